@@ -8,9 +8,26 @@ import sys
 from pathlib import Path
 from typing import Callable, List, Optional
 
-from tools.rephrase import rephrase_question
-from tools.retrieve import generate_metadata_filter, retrieve_from_kb
-from tools.retrieve_generate import ret_and_gen
+from tools.batch import load_prompts, run_batch
+from tools.bedrock import last_usage
+from tools import session
+from tools.config import FanoutConfig, LocalIndexConfig, PipelineConfig, RetrieveConfig, ServeConfig, SessionConfig
+from tools.deadline import Deadline
+from tools.fanout import parse_knowledge_bases, retrieve_from_kbs
+from tools.fused import rephrase_and_extract
+from tools.metadata import evaluate_rules
+from tools.pipeline import retrieve_then_generate
+from tools.rephrase import rephrase_question, rephrase_question_stream
+from tools.sections import retrieve_then_generate_sections, retrieve_then_generate_sections_stream
+from tools.retrieve import (
+    generate_metadata_filter,
+    metadata_filter_cache_stats,
+    retrieval_cache_stats,
+    retrieve_from_kb,
+    speculation_stats,
+)
+from tools.retrieve_generate import ret_and_gen, ret_and_gen_stream
+from tools.singleflight import stats as single_flight_stats
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -25,6 +42,24 @@ def build_parser() -> argparse.ArgumentParser:
         help="Invoke the Nova Pro based rephrase_question helper.",
     )
     rephrase_parser.add_argument("prompt", help="Prompt that should be rewritten in first-person formal tone.")
+    rephrase_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Print the rephrased text incrementally as the model streams it.",
+    )
+    rephrase_parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="End-to-end time budget in seconds; stages get a share of what is left and the optional "
+             "metadata filter is skipped when time runs short.",
+    )
+    rephrase_parser.add_argument(
+        "--with-filter",
+        action="store_true",
+        help="Rephrase and extract the retrieval query plus metadata filter in a single model call "
+             "(falls back to two calls when the combined output cannot be parsed).",
+    )
     rephrase_parser.set_defaults(handler=run_rephrase)
 
     # Scenario 2: retrieve and generate
@@ -56,6 +91,56 @@ def build_parser() -> argparse.ArgumentParser:
         default=None,
         help="Optional file path for storing the generated draft (default when flag used: output/ret_and_gen.md).",
     )
+    ret_gen_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Use RetrieveAndGenerateStream (or, with --mode sections, print sections in order as they complete): "
+             "print (and save) the draft as it is generated; citations go to stderr.",
+    )
+    ret_gen_parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="End-to-end time budget in seconds; stages get a share of what is left and the optional "
+             "metadata filter is skipped when time runs short.",
+    )
+    ret_gen_parser.add_argument(
+        "--mode",
+        choices=["kb", "split", "sections"],
+        default=PipelineConfig.MODE,
+        help="kb: one RetrieveAndGenerate call; split: retrieve, dedupe and pack chunks into a token budget, "
+             "then invoke the model directly; sections: like split, but generate the four draft sections "
+             "concurrently with per-section token limits (default: $RET_GEN_MODE or kb).",
+    )
+    ret_gen_parser.add_argument(
+        "--context-tokens",
+        type=int,
+        default=None,
+        help="Token budget for retrieved context in split and sections modes "
+             "(default: $RET_GEN_CONTEXT_TOKENS or 1500).",
+    )
+    ret_gen_parser.add_argument(
+        "--rephrase",
+        action="store_true",
+        help="Rephrase the prompt and extract a metadata filter in one model call before retrieval; "
+             "the rephrased text is used as the question and the filter narrows the search.",
+    )
+    ret_gen_parser.add_argument(
+        "--session",
+        default=None,
+        metavar="SESSION_ID",
+        help="Revise the draft of an earlier ret-gen run instead of starting over: the prompt is the edit "
+             "instruction and only the previous draft is sent to the model, without retrieving again. "
+             "Requires --session-store.",
+    )
+    ret_gen_parser.add_argument(
+        "--session-store",
+        nargs="?",
+        const="output/draft_sessions.db",
+        default=SessionConfig.PERSIST_PATH,
+        help="SQLite file that keeps the draft so it can be revised later with --session; drafts are only kept "
+             "when this is set (default: $DRAFT_SESSION_PATH; default when flag used: output/draft_sessions.db).",
+    )
     ret_gen_parser.set_defaults(handler=run_ret_gen)
 
     # Scenario 3: retrieve chunks and/or metadata filters
@@ -67,7 +152,21 @@ def build_parser() -> argparse.ArgumentParser:
     retrieve_parser.add_argument(
         "--kb-id",
         default=os.environ.get("KNOWLEDGE_BASE_ID"),
-        help="Knowledge Base ID (default: $KNOWLEDGE_BASE_ID).",
+        help="Knowledge Base ID (default: $KNOWLEDGE_BASE_ID). A comma separated list such as "
+             "KB1,KB2@us-west-2 queries every knowledge base concurrently and fuses the results.",
+    )
+    retrieve_parser.add_argument(
+        "--fusion",
+        choices=["rrf", "score"],
+        default=FanoutConfig.FUSION,
+        help="How results from several knowledge bases are merged: reciprocal-rank fusion or "
+             "min-max normalized scores (default: $RETRIEVE_FUSION or rrf).",
+    )
+    retrieve_parser.add_argument(
+        "--quorum",
+        type=int,
+        default=None,
+        help="Return as soon as this many knowledge bases have answered (default: all of them).",
     )
     retrieve_parser.add_argument(
         "--top-k",
@@ -85,8 +184,254 @@ def build_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="Include the full bedrock-agent-runtime.retrieve response in the output JSON.",
     )
+    retrieve_parser.add_argument(
+        "--no-filter-cache",
+        action="store_true",
+        help="Bypass the metadata filter cache and always call the model.",
+    )
+    retrieve_parser.add_argument(
+        "--no-retrieval-cache",
+        action="store_true",
+        help="Bypass the retrieval result cache and always call retrieve().",
+    )
+    retrieve_parser.add_argument(
+        "--backend",
+        choices=["kb", "local"],
+        default=RetrieveConfig.BACKEND,
+        help="Retrieve from the Bedrock Knowledge Base or from a local index built with index-build "
+             "(default: $RETRIEVE_BACKEND or kb).",
+    )
+    retrieve_parser.add_argument(
+        "--rerank",
+        action="store_true",
+        help="Over-fetch candidates and re-rank them locally with character n-gram BM25 before keeping --top-k.",
+    )
+    retrieve_parser.add_argument(
+        "--fetch-k",
+        type=int,
+        default=None,
+        help="Number of candidates fetched for --rerank (default: $RETRIEVE_RERANK_FETCH_K or 20).",
+    )
+    retrieve_parser.add_argument(
+        "--index-path",
+        default=LocalIndexConfig.PATH,
+        help="Local index directory used with --backend local (default: $LOCAL_INDEX_PATH or ./index).",
+    )
+    retrieve_parser.add_argument(
+        "--no-rules",
+        action="store_true",
+        help="Skip the rule-based metadata extractor and always ask the model.",
+    )
+    retrieve_parser.add_argument(
+        "--speculative",
+        action="store_true",
+        help="Start an unfiltered retrieve while the metadata filter is being generated.",
+    )
+    retrieve_parser.add_argument(
+        "--cache-stats",
+        action="store_true",
+        help="Include cache hit/miss/eviction statistics (metadata filter and retrieval results) in the output JSON.",
+    )
+    retrieve_parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="End-to-end time budget in seconds; stages get a share of what is left and the optional "
+             "metadata filter is skipped when time runs short.",
+    )
     retrieve_parser.set_defaults(handler=run_retrieve)
 
+    # Evaluate the rule-based metadata extractor against labelled prompts
+    filter_eval_parser = subparsers.add_parser(
+        "filter-eval",
+        help="Measure rule-based metadata filter accuracy (and LLM agreement) on a labelled JSONL file.",
+    )
+    filter_eval_parser.add_argument(
+        "labels",
+        help='JSONL file where each line is {"prompt": ..., "metadata_filter": {...} | null}.',
+    )
+    filter_eval_parser.add_argument(
+        "--with-llm",
+        action="store_true",
+        help="Also call the LLM filter generator for every prompt and report agreement.",
+    )
+    filter_eval_parser.set_defaults(handler=run_filter_eval)
+
+    # Build a local vector index for --backend local
+    index_parser = subparsers.add_parser(
+        "index-build",
+        help="Build a local vector index from an exported Knowledge Base directory.",
+    )
+    index_parser.add_argument(
+        "export_dir",
+        help="Directory with chunks.jsonl (text, metadata, uri, optional embedding) or *.md/*.txt documents "
+             "with <name>.metadata.json sidecars.",
+    )
+    index_parser.add_argument(
+        "--output",
+        default=LocalIndexConfig.PATH,
+        help="Index directory to write (default: $LOCAL_INDEX_PATH or ./index).",
+    )
+    index_parser.add_argument(
+        "--ivf-lists",
+        type=int,
+        default=0,
+        help="Number of IVF clusters; 0 keeps exact brute-force search (default: 0).",
+    )
+    index_parser.add_argument(
+        "--embedder",
+        default=None,
+        help="Embedder name: hashing-<dim> (default, offline) or bedrock:<model_id>:<dim>.",
+    )
+    index_parser.set_defaults(handler=run_index_build)
+
+    # Bulk mode: run one of the flows above over many prompts
+    batch_parser = subparsers.add_parser(
+        "batch",
+        help="Run rephrase, retrieve or ret-gen over prompts from a JSONL/CSV file with a worker pool.",
+    )
+    batch_parser.add_argument("operation", choices=["rephrase", "retrieve", "ret-gen"], help="Flow to run per prompt.")
+    batch_parser.add_argument("input", help='JSONL or CSV file with a "prompt" column and an optional "id" column.')
+    batch_parser.add_argument(
+        "--output",
+        default="output/batch.jsonl",
+        help="JSONL file that receives one result per line as soon as it finishes (default: output/batch.jsonl).",
+    )
+    batch_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Number of prompts processed in parallel (default: 8).",
+    )
+    batch_parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip prompts already completed successfully in --output and append the rest.",
+    )
+    batch_parser.add_argument(
+        "--kb-id",
+        default=os.environ.get("KNOWLEDGE_BASE_ID"),
+        help="Knowledge Base ID for retrieve / ret-gen (default: $KNOWLEDGE_BASE_ID).",
+    )
+    batch_parser.add_argument(
+        "--model-arn",
+        default=os.environ.get("MODEL_ARN"),
+        help="Bedrock model ARN for ret-gen (default: $MODEL_ARN).",
+    )
+    batch_parser.add_argument(
+        "--top-k",
+        type=int,
+        default=None,
+        help="Override numberOfResults for retrieve / ret-gen.",
+    )
+    batch_parser.set_defaults(handler=run_batch_command)
+
+    # Benchmark / load test across all stages
+    bench_parser = subparsers.add_parser(
+        "bench",
+        help="Benchmark rephrase -> metadata filter -> retrieve -> generate at increasing concurrency.",
+    )
+    bench_parser.add_argument(
+        "--backend",
+        choices=["aws", "simulator", "replay"],
+        default="simulator",
+        help="Bedrock backend to benchmark against (default: simulator; replay uses $BEDROCK_CASSETTE).",
+    )
+    bench_parser.add_argument(
+        "--prompts",
+        default=None,
+        help="Optional JSONL/CSV file with prompts (default: a small built-in set).",
+    )
+    bench_parser.add_argument(
+        "--concurrency",
+        default="1,4,16",
+        help="Comma separated concurrency levels (default: 1,4,16).",
+    )
+    bench_parser.add_argument(
+        "--requests",
+        type=int,
+        default=20,
+        help="Number of end-to-end requests per concurrency level (default: 20).",
+    )
+    bench_parser.add_argument(
+        "--use-rules",
+        action="store_true",
+        help="Let the metadata filter stage use rules and caches instead of always calling the model.",
+    )
+    bench_parser.add_argument(
+        "--skip-import",
+        action="store_true",
+        help="Skip the cold-import measurement.",
+    )
+    bench_parser.add_argument(
+        "--kb-id",
+        default=os.environ.get("KNOWLEDGE_BASE_ID"),
+        help="Knowledge Base ID (required for --backend aws; default: $KNOWLEDGE_BASE_ID).",
+    )
+    bench_parser.add_argument(
+        "--model-arn",
+        default=os.environ.get("MODEL_ARN"),
+        help="Bedrock model ARN (required for --backend aws; default: $MODEL_ARN).",
+    )
+    bench_parser.add_argument(
+        "--output",
+        default="output/bench.json",
+        help="Where to write the machine-readable results (default: output/bench.json).",
+    )
+    bench_parser.add_argument(
+        "--baseline",
+        default=None,
+        help="Previous bench JSON to compare against; regressions make the command exit with status 1.",
+    )
+    bench_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.10,
+        help="Relative change treated as a regression when --baseline is given (default: 0.10).",
+    )
+    bench_parser.set_defaults(handler=run_bench)
+
+    # Long-running HTTP server
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Run an HTTP server exposing rephrase, retrieve, metadata-filter and ret-gen (with SSE streaming).",
+    )
+    serve_parser.add_argument(
+        "--host",
+        default=ServeConfig.HOST,
+        help="Address to bind (default: $SERVE_HOST or 127.0.0.1; use 0.0.0.0 in containers).",
+    )
+    serve_parser.add_argument("--port", type=int, default=ServeConfig.PORT, help="Port to bind (default: $SERVE_PORT or 8080).")
+    serve_parser.add_argument(
+        "--kb-id",
+        default=os.environ.get("KNOWLEDGE_BASE_ID"),
+        help="Knowledge Base ID for retrieve / ret-gen (default: $KNOWLEDGE_BASE_ID).",
+    )
+    serve_parser.add_argument(
+        "--model-arn",
+        default=os.environ.get("MODEL_ARN"),
+        help="Bedrock model ARN for ret-gen (default: $MODEL_ARN).",
+    )
+    serve_parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=ServeConfig.MAX_CONCURRENCY,
+        help="Requests processed at the same time; further requests wait in the queue (default: $SERVE_MAX_CONCURRENCY).",
+    )
+    serve_parser.add_argument(
+        "--max-queue",
+        type=int,
+        default=ServeConfig.MAX_QUEUE,
+        help="Requests allowed to wait for a slot before the server answers 503 (default: $SERVE_MAX_QUEUE).",
+    )
+    serve_parser.add_argument(
+        "--request-timeout",
+        type=float,
+        default=ServeConfig.REQUEST_TIMEOUT,
+        help="End-to-end deadline per request in seconds (default: $SERVE_REQUEST_TIMEOUT or 60).",
+    )
+    serve_parser.set_defaults(handler=run_serve)
+
     return parser
 
 
@@ -96,9 +441,33 @@ def _require(value: Optional[str], *, flag: str, env: str) -> str:
     raise SystemExit(f"Missing required {flag}. Provide it explicitly or set the {env} environment variable.")
 
 
+def _deadline(args: argparse.Namespace) -> Optional[Deadline]:
+    return Deadline(args.deadline) if args.deadline else None
+
+
+def _cache_stats() -> dict:
+    return {"metadata_filter": metadata_filter_cache_stats(), "retrieval": retrieval_cache_stats(),
+            "single_flight": single_flight_stats()}
+
+
 def run_rephrase(args: argparse.Namespace) -> int:
-    rephrased = rephrase_question(args.prompt)
-    print(json.dumps({"input": args.prompt, "rephrased": rephrased}, indent=2, ensure_ascii=False))
+    deadline = _deadline(args)
+    if args.with_filter:
+        if args.stream:
+            raise SystemExit("--stream cannot be combined with --with-filter.")
+        result = rephrase_and_extract(args.prompt, deadline=deadline)
+        print(json.dumps(dict({"input": args.prompt}, **result, usage=last_usage()), indent=2, ensure_ascii=False))
+        return 0
+    if args.stream:
+        for text in rephrase_question_stream(args.prompt, deadline=deadline):
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        sys.stdout.write("\n")
+        return 0
+
+    rephrased = rephrase_question(args.prompt, deadline=deadline)
+    print(json.dumps({"input": args.prompt, "rephrased": rephrased, "usage": last_usage()},
+                     indent=2, ensure_ascii=False))
     return 0
 
 
@@ -106,15 +475,79 @@ def run_ret_gen(args: argparse.Namespace) -> int:
     kb_id = _require(args.kb_id, flag="--kb-id", env="KNOWLEDGE_BASE_ID")
     model_arn = _require(args.model_arn, flag="--model-arn", env="MODEL_ARN")
 
-    response = ret_and_gen(
-        args.prompt,
-        kb_id,
-        model_arn,
-        number_of_results=args.top_k,
-    )
+    if args.stream and args.mode == "split":
+        raise SystemExit("--stream is only supported with --mode kb or sections.")
+    if args.session and (args.stream or args.rephrase):
+        raise SystemExit("--session cannot be combined with --stream or --rephrase.")
+
+    if args.session and not args.session_store:
+        raise SystemExit("--session requires --session-store (or $DRAFT_SESSION_PATH).")
+
+    session.configure(args.session_store)
+    deadline = _deadline(args)
+    if args.session:
+        try:
+            response = session.revise_draft(args.session, args.prompt, deadline)
+        except session.SessionNotFound:
+            raise SystemExit(f"Session {args.session} was not found or has expired.")
+        return _print_ret_gen(args, response, None, args.session)
+
+    prompt, metadata_filter, rephrased, retrieval_query = args.prompt, None, None, None
+    if args.rephrase:
+        rephrased = rephrase_and_extract(args.prompt, deadline=deadline)
+        # 空 dict 代表「已確認不需要 filter」，split 模式不會再產生一次
+        prompt, metadata_filter = rephrased["rephrased"], rephrased["metadata_filter"] or {}
+        # split / sections 模式以去除條件後的 query 檢索；kb 模式的 RetrieveAndGenerate 只接受一段輸入
+        retrieval_query = rephrased["query"]
+
+    if args.stream:
+        return _run_ret_gen_stream(args, kb_id, model_arn, prompt, metadata_filter, deadline, retrieval_query)
+
+    if args.mode == "split":
+        response = retrieve_then_generate(
+            prompt,
+            kb_id,
+            model_arn,
+            number_of_results=args.top_k,
+            metadata_filter=metadata_filter,
+            token_budget=args.context_tokens,
+            deadline=deadline,
+            retrieval_query=retrieval_query,
+        )
+    elif args.mode == "sections":
+        response = retrieve_then_generate_sections(
+            prompt,
+            kb_id,
+            model_arn,
+            number_of_results=args.top_k,
+            metadata_filter=metadata_filter,
+            token_budget=args.context_tokens,
+            deadline=deadline,
+            retrieval_query=retrieval_query,
+        )
+    else:
+        response = ret_and_gen(
+            prompt,
+            kb_id,
+            model_arn,
+            number_of_results=args.top_k,
+            deadline=deadline,
+            metadata_filter=metadata_filter,
+        )
+    session_id = session.start_session(prompt, response, kb_id, model_arn) if args.session_store else None
+    return _print_ret_gen(args, response, rephrased, session_id)
+
 
+def _print_ret_gen(args: argparse.Namespace,
+                   response: dict,
+                   rephrased: Optional[dict],
+                   session_id: Optional[str]) -> int:
     output = response.get("output", {}).get("text")
     payload = {"response": response}
+    if session_id:
+        payload["session_id"] = session_id
+    if rephrased is not None:
+        payload["rephrase"] = rephrased
     if output:
         payload["output_text"] = output
 
@@ -129,33 +562,303 @@ def run_ret_gen(args: argparse.Namespace) -> int:
     return 0
 
 
+def _run_ret_gen_stream(args: argparse.Namespace,
+                        kb_id: str,
+                        model_arn: str,
+                        prompt: str,
+                        metadata_filter: Optional[dict],
+                        deadline: Optional[Deadline],
+                        retrieval_query: Optional[str] = None) -> int:
+    output_file = None
+    if args.save_output:
+        output_path = Path(args.save_output)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        output_file = output_path.open("w", encoding="utf-8")
+
+    summary: dict = {"citations": []}
+    texts: List[str] = []
+    if args.mode == "sections":
+        events = retrieve_then_generate_sections_stream(prompt, kb_id, model_arn, number_of_results=args.top_k,
+                                                        metadata_filter=metadata_filter,
+                                                        token_budget=args.context_tokens, deadline=deadline,
+                                                        retrieval_query=retrieval_query)
+    else:
+        events = ret_and_gen_stream(prompt, kb_id, model_arn, number_of_results=args.top_k,
+                                    deadline=deadline, metadata_filter=metadata_filter)
+    try:
+        for event in events:
+            if event["type"] == "text":
+                texts.append(event["text"])
+                sys.stdout.write(event["text"])
+                sys.stdout.flush()
+                if output_file is not None:
+                    output_file.write(event["text"])
+                    output_file.flush()
+            elif event["type"] == "citation":
+                summary["citations"].append(event["citation"])
+            elif event["type"] == "session":
+                summary["sessionId"] = event["sessionId"]
+            elif event["type"] == "section":
+                summary.setdefault("sections", []).append(
+                    {"index": event["index"], "heading": event["heading"], "latency_ms": event["latency_ms"]})
+    finally:
+        if output_file is not None:
+            output_file.close()
+
+    sys.stdout.write("\n")
+    if args.session_store:
+        summary["session_id"] = session.start_session(prompt, dict(summary, output={"text": "".join(texts)}),
+                                                      kb_id, model_arn)
+    print(json.dumps(summary, indent=2, ensure_ascii=False), file=sys.stderr)
+    if output_file is not None:
+        print(f"Saved generated text to {args.save_output}", file=sys.stderr)
+    return 0
+
+
 def run_retrieve(args: argparse.Namespace) -> int:
-    kb_id = _require(args.kb_id, flag="--kb-id", env="KNOWLEDGE_BASE_ID")
-    metadata_filter = generate_metadata_filter(args.prompt)
+    if args.backend == "local":
+        # 本地索引不使用 knowledge base ID，只用來區分快取與遙測
+        kb_id = args.kb_id or "local"
+        LocalIndexConfig.PATH = args.index_path
+    else:
+        kb_id = _require(args.kb_id, flag="--kb-id", env="KNOWLEDGE_BASE_ID")
+    knowledge_bases = parse_knowledge_bases(kb_id)
+    if len(knowledge_bases) > 1 and args.backend == "local":
+        raise SystemExit("--backend local cannot be combined with multiple knowledge bases.")
+    if len(knowledge_bases) > 1 and args.speculative and not args.metadata_only:
+        raise SystemExit("--speculative cannot be combined with multiple knowledge bases.")
+    use_cache = not args.no_filter_cache
+    deadline = _deadline(args)
+
+    if args.speculative and not args.metadata_only:
+        # filter 交由 retrieve_from_kb 產生，以便與推測的 retrieve 並行
+        response = retrieve_from_kb(
+            args.prompt,
+            kb_id,
+            number_of_results=args.top_k,
+            use_filter_cache=use_cache,
+            speculative=True,
+            deadline=deadline,
+            use_retrieval_cache=not args.no_retrieval_cache,
+            backend=args.backend,
+            rerank=args.rerank or None,
+            fetch_k=args.fetch_k,
+            use_rules=not args.no_rules,
+        )
+        speculation = response.pop("speculation", None)
+        if speculation is not None:
+            metadata_filter = speculation["metadata_filter"]
+        else:
+            metadata_filter = generate_metadata_filter(args.prompt, use_cache=use_cache, use_rules=not args.no_rules)
+        return _print_retrieve(args, response, metadata_filter, speculation)
+
+    metadata_filter = generate_metadata_filter(args.prompt, use_cache=use_cache, use_rules=not args.no_rules,
+                                               deadline=deadline)
 
     if args.metadata_only:
-        print(json.dumps({"metadata_filter": metadata_filter}, indent=2, ensure_ascii=False))
+        payload = {"metadata_filter": metadata_filter}
+        if args.cache_stats:
+            payload["cache_stats"] = _cache_stats()
+        print(json.dumps(payload, indent=2, ensure_ascii=False))
         return 0
 
+    if len(knowledge_bases) > 1:
+        response = retrieve_from_kbs(
+            args.prompt,
+            knowledge_bases,
+            number_of_results=args.top_k,
+            metadata_filter=metadata_filter if metadata_filter is not None else {},
+            fusion=args.fusion,
+            quorum=args.quorum,
+            deadline=deadline,
+            use_filter_cache=use_cache,
+            use_retrieval_cache=not args.no_retrieval_cache,
+            backend=args.backend,
+            rerank=args.rerank or None,
+            fetch_k=args.fetch_k,
+        )
+        return _print_retrieve(args, response, metadata_filter)
+
     response = retrieve_from_kb(
         args.prompt,
         kb_id,
         number_of_results=args.top_k,
-        metadata_filter=metadata_filter,
+        # 空 dict 代表「已確認不需要 filter」，避免 retrieve_from_kb 再產生一次
+        metadata_filter=metadata_filter if metadata_filter is not None else {},
+        use_filter_cache=use_cache,
+        deadline=deadline,
+        use_retrieval_cache=not args.no_retrieval_cache,
+        backend=args.backend,
+        rerank=args.rerank or None,
+        fetch_k=args.fetch_k,
     )
+    return _print_retrieve(args, response, metadata_filter)
+
 
+def _print_retrieve(args: argparse.Namespace,
+                    response: dict,
+                    metadata_filter: Optional[dict],
+                    speculation: Optional[dict] = None) -> int:
     chunks = response.get("retrievalResults", [])
+    retrieval_cache = response.pop("retrieval_cache", None)
     payload = {
         "chunks": chunks,
         "metadata_filter": metadata_filter,
     }
+    if retrieval_cache is not None:
+        payload["retrieval_cache"] = retrieval_cache
+    if "knowledge_bases" in response:
+        payload["knowledge_bases"] = response["knowledge_bases"]
+    if speculation is not None:
+        payload["speculation"] = dict(speculation, totals=speculation_stats())
     if args.show_raw:
         payload["raw_response"] = response
+    if args.cache_stats:
+        payload["cache_stats"] = _cache_stats()
 
     print(json.dumps(payload, indent=2, ensure_ascii=False))
     return 0
 
 
+def run_filter_eval(args: argparse.Namespace) -> int:
+    with open(args.labels, encoding="utf-8") as handle:
+        samples = [json.loads(line) for line in handle if line.strip()]
+
+    llm = None
+    if args.with_llm:
+        llm = lambda prompt: generate_metadata_filter(prompt, use_cache=False, use_rules=False)  # noqa: E731
+
+    report = evaluate_rules(samples, llm=llm)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    return 0
+
+
+def run_index_build(args: argparse.Namespace) -> int:
+    from tools.local_index import build_index, embedder_from_name
+
+    embedder = embedder_from_name(args.embedder) if args.embedder else None
+    manifest = build_index(args.export_dir, args.output, embedder=embedder, ivf_lists=args.ivf_lists)
+    print(json.dumps(manifest, indent=2, ensure_ascii=False))
+    return 0
+
+
+def _batch_operation(args: argparse.Namespace) -> Callable[[str], dict]:
+    if args.operation == "rephrase":
+        return lambda prompt: {"rephrased": rephrase_question(prompt)}
+
+    kb_id = _require(args.kb_id, flag="--kb-id", env="KNOWLEDGE_BASE_ID")
+    if args.operation == "retrieve":
+        def _retrieve(prompt: str) -> dict:
+            metadata_filter = generate_metadata_filter(prompt)
+            response = retrieve_from_kb(
+                prompt,
+                kb_id,
+                number_of_results=args.top_k,
+                metadata_filter=metadata_filter if metadata_filter is not None else {},
+            )
+            return {"chunks": response.get("retrievalResults", []), "metadata_filter": metadata_filter}
+        return _retrieve
+
+    model_arn = _require(args.model_arn, flag="--model-arn", env="MODEL_ARN")
+
+    def _ret_gen(prompt: str) -> dict:
+        response = ret_and_gen(prompt, kb_id, model_arn, number_of_results=args.top_k)
+        return {
+            "output_text": response.get("output", {}).get("text"),
+            "citations": response.get("citations", []),
+        }
+    return _ret_gen
+
+
+def run_batch_command(args: argparse.Namespace) -> int:
+    if args.concurrency < 1:
+        raise SystemExit("--concurrency must be at least 1.")
+    operation = _batch_operation(args)
+    records = load_prompts(args.input)
+
+    def _progress(row: dict) -> None:
+        status = "ok" if row["ok"] else f"error: {row['error']}"
+        print(f"[{row['id']}] {row['latency_ms']:.0f} ms {status}", file=sys.stderr)
+
+    summary = run_batch(
+        records,
+        operation,
+        args.output,
+        concurrency=args.concurrency,
+        resume=args.resume,
+        on_result=_progress,
+    )
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    return 0 if summary["failed"] == 0 else 1
+
+
+def run_bench(args: argparse.Namespace) -> int:
+    from tools import bench
+    from tools.simulator import use_backend
+
+    if args.backend == "aws":
+        kb_id = _require(args.kb_id, flag="--kb-id", env="KNOWLEDGE_BASE_ID")
+        model_arn = _require(args.model_arn, flag="--model-arn", env="MODEL_ARN")
+    else:
+        kb_id = args.kb_id or "simulated-kb"
+        model_arn = args.model_arn or "simulated-model"
+    use_backend(args.backend)
+
+    prompts = [record["prompt"] for record in load_prompts(args.prompts)] if args.prompts else bench.DEFAULT_PROMPTS
+    levels = [int(level) for level in args.concurrency.split(",") if level.strip()]
+
+    result = bench.run_benchmark(
+        prompts,
+        kb_id,
+        model_arn,
+        concurrency_levels=levels,
+        requests_per_level=args.requests,
+        backend=args.backend,
+        use_llm_filter=not args.use_rules,
+        measure_import=not args.skip_import,
+    )
+
+    regressions: List[str] = []
+    if args.baseline:
+        regressions = bench.compare_results(result, bench.load_result(args.baseline), args.threshold)
+        result["regressions"] = regressions
+
+    output_path = Path(args.output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    output_path.write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+
+    for level in result["levels"]:
+        stages = ", ".join(f"{stage} p95={summary.get('p95_ms', 0):.0f}ms" for stage, summary in level["stages"].items())
+        print(
+            f"c={level['concurrency']}: {level['throughput_per_s']:.2f} req/s, "
+            f"e2e p50={level['end_to_end'].get('p50_ms', 0):.0f}ms p95={level['end_to_end'].get('p95_ms', 0):.0f}ms "
+            f"p99={level['end_to_end'].get('p99_ms', 0):.0f}ms, errors={level['errors']} | {stages}"
+        )
+    if "cold_import" in result:
+        print(f"cold import: {result['cold_import']['median_ms']:.0f}ms")
+    print(f"Saved benchmark results to {output_path}")
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+def run_serve(args: argparse.Namespace) -> int:
+    from tools.server import serve
+
+    if args.max_concurrency < 1 or args.max_queue < 0:
+        raise SystemExit("--max-concurrency must be at least 1 and --max-queue cannot be negative.")
+    serve(
+        args.kb_id,
+        args.model_arn,
+        host=args.host,
+        port=args.port,
+        max_concurrency=args.max_concurrency,
+        max_queue=args.max_queue,
+        request_timeout=args.request_timeout,
+    )
+    return 0
+
+
 def main(argv: Optional[List[str]] = None) -> int:
     parser = build_parser()
     args = parser.parse_args(argv)
@@ -0,0 +1,14 @@
+import pytest
+
+from tools.simulator import SimulatorConfig, use_backend
+
+
+@pytest.fixture
+def simulator():
+    """
+    以本地模擬器取代 Bedrock（不需 AWS 憑證）；time_scale 很小，模擬的延遲只保留相對長短。
+    """
+    config = SimulatorConfig(time_scale=0.05, seed=7)
+    use_backend("simulator", config)
+    yield config
+    use_backend("aws")
@@ -1,24 +1,183 @@
 import json
 import os
-from tools.retrieve_generate import ret_and_gen
+import threading
+import time
+from tools import telemetry
+from tools.config import LambdaConfig, PipelineConfig, RetrieveGenerateConfig, SessionConfig
+from tools.deadline import Deadline, DeadlineExceeded
+
+# boto3 / tools.retrieve_generate 延後到 _initialize() 才載入，
+# 以便分別量測 import 與 client 建立的時間，也讓只 import 本模組的工具（例如測試）不必付出這些成本。
+_retrieve_generate = None
+_init_lock = threading.Lock()
+_cold_start = {'import_ms': None, 'init_ms': None, 'pending': True}
+
+
+def _initialize(deadline=None):
+    """
+    載入重量級模組並建立 Bedrock client（只執行一次），回傳 tools.retrieve_generate 模組。
+    在 Lambda 中於 init 階段執行，provisioned concurrency 會在收到請求前就完成這一步。
+    """
+    global _retrieve_generate
+    if _retrieve_generate is not None:
+        if deadline is not None:
+            # 依本次可用時間建立對應逾時級距的 client（已存在則直接取用）
+            _retrieve_generate.warm_up(RetrieveGenerateConfig.REGION, deadline)
+        return _retrieve_generate
+    with _init_lock:
+        if _retrieve_generate is None:
+            started = time.perf_counter()
+            import boto3  # noqa: F401  預先載入，計入 import 時間
+            from tools import retrieve_generate
+            imported = time.perf_counter()
+            retrieve_generate.warm_up(RetrieveGenerateConfig.REGION, deadline)
+            if PipelineConfig.MODE in ('split', 'sections'):
+                from tools import pipeline
+                pipeline.warm_up(RetrieveGenerateConfig.REGION, deadline)
+            initialized = time.perf_counter()
+
+            _cold_start['import_ms'] = (imported - started) * 1000
+            _cold_start['init_ms'] = (initialized - imported) * 1000
+            telemetry.metric('cold_start_import', _cold_start['import_ms'])
+            telemetry.metric('cold_start_init', _cold_start['init_ms'])
+            _retrieve_generate = retrieve_generate
+    return _retrieve_generate
+
+
+def _ret_and_gen(retrieve_generate):
+    """
+    依 RET_GEN_MODE 選擇生成流程：kb 使用 RetrieveAndGenerate，split 先檢索再直接呼叫模型，
+    sections 先檢索再同時生成四個段落。
+    """
+    if PipelineConfig.MODE == 'split':
+        from tools.pipeline import retrieve_then_generate
+        return retrieve_then_generate
+    if PipelineConfig.MODE == 'sections':
+        from tools.sections import retrieve_then_generate_sections
+        return retrieve_then_generate_sections
+    return retrieve_generate.ret_and_gen
+
+
+def _ret_and_gen_stream(retrieve_generate):
+    """
+    串流版本：sections 模式另外送出 section 事件（依完成順序），其餘模式使用 RetrieveAndGenerateStream。
+    """
+    if PipelineConfig.MODE == 'sections':
+        from tools.sections import retrieve_then_generate_sections_stream
+        return retrieve_then_generate_sections_stream
+    return retrieve_generate.ret_and_gen_stream
+
+
+def _revise(session_id, instruction, deadline):
+    """
+    以 prompt_question 作為修改指示，修訂 session 中的草稿而不重新檢索；
+    session 不存在（未開啟、已過期或由其他執行環境建立）時回傳 None。
+    """
+    from tools import session
+    try:
+        return session.revise_draft(session_id, instruction, deadline)
+    except session.SessionNotFound:
+        return None
+
+
+def _start_session(prompt_question, response, knowledge_base_id, model_arn):
+    """開啟草稿 session（DRAFT_SESSIONS=1 或設定 DRAFT_SESSION_PATH）時保存草稿，回傳 session id；否則回傳 None。"""
+    if not SessionConfig.ENABLED:
+        return None
+    from tools import session
+    return session.start_session(prompt_question, response, knowledge_base_id, model_arn)
+
+
+def _consume_cold_start():
+    """回傳此次呼叫是否為該執行環境的第一次呼叫（cold start）。"""
+    cold = _cold_start['pending']
+    _cold_start['pending'] = False
+    return cold
+
+
+def _is_warmup(event):
+    """
+    判斷是否為預熱事件：明確帶有 {"warmup": true}（例如 EventBridge 排程的固定輸入）
+    或 serverless-plugin-warmup；其他 source 為 aws.events 的事件不視為預熱。
+    """
+    return isinstance(event, dict) and (
+        event.get('warmup') is True or event.get('source') in LambdaConfig.WARMUP_SOURCES
+    )
+
+
+def _warmup_response(context):
+    """只完成初始化、不呼叫 Bedrock，回傳 cold start 相關的量測值。"""
+    _initialize(Deadline.from_lambda_context(context))
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'warmed': True,
+            'cold_start': _consume_cold_start(),
+            'import_ms': _cold_start['import_ms'],
+            'init_ms': _cold_start['init_ms']
+        }, ensure_ascii=False)
+    }
+
+
+def _get_body(event):
+    """
+    取得直接呼叫或 API Gateway 格式 event 的輸入欄位
+    """
+    if 'body' in event:
+        return json.loads(event['body']) if isinstance(event['body'], str) else event['body']
+    return event
+
+
+def _get_prompt_question(event):
+    """
+    從直接呼叫或 API Gateway 格式的 event 取得 prompt_question
+    """
+    return _get_body(event).get('prompt_question')
+
+
+def _rephrase(event, prompt_question, deadline):
+    """
+    event 中 rephrase 為 true 時，先以一次模型呼叫重述問題並擷取 metadata filter，
+    回傳 (生成用的問題, metadata filter, 重述結果)；未要求時原樣回傳。
+    """
+    if _get_body(event).get('rephrase') is not True:
+        return prompt_question, None, None
+    from tools.fused import rephrase_and_extract
+    rephrased = rephrase_and_extract(prompt_question, deadline=deadline)
+    # 空 dict 代表「已確認不需要 filter」，split 模式不會再產生一次
+    return rephrased['rephrased'], rephrased['metadata_filter'] or {}, rephrased
+
+
+def _retrieval_kwargs(rephrased, modes):
+    """
+    有重述結果且 RET_GEN_MODE 屬於 modes 時，以 rephrase_and_extract 去除條件後的 query 檢索；
+    kb 模式的 RetrieveAndGenerate 只接受一段輸入，仍以重述文字檢索與生成。
+    """
+    if rephrased is None or PipelineConfig.MODE not in modes:
+        return {}
+    return {'retrieval_query': rephrased['query']}
 
 
 def lambda_handler(event, context):
     """
     Lambda 函數處理器：接收 prompt_question，回傳簽呈草稿文字
     """
+    if _is_warmup(event):
+        return _warmup_response(context)
+
     try:
+        # 以 Lambda 剩餘執行時間作為端到端 deadline
+        deadline = Deadline.from_lambda_context(context)
+        retrieve_generate = _initialize()
+        cold_start = _consume_cold_start()
+
         # 從環境變數讀取必要參數
         knowledge_base_id = os.environ['KNOWLEDGE_BASE_ID']
         model_arn = os.environ['MODEL_ARN']
-        
+
         # 從 event 取得輸入
-        if 'body' in event:
-            body = json.loads(event['body']) if isinstance(event['body'], str) else event['body']
-            prompt_question = body.get('prompt_question')
-        else:
-            prompt_question = event.get('prompt_question')
-        
+        prompt_question = _get_prompt_question(event)
+
         if not prompt_question:
             return {
                 'statusCode': 400,
@@ -26,28 +185,120 @@ def lambda_handler(event, context):
                     'error': 'prompt_question is required'
                 }, ensure_ascii=False)
             }
-        
-        # 執行檢索與生成
-        response = ret_and_gen(
-            prompt_question=prompt_question,
-            knowledge_base_id=knowledge_base_id,
-            model_arn=model_arn
-        )
-        
+
+        # 執行檢索與生成；帶有 session_id 時改為修訂既有草稿
+        session_id = _get_body(event).get('session_id')
+        with telemetry.span('lambda_handler', cold_start=cold_start):
+            rephrased = None
+            if session_id:
+                response = _revise(session_id, prompt_question, deadline)
+                if response is None:
+                    return {
+                        'statusCode': 404,
+                        'body': json.dumps({
+                            'error': f'session {session_id} was not found or has expired'
+                        }, ensure_ascii=False)
+                    }
+            else:
+                prompt_question, metadata_filter, rephrased = _rephrase(event, prompt_question, deadline)
+                response = _ret_and_gen(retrieve_generate)(
+                    prompt_question=prompt_question,
+                    knowledge_base_id=knowledge_base_id,
+                    model_arn=model_arn,
+                    deadline=deadline,
+                    metadata_filter=metadata_filter,
+                    **_retrieval_kwargs(rephrased, ('split', 'sections'))
+                )
+                session_id = _start_session(prompt_question, response, knowledge_base_id, model_arn)
+
         # 提取生成的文字
-        generated_text = response['output']['text']
-        
+        result = {
+            'draft_text': response['output']['text']
+        }
+        if session_id:
+            result['session_id'] = session_id
+        if 'revision' in response:
+            result['revision'] = response['revision']
+        if rephrased is not None:
+            result['rephrase'] = rephrased
+        if 'semantic_cache' in response:
+            result['semantic_cache'] = response['semantic_cache']
+
         return {
             'statusCode': 200,
+            'body': json.dumps(result, ensure_ascii=False)
+        }
+
+    except DeadlineExceeded as e:
+        return {
+            'statusCode': 504,
             'body': json.dumps({
-                'draft_text': generated_text
+                'error': str(e)
             }, ensure_ascii=False)
         }
-        
+
     except Exception as e:
         return {
             'statusCode': 500,
             'body': json.dumps({
                 'error': str(e)
             }, ensure_ascii=False)
-        }
\ No newline at end of file
+        }
+
+
+def stream_lambda_handler(event, context):
+    """
+    串流版處理器：以 generator 逐行 yield NDJSON（UTF-8 bytes），
+    每行為 {"rephrase": ...}（要求重述時）、{"draft_delta": ...}、{"citation": ...} 或最後的 {"done": true}；
+    sections 模式另有 {"section": {"index", "heading", "text"}}，在每個段落完成時送出。
+    Python 受管 runtime 本身不支援 response streaming，需搭配 Lambda Web Adapter
+    或自訂 runtime 將 yield 出的內容寫入 Function URL (RESPONSE_STREAM) 的串流回應。
+    """
+    def _line(payload):
+        return (json.dumps(payload, ensure_ascii=False) + '\n').encode('utf-8')
+
+    if _is_warmup(event):
+        yield _line(json.loads(_warmup_response(context)['body']))
+        return
+
+    try:
+        deadline = Deadline.from_lambda_context(context)
+        retrieve_generate = _initialize()
+        _consume_cold_start()
+
+        knowledge_base_id = os.environ['KNOWLEDGE_BASE_ID']
+        model_arn = os.environ['MODEL_ARN']
+
+        prompt_question = _get_prompt_question(event)
+        if not prompt_question:
+            yield _line({'error': 'prompt_question is required'})
+            return
+
+        prompt_question, metadata_filter, rephrased = _rephrase(event, prompt_question, deadline)
+        if rephrased is not None:
+            yield _line({'rephrase': rephrased})
+
+        for chunk in _ret_and_gen_stream(retrieve_generate)(
+            prompt_question=prompt_question,
+            knowledge_base_id=knowledge_base_id,
+            model_arn=model_arn,
+            deadline=deadline,
+            metadata_filter=metadata_filter,
+            **_retrieval_kwargs(rephrased, ('sections',))
+        ):
+            if chunk['type'] == 'text':
+                yield _line({'draft_delta': chunk['text']})
+            elif chunk['type'] == 'citation':
+                yield _line({'citation': chunk['citation']})
+            elif chunk['type'] == 'section':
+                yield _line({'section': {key: chunk[key] for key in ('index', 'heading', 'text')}})
+
+        yield _line({'done': True})
+
+    except Exception as e:
+        yield _line({'error': str(e)})
+
+
+if LambdaConfig.INIT_ON_IMPORT:
+    # Lambda init 階段有額外的 CPU 配額且不計入第一個請求的延遲，提早完成初始化
+    _initialize()
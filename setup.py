@@ -18,6 +18,7 @@ setup(
     ],
     extras_require={
         "dev": ["mypy", "black"],
+        "local-index": ["numpy>=1.22"],
     },
     entry_points={
         "console_scripts": [
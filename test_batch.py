@@ -0,0 +1,47 @@
+import json
+
+from tools.batch import _truncate_partial_line, completed_ids, run_batch
+
+
+def _records(count):
+    return [{"id": str(index), "prompt": f"prompt {index}"} for index in range(count)]
+
+
+def test_resume_skips_completed_and_drops_partial_line(tmp_path):
+    """
+    中斷後續跑：已成功的 id 不重跑，寫到一半的最後一行被截掉，不會與續寫的第一筆接在同一行
+    """
+    output = tmp_path / "drafts.jsonl"
+    output.write_text(
+        json.dumps({"id": "0", "ok": True}) + "\n"
+        + json.dumps({"id": "1", "ok": False}) + "\n"
+        + '{"id": "2", "ok": tr',
+        encoding="utf-8",
+    )
+    assert completed_ids(str(output)) == {"0"}
+
+    summary = run_batch(_records(3), lambda prompt: {"text": prompt}, str(output), concurrency=2, resume=True)
+    assert summary["skipped"] == 1
+    assert summary["succeeded"] == 2
+
+    rows = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    assert [row["id"] for row in rows[:2]] == ["0", "1"]
+    assert sorted(row["id"] for row in rows[2:]) == ["1", "2"]
+    assert completed_ids(str(output)) == {"0", "1", "2"}
+
+
+def test_resume_truncates_partial_only_line(tmp_path):
+    output = tmp_path / "drafts.jsonl"
+    output.write_text('{"id": "0", "ok"', encoding="utf-8")
+    run_batch(_records(1), lambda prompt: {"text": prompt}, str(output), resume=True)
+    assert [json.loads(line)["id"] for line in output.read_text(encoding="utf-8").splitlines()] == ["0"]
+
+
+def test_truncate_partial_line_across_blocks(tmp_path):
+    output = tmp_path / "drafts.jsonl"
+    output.write_bytes("第一行\n寫到一半的第二行".encode("utf-8"))
+    _truncate_partial_line(output, block_size=4)
+    assert output.read_text(encoding="utf-8") == "第一行\n"
+    # 已以換行結尾時不變
+    _truncate_partial_line(output, block_size=4)
+    assert output.read_text(encoding="utf-8") == "第一行\n"
@@ -0,0 +1,91 @@
+from tools.cache import SQLiteStore, TTLCache, normalize_query
+
+
+def test_normalize_query():
+    assert normalize_query("  幫我生成ＳＡＳ   Viya 簽呈。") == "幫我生成sas viya 簽呈"
+    assert normalize_query("SAS Viya?") == normalize_query("sas viya")
+
+
+def test_ttl_cache_lru_eviction():
+    """
+    超過筆數上限時淘汰最久未使用的項目（get 會更新使用順序）
+    """
+    cache = TTLCache(max_entries=2, ttl_seconds=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    stats = cache.stats()
+    assert stats["evictions"] == 1 and stats["size"] == 2
+    assert stats["hits"] == 3 and stats["misses"] == 1
+
+
+def test_ttl_cache_expiry():
+    cache = TTLCache(max_entries=8, ttl_seconds=60)
+    cache.set("fresh", "ok")
+    cache.set("stale", "old", ttl_seconds=0)
+    assert cache.get("stale", "missing") == "missing"
+    assert cache.get("fresh") == "ok"
+    assert cache.stats()["expirations"] == 1
+    assert len(cache) == 1
+
+
+def test_ttl_cache_peek_returns_expired_entries():
+    cache = TTLCache(max_entries=8, ttl_seconds=60)
+    cache.set("stale", {"equals": {"key": "product_name", "value": "SAS"}}, ttl_seconds=0)
+    # peek 不計入統計，也不移除過期項目
+    assert cache.peek("stale") == {"equals": {"key": "product_name", "value": "SAS"}}
+    assert cache.peek("missing", "default") == "default"
+    assert cache.stats()["misses"] == 0
+    assert cache.get("stale") is None
+    assert cache.peek("stale") is None
+
+
+def test_ttl_cache_byte_budget():
+    """
+    指定 max_bytes 時依大小淘汰，單一項目大於上限時不寫入
+    """
+    cache = TTLCache(max_entries=100, ttl_seconds=60, max_bytes=10, sizeof=len)
+    cache.set("a", "12345")
+    cache.set("b", "12345")
+    cache.set("c", "123")
+    assert cache.get("a") is None
+    assert cache.get("b") == "12345" and cache.get("c") == "123"
+    cache.set("huge", "x" * 11)
+    assert cache.get("huge") is None
+    stats = cache.stats()
+    assert stats["rejected"] == 1 and stats["bytes"] == 8
+
+
+def test_ttl_cache_delete_where():
+    cache = TTLCache(max_entries=8, ttl_seconds=60)
+    for key in [("KB1", "q1"), ("KB1", "q2"), ("KB2", "q1")]:
+        cache.set(key, True)
+    assert cache.delete_where(lambda key: key[0] == "KB1") == 2
+    assert cache.get(("KB2", "q1")) is True
+    assert len(cache) == 1
+
+
+def test_sqlite_store_persists_across_instances(tmp_path):
+    path = str(tmp_path / "cache" / "filters.db")
+    store = SQLiteStore(path, ttl_seconds=60)
+    value = {"equals": {"key": "product_name", "value": "SAS Viya"}}
+    store.set("sas viya", value)
+    store.set("none", None)
+
+    reopened = SQLiteStore(path, ttl_seconds=60)
+    assert reopened.get("sas viya") == value
+    # None 也是有效的快取值（代表不需要 filter），與找不到不同
+    assert reopened.get("none", "missing") is None
+    assert reopened.get("unknown", "missing") == "missing"
+
+    reopened.clear()
+    assert store.get("sas viya") is None
+
+
+def test_sqlite_store_expiry(tmp_path):
+    store = SQLiteStore(str(tmp_path / "expired.db"), ttl_seconds=0)
+    store.set("key", "value")
+    assert store.get("key", "missing") == "missing"
@@ -0,0 +1,70 @@
+import pytest
+
+from tools.fanout import fuse_results, parse_knowledge_bases, retrieve_from_kbs
+
+
+def _result(text, uri, score):
+    return {
+        "content": {"text": text},
+        "location": {"type": "S3", "s3Location": {"uri": uri}},
+        "score": score,
+    }
+
+
+SHARED = _result("主旨：擬辦理 SAS 續約案。", "s3://kb/sas.md", 0.9)
+ONLY_A = _result("內文：合約期間一年。", "s3://kb/a.md", 0.8)
+ONLY_B = _result("審核流程：承辦人 → 科長。", "s3://kb/b.md", 0.95)
+
+
+def test_fuse_results_rrf():
+    """
+    reciprocal-rank fusion：兩個知識庫都排在前面的 chunk 分數最高，相同 chunk 只保留一筆
+    """
+    fused = fuse_results([
+        ("KB-A", [SHARED, ONLY_A]),
+        # 同一來源、只差空白的內容視為同一個 chunk
+        ("KB-B", [ONLY_B, dict(SHARED, content={"text": "主旨：擬辦理 SAS 續約案。 "})]),
+    ], "rrf", rrf_k=60)
+
+    assert [result["location"]["s3Location"]["uri"] for result in fused] == [
+        "s3://kb/sas.md", "s3://kb/b.md", "s3://kb/a.md"]
+    assert fused[0]["knowledgeBaseIds"] == ["KB-A", "KB-B"]
+    assert fused[0]["fusedScore"] == pytest.approx(1 / 61 + 1 / 62)
+    assert fused[1]["fusedScore"] == pytest.approx(1 / 61)
+    assert fused[2]["knowledgeBaseIds"] == ["KB-A"]
+    # 原本的結果不會被修改
+    assert "fusedScore" not in SHARED
+
+
+def test_fuse_results_score():
+    fused = fuse_results([
+        ("KB-A", [SHARED, ONLY_A]),
+        ("KB-B", [ONLY_B, _result("其他", "s3://kb/other.md", 0.15)]),
+    ], "score")
+    scores = {result["location"]["s3Location"]["uri"]: result["fusedScore"] for result in fused}
+    assert scores == {"s3://kb/sas.md": 1.0, "s3://kb/a.md": 0.0, "s3://kb/b.md": 1.0, "s3://kb/other.md": 0.0}
+
+
+def test_fuse_results_rejects_unknown_method():
+    with pytest.raises(ValueError):
+        fuse_results([("KB-A", [SHARED])], "borda")
+
+
+def test_parse_knowledge_bases():
+    assert parse_knowledge_bases("KB1, KB2@us-west-2,", region="us-east-1") == [
+        ("KB1", "us-east-1"), ("KB2", "us-west-2")]
+
+
+def test_retrieve_from_kbs(simulator):
+    """
+    以模擬器同時檢索兩個知識庫（內容相同），合併後每個 chunk 只出現一次並記錄兩個來源
+    """
+    response = retrieve_from_kbs("幫我生成 SAS Viya 雲端簽呈", ["KB-FAN-1", ("KB-FAN-2", "us-west-2")],
+                                 region="us-east-1", number_of_results=2, metadata_filter={}, fusion="rrf")
+
+    assert [status["status"] for status in response["knowledge_bases"]] == ["ok", "ok"]
+    assert [status["region"] for status in response["knowledge_bases"]] == ["us-east-1", "us-west-2"]
+    assert len(response["retrievalResults"]) == 2
+    for result in response["retrievalResults"]:
+        assert sorted(result["knowledgeBaseIds"]) == ["KB-FAN-1", "KB-FAN-2"]
+    assert response["retrievalResults"][0]["fusedScore"] >= response["retrievalResults"][1]["fusedScore"]
@@ -1,6 +1,6 @@
 import json
 import os
-from lambda_handler import lambda_handler
+from lambda_handler import _is_warmup, lambda_handler
 
 
 def test_lambda_local():
@@ -41,5 +41,24 @@ def test_lambda_local():
     print(json.dumps(result3, indent=2, ensure_ascii=False))
 
 
+
+def test_lambda_warmup():
+    """
+    預熱事件只會初始化 client，不呼叫 Bedrock
+    """
+    for event in ({'warmup': True}, {'source': 'serverless-plugin-warmup'}):
+        result = lambda_handler(event, {})
+        body = json.loads(result['body'])
+        print(json.dumps(body, indent=2, ensure_ascii=False))
+        assert result['statusCode'] == 200
+        assert body['warmed'] is True
+        assert body['import_ms'] is not None and body['init_ms'] is not None
+
+    # 沒有明確標記的 EventBridge 事件不能被當成預熱而略過
+    assert not _is_warmup({'source': 'aws.events', 'detail-type': 'Scheduled Event'})
+    assert not _is_warmup({'source': 'aws.events', 'detail-type': 'Object Created', 'warmup': 'yes'})
+
+
 if __name__ == "__main__":
-    test_lambda_local()
\ No newline at end of file
+    test_lambda_local()
+    test_lambda_warmup()
\ No newline at end of file
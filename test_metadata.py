@@ -0,0 +1,61 @@
+from tools.config import MetadataRuleConfig
+from tools.metadata import (
+    AMBIGUOUS,
+    MATCHED,
+    NO_MATCH,
+    RuleExtractor,
+    extract_metadata_filter,
+    matches_filter,
+)
+
+
+def test_rule_longest_match():
+    """
+    別名重疊時採最長比對，英數別名需以非英數字元為邊界
+    """
+    extractor = RuleExtractor()
+    assert extractor.extract("幫我生成 SAS Viya 雲端簽呈") == (
+        MATCHED, {"equals": {"key": "product_name", "value": "SAS Viya"}})
+    assert extractor.extract("幫我生成ＳＡＳ軟體採購簽呈") == (
+        MATCHED, {"equals": {"key": "product_name", "value": "SAS"}})
+    assert extractor.extract("IBM Data Stage 續約") == (
+        MATCHED, {"equals": {"key": "product_name", "value": "DataStage"}})
+    assert extractor.extract("SASE 資安服務採購") == (NO_MATCH, None)
+
+
+def test_rule_ambiguous_and_multiple_fields():
+    extractor = RuleExtractor([
+        {"key": "product_name", "values": {"SAS": ["SAS"], "DataStage": ["DataStage"]}},
+        {"key": "year", "type": "NUMBER", "pattern": r"(20\d{2})\s*年"},
+    ])
+    assert extractor.extract("SAS 與 DataStage 合併採購") == (AMBIGUOUS, None)
+    assert extractor.extract("2025 年 SAS 續約") == (MATCHED, {"andAll": [
+        {"equals": {"key": "product_name", "value": "SAS"}},
+        {"equals": {"key": "year", "value": 2025}},
+    ]})
+
+
+def test_extract_metadata_filter_no_match(monkeypatch):
+    """
+    沒有比對到任何規則時，預設交給 LLM（未決定）；關閉 fallback 則直接視為不需 filter
+    """
+    assert extract_metadata_filter("SAS Viya 授權") == (
+        True, {"equals": {"key": "product_name", "value": "SAS Viya"}})
+
+    monkeypatch.setattr(MetadataRuleConfig, "FALLBACK_ON_NO_MATCH", True)
+    assert extract_metadata_filter("請協助撰寫零信任架構簽呈") == (False, None)
+    monkeypatch.setattr(MetadataRuleConfig, "FALLBACK_ON_NO_MATCH", False)
+    assert extract_metadata_filter("請協助撰寫零信任架構簽呈") == (True, None)
+
+
+def test_matches_filter():
+    metadata = {"product_name": "SAS", "year": 2025}
+    assert matches_filter(None, metadata) is True
+    assert matches_filter({"equals": {"key": "product_name", "value": "SAS"}}, metadata) is True
+    assert matches_filter({"andAll": [
+        {"equals": {"key": "product_name", "value": "SAS"}},
+        {"greaterThan": {"key": "year", "value": 2025}},
+    ]}, metadata) is False
+    # 缺少欄位時否定運算與不支援的運算子都無法在本地判斷
+    assert matches_filter({"notEquals": {"key": "vendor", "value": "IBM"}}, metadata) is None
+    assert matches_filter({"vectorSimilarity": {"key": "product_name", "value": "S"}}, metadata) is None
@@ -0,0 +1,77 @@
+from tools.pipeline import dedupe_results, generate_from_results, pack_context
+from tools.text import estimate_tokens
+
+MODEL_ARN = "arn:aws:bedrock:us-east-1::foundation-model/amazon.nova-pro-v1:0"
+
+
+def _result(text, uri="s3://kb/doc.md", score=0.5):
+    return {
+        "content": {"text": text, "type": "TEXT"},
+        "location": {"type": "S3", "s3Location": {"uri": uri}},
+        "metadata": {},
+        "score": score,
+    }
+
+
+def test_dedupe_removes_duplicates_and_contained_chunks():
+    """
+    依排名保留 chunk：完全相同、只差空白標點，或被已保留 chunk 包含的段落都會被移除
+    """
+    first = _result("主旨：擬辦理 SAS Viya 雲端平台新約採購案，簽請核示。")
+    results = [
+        first,
+        _result("主旨：擬辦理SAS Viya雲端平台新約採購案，簽請核示", uri="s3://kb/copy.md"),
+        _result("擬辦理 SAS Viya 雲端平台新約採購案"),
+        _result("審核流程：承辦人 → 科長 → 資訊處處長 → 總經理。"),
+        _result(""),
+    ]
+    kept = dedupe_results(results)
+    assert [result["content"]["text"] for result in kept] == [
+        first["content"]["text"],
+        "審核流程：承辦人 → 科長 → 資訊處處長 → 總經理。",
+    ]
+    assert kept[0] is first
+
+
+def test_dedupe_keeps_partially_overlapping_chunks():
+    results = [
+        _result("本案為 SAS Viya 雲端訂閱，合約期間一年，費用由資訊處年度預算支應。"),
+        _result("本案為 DataStage 地端授權續約，合約期間三年，費用由營運處專案預算支應。"),
+    ]
+    assert len(dedupe_results(results)) == 2
+
+
+def test_pack_context_skips_chunks_that_do_not_fit():
+    """
+    依排名貪婪放入，放不下的略過並繼續嘗試後面較短的 chunk
+    """
+    long_chunk = _result("長" * 60)
+    short_chunk = _result("短" * 10)
+    medium_chunk = _result("中" * 35)
+    packed, used = pack_context([medium_chunk, long_chunk, short_chunk], budget_tokens=50)
+    assert packed == [medium_chunk, short_chunk]
+    assert used == 45 == sum(estimate_tokens(result["content"]["text"]) for result in packed)
+
+    assert pack_context([long_chunk], budget_tokens=10) == ([], 0)
+
+
+def test_generate_from_results_packs_within_budget(simulator):
+    results = [
+        _result("主旨：擬辦理 SAS 地端軟體續約案，簽請核示。", uri="s3://kb/a.md"),
+        _result("主旨：擬辦理 SAS 地端軟體續約案，簽請核示。", uri="s3://kb/b.md"),
+        _result("內文：" + "續約" * 100, uri="s3://kb/c.md"),
+        _result("審核流程：承辦人 → 科長 → 處長。", uri="s3://kb/d.md"),
+    ]
+    response = generate_from_results("幫我生成 SAS 續約簽呈", results, MODEL_ARN, token_budget=60)
+
+    assert response["output"]["text"]
+    assert response["packing"] == {
+        "candidates": 4,
+        "unique": 3,
+        "packed": 2,
+        "context_tokens": response["packing"]["context_tokens"],
+        "budget_tokens": 60,
+    }
+    assert response["packing"]["context_tokens"] <= 60
+    references = response["citations"][0]["retrievedReferences"]
+    assert [reference["location"]["s3Location"]["uri"] for reference in references] == ["s3://kb/a.md", "s3://kb/d.md"]
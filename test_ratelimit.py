@@ -0,0 +1,127 @@
+import random
+
+import pytest
+from botocore.exceptions import ClientError
+
+from tools import ratelimit
+from tools.config import DEFAULT_REGION, RateLimitConfig
+from tools.ratelimit import AimdLimiter, RegionRouter
+
+
+def _throttle():
+    return ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "InvokeModel")
+
+
+def test_aimd_additive_increase():
+    limiter = AimdLimiter(initial=4, minimum=1, maximum=5, decrease_factor=0.5, min_cooldown=0.0)
+    assert limiter.acquire(0)
+    limiter.release("ok", latency=0.1)
+    assert limiter.limit == pytest.approx(4.25)
+    for _ in range(20):
+        limiter.acquire(0)
+        limiter.release("ok", latency=0.1)
+    assert limiter.limit == 5
+    # 其他錯誤不調整上限
+    limiter.acquire(0)
+    limiter.release("error")
+    assert limiter.limit == 5 and limiter.in_flight == 0
+
+
+def test_aimd_decreases_once_per_round():
+    """
+    同一輪內的多次 throttling 只把上限乘上 decrease_factor 一次，且不低於下限
+    """
+    limiter = AimdLimiter(initial=8, minimum=3, maximum=16, decrease_factor=0.5, min_cooldown=60)
+    for _ in range(3):
+        assert limiter.acquire(0)
+    for _ in range(3):
+        limiter.release("throttled")
+    assert limiter.limit == 4
+
+    limiter = AimdLimiter(initial=4, minimum=3, maximum=16, decrease_factor=0.5, min_cooldown=0.0)
+    limiter.acquire(0)
+    limiter.release("throttled")
+    assert limiter.limit == 3
+
+
+def test_aimd_blocks_at_limit():
+    limiter = AimdLimiter(initial=2, minimum=1, maximum=4, decrease_factor=0.5, min_cooldown=0.0)
+    assert limiter.acquire(0) and limiter.acquire(0)
+    assert not limiter.acquire(0.01)
+    limiter.release("ok", latency=0.1)
+    assert limiter.acquire(0)
+
+
+def test_region_router_prefers_fast_healthy_region():
+    router = RegionRouter(["us-east-1", "us-west-2", "eu-central-1"])
+    router._random = random.Random(0)
+    for _ in range(30):
+        router.record("us-east-1", 50, throttled=False)
+        router.record("us-west-2", 500, throttled=False)
+        router.record("eu-central-1", 50, throttled=True)
+
+    choices = [router.choose() for _ in range(1000)]
+    assert choices.count("us-east-1") > 800
+    assert choices.count("eu-central-1") < choices.count("us-west-2")
+    assert router.choose(exclude=["us-east-1", "us-west-2"]) == "eu-central-1"
+    # 全部排除時仍從所有 region 中選擇
+    assert router.choose(exclude=["us-east-1", "us-west-2", "eu-central-1"]) in router.regions
+
+    stats = router.stats()
+    assert stats["us-east-1"]["latency_ms"] == 50
+    assert stats["eu-central-1"]["latency_ms"] is None
+    assert stats["eu-central-1"]["throttle_rate"] > 0.99
+
+
+def test_call_retries_throttling_in_another_region(monkeypatch):
+    """
+    throttling 時優先改試其他 region；呼叫端指定 region 或以 ARN 指定模型時不做路由
+    """
+    monkeypatch.setattr(RateLimitConfig, "REGIONS", ["us-east-1", "us-west-2"])
+    monkeypatch.setattr(RateLimitConfig, "ENABLED", True)
+    attempts = []
+
+    def _invoke(region):
+        attempts.append(region)
+        if len(attempts) == 1:
+            raise _throttle()
+        return region
+
+    attributes = {}
+    result = ratelimit.call("InvokeModel", "test.route-model", None, _invoke, attributes=attributes)
+    assert result == attempts[1] != attempts[0]
+    assert attributes == {"throttle_retries": 1, "region": result}
+    limiter_stats = ratelimit.stats()["limiters"]
+    assert limiter_stats[f"test.route-model/InvokeModel/{attempts[0]}"]["throttles"] == 1
+
+    assert ratelimit.call("InvokeModel", "test.route-model", "ap-northeast-1", lambda region: region) == \
+        "ap-northeast-1"
+    arn = "arn:aws:bedrock:us-east-1::foundation-model/amazon.nova-pro-v1:0"
+    assert ratelimit.call("Converse", arn, None, lambda region: region) == DEFAULT_REGION
+
+
+def test_call_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(RateLimitConfig, "REGIONS", [])
+    monkeypatch.setattr(RateLimitConfig, "ENABLED", True)
+    monkeypatch.setattr(RateLimitConfig, "MAX_THROTTLE_RETRIES", 2)
+    monkeypatch.setattr(RateLimitConfig, "BACKOFF_SECONDS", 0.001)
+    attempts = []
+
+    def _invoke(region):
+        attempts.append(region)
+        raise _throttle()
+
+    with pytest.raises(ClientError):
+        ratelimit.call("InvokeModel", "test.retry-model", None, _invoke)
+    assert len(attempts) == 3
+
+    # 非 throttling 的錯誤不重試
+    attempts.clear()
+
+    def _fail(region):
+        attempts.append(region)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        ratelimit.call("InvokeModel", "test.retry-model", None, _fail)
+    assert len(attempts) == 1
@@ -0,0 +1,59 @@
+from tools.rerank import bm25_scores, rerank_results
+from tools.retrieve import retrieve_from_kb
+
+
+def _result(text, score):
+    return {"content": {"text": text}, "location": {}, "score": score}
+
+
+def test_bm25_prefers_documents_with_query_terms():
+    scores = bm25_scores("DataStage 續約", ["SAS Viya 雲端訂閱", "DataStage 地端授權續約", "審核流程"])
+    assert scores[1] > scores[0] >= 0.0
+    assert scores[2] == 0.0
+    assert bm25_scores("", ["任何內容"]) == [0.0]
+
+
+def test_rerank_promotes_lexical_match():
+    """
+    語意分數接近時，提到查詢中產品名稱的候選排到前面；原本的 score 不變，另附 rerankScore
+    """
+    results = [
+        _result("SAS Viya 雲端平台新約採購", 0.82),
+        _result("審核流程：承辦人 → 科長 → 處長", 0.81),
+        _result("DataStage 地端授權續約，合約期間三年", 0.80),
+    ]
+    reranked = rerank_results("幫我生成 DataStage 續約簽呈", results, top_k=2, semantic_weight=0.3)
+
+    assert [result["content"]["text"] for result in reranked] == [
+        "DataStage 地端授權續約，合約期間三年",
+        "SAS Viya 雲端平台新約採購",
+    ]
+    assert reranked[0]["score"] == 0.80
+    assert reranked[0]["rerankScore"] > reranked[1]["rerankScore"]
+    # 輸入的候選不會被修改
+    assert all("rerankScore" not in result for result in results)
+
+
+def test_rerank_semantic_weight_and_ties():
+    results = [_result("相同內容", 0.9), _result("相同內容", 0.1)]
+    # 只看語意分數時維持原本順序
+    assert [result["score"] for result in rerank_results("其他", results, 2, semantic_weight=1.0)] == [0.9, 0.1]
+    # 分數完全相同時維持原本（向量搜尋）的順序
+    first, second = dict(_result("相同內容", 0.5), location={"uri": "first"}), _result("相同內容", 0.5)
+    tied = rerank_results("相同", [first, second], 2, semantic_weight=0.0)
+    assert tied[0]["location"] == {"uri": "first"}
+    assert tied[0]["rerankScore"] == tied[1]["rerankScore"] == 1.0
+    assert rerank_results("任何查詢", [], 3) == []
+
+
+def test_retrieve_with_rerank_keeps_top_k(simulator):
+    """
+    以模擬器檢索：rerank 開啟時先多取 fetch_k 筆候選，再保留 top-k 筆
+    """
+    response = retrieve_from_kb("DataStage 續約簽呈", "KB-RERANK", number_of_results=2, metadata_filter={},
+                                use_retrieval_cache=False, rerank=True, fetch_k=5)
+    results = response["retrievalResults"]
+    assert len(results) == 2
+    assert all("rerankScore" in result for result in results)
+    assert "DataStage" in results[0]["content"]["text"]
+    assert results[0]["rerankScore"] >= results[1]["rerankScore"]
@@ -0,0 +1,47 @@
+from tools import retrieve
+from tools.cache import TTLCache, normalize_query
+
+QUESTION = "請協助撰寫 DataStage 維護續約簽呈"
+DATASTAGE = {"equals": {"key": "product_name", "value": "DataStage"}}
+
+
+def _count_retrieves(monkeypatch):
+    calls = []
+    original = retrieve._retrieve
+
+    def _retrieve(client, question, knowledge_base_id, number_of_results, metadata_filter, *args):
+        calls.append(metadata_filter)
+        return original(client, question, knowledge_base_id, number_of_results, metadata_filter, *args)
+
+    monkeypatch.setattr(retrieve, "_retrieve", _retrieve)
+    monkeypatch.setattr(retrieve, "_filter_cache", TTLCache(max_entries=8, ttl_seconds=60))
+    return calls
+
+
+def test_speculative_retrieve_uses_stale_cached_filter(simulator, monkeypatch):
+    """
+    快取中的 filter 已過期時仍用來推測；模型產生的 filter 相同時直接採用，不再送出第二次 retrieve
+    """
+    calls = _count_retrieves(monkeypatch)
+    retrieve._filter_cache.set(normalize_query(QUESTION), DATASTAGE, ttl_seconds=0)
+
+    response = retrieve.retrieve_from_kb(QUESTION, "KB-SPECULATIVE", number_of_results=2, speculative=True,
+                                         use_retrieval_cache=False, use_rules=False)
+
+    assert response["speculation"]["outcome"] == "hit"
+    assert response["speculation"]["speculated_filter"] == DATASTAGE
+    assert response["speculation"]["metadata_filter"] == DATASTAGE
+    assert calls == [DATASTAGE]
+    assert len(response["retrievalResults"]) <= 2
+
+
+def test_speculative_retrieve_guesses_when_cache_disabled(simulator, monkeypatch):
+    # use_filter_cache=False 時不採用快取結果，但仍可拿來推測
+    calls = _count_retrieves(monkeypatch)
+    retrieve._filter_cache.set(normalize_query(QUESTION), DATASTAGE)
+
+    response = retrieve.retrieve_from_kb(QUESTION, "KB-SPECULATIVE", number_of_results=2, speculative=True,
+                                         use_filter_cache=False, use_retrieval_cache=False, use_rules=False)
+
+    assert response["speculation"]["outcome"] == "hit"
+    assert calls == [DATASTAGE]
@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from tools.local_index import embedder_from_name  # noqa: E402
+from tools.semantic_cache import SemanticDraftCache  # noqa: E402
+
+SCOPE = ("KB-SEMANTIC", "model", "us-east-1", 5, "")
+DRAFT = {"output": {"text": "簽呈草稿"}}
+
+
+def _cache():
+    return SemanticDraftCache(embedder_from_name("hashing-512"), threshold=0.85)
+
+
+def test_paraphrase_hits():
+    cache = _cache()
+    cache.store("幫我生成 SAS Viya 雲端簽呈", SCOPE, DRAFT)
+    hit = cache.lookup("我想申請：幫我生成 SAS Viya 雲端簽呈。", SCOPE)
+    assert hit is not None
+    assert hit["response"] == DRAFT
+    assert hit["similarity"] >= 0.85
+
+
+def test_product_or_deployment_change_misses():
+    """
+    只差產品名稱或雲端／地端時，即使相似度高於門檻也不可共用草稿
+    """
+    cache = _cache()
+    cache.store("幫我生成 SAS Viya 雲端簽呈", SCOPE, DRAFT)
+    assert cache.lookup("幫我生成 DataStage 雲端簽呈", SCOPE) is None
+    assert cache.lookup("幫我生成 SAS Viya 地端簽呈", SCOPE) is None
+    assert cache.lookup("幫我生成 2026 SAS Viya 雲端簽呈", SCOPE) is None
+    # 範圍不同（例如 filter 不同）也不共用
+    assert cache.lookup("幫我生成 SAS Viya 雲端簽呈", SCOPE[:4] + ("other-filter",)) is None
+
+
+def test_ret_and_gen_kb_path_does_not_share_drafts_across_products(simulator, monkeypatch):
+    """
+    預設的 kb 路徑先產生 filter 再查詢快取：不同產品的問題不會取得彼此的草稿
+    """
+    from tools import semantic_cache
+    from tools.retrieve_generate import ret_and_gen
+
+    monkeypatch.setattr(semantic_cache, "_cache", _cache())
+    model_arn = "arn:aws:bedrock:us-east-1::foundation-model/amazon.nova-pro-v1:0"
+    first = ret_and_gen("幫我生成 SAS Viya 雲端簽呈", "KB-SEMANTIC", model_arn, use_semantic_cache=True)
+    assert "semantic_cache" not in first
+    assert "semantic_cache" not in ret_and_gen("幫我生成 DataStage 雲端簽呈", "KB-SEMANTIC", model_arn,
+                                               use_semantic_cache=True)
+    hit = ret_and_gen("我想申請：幫我生成 SAS Viya 雲端簽呈。", "KB-SEMANTIC", model_arn, use_semantic_cache=True)
+    assert hit["semantic_cache"]["matched_prompt"] == "幫我生成 SAS Viya 雲端簽呈"
@@ -0,0 +1,69 @@
+import pytest
+
+from tools import session
+
+MODEL_ARN = "arn:aws:bedrock:us-east-1::foundation-model/amazon.nova-pro-v1:0"
+
+DRAFT = (
+    "簽呈草稿\n"
+    "一、【主旨】\n擬辦理 SAS 續約案，簽請核示。\n\n"
+    "二、【內文】\n合約期間一年，費用新台幣 120 萬元。\n\n"
+    "三、【建議附件】\n報價單。\n\n"
+    "四、【審核流程】\n承辦人 → 科長。"
+)
+
+
+def test_merge_revision_replaces_only_changed_sections():
+    """
+    模型只輸出修改的項目時，以標題取代草稿中對應的項目，其餘項目與開頭文字保持不變
+    """
+    merged = session.merge_revision(DRAFT, "二、【內文】\n合約期間三年，費用新台幣 300 萬元。")
+    assert merged == (
+        "簽呈草稿\n\n"
+        "一、【主旨】\n擬辦理 SAS 續約案，簽請核示。\n\n"
+        "二、【內文】\n合約期間三年，費用新台幣 300 萬元。\n\n"
+        "三、【建議附件】\n報價單。\n\n"
+        "四、【審核流程】\n承辦人 → 科長。"
+    )
+
+
+def test_merge_revision_without_numbering_and_new_section():
+    draft = "一、【主旨】\n擬辦理 SAS 續約案。\n\n二、【內文】\n合約期間一年。"
+    # 模型省略編號仍可對應；草稿原本沒有的項目接在最後
+    merged = session.merge_revision(draft, "【主旨】\n擬辦理 SAS Viya 續約案。\n\n四、【審核流程】\n承辦人 → 處長。")
+    assert session._split_sections(merged) == [
+        ("【主旨】", "【主旨】\n擬辦理 SAS Viya 續約案。"),
+        ("【內文】", "二、【內文】\n合約期間一年。"),
+        ("【審核流程】", "四、【審核流程】\n承辦人 → 處長。"),
+    ]
+
+
+def test_merge_revision_falls_back_to_full_text():
+    assert session.merge_revision(DRAFT, "  全新的草稿內容  ") == "全新的草稿內容"
+    assert session.merge_revision("沒有標題的草稿", "一、【主旨】\n新的主旨") == "一、【主旨】\n新的主旨"
+
+
+def test_revise_draft_keeps_references(simulator):
+    """
+    修訂只送出需求、草稿與指示：沿用第一次的引用來源，每次修訂遞增 revision
+    """
+    reference = {"content": {"text": "主旨：擬辦理 SAS 地端軟體續約案"}, "location": {"s3Location": {"uri": "s3://kb/a.md"}}}
+    response = {
+        "output": {"text": DRAFT},
+        "citations": [{"retrievedReferences": [reference]}, {"retrievedReferences": [reference]}],
+    }
+    session_id = session.start_session("幫我生成 SAS 續約簽呈", response, "KB-SESSION", MODEL_ARN)
+
+    revised = session.revise_draft(session_id, "把合約期間改成三年")
+    assert revised["sessionId"] == session_id
+    assert revised["revision"] == 1
+    assert revised["output"]["text"]
+    assert revised["citations"][0]["retrievedReferences"] == [reference]
+    assert session.get_session(session_id)["draft"] == revised["output"]["text"]
+
+    assert session.revise_draft(session_id, "再精簡一些")["revision"] == 2
+
+
+def test_revise_missing_session():
+    with pytest.raises(session.SessionNotFound):
+        session.revise_draft("does-not-exist", "修改主旨")
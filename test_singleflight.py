@@ -0,0 +1,204 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from tools import aio, retrieve_generate
+from tools.deadline import Deadline, DeadlineExceeded
+from tools.singleflight import SingleFlight
+
+MODEL_ARN = "arn:aws:bedrock:us-east-1::foundation-model/amazon.nova-pro-v1:0"
+
+
+def _run_concurrently(count, target):
+    results = [None] * count
+    errors = [None] * count
+
+    def _worker(index):
+        try:
+            results[index] = target(index)
+        except Exception as exc:
+            errors[index] = exc
+
+    threads = [threading.Thread(target=_worker, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results, errors
+
+
+def _wait_for_followers(group, count):
+    # 等待者加入後 coalesced 才會增加
+    for _ in range(500):
+        if group.stats()["coalesced"] >= count:
+            return
+        time.sleep(0.001)
+
+
+def test_followers_share_one_call():
+    """
+    相同 key 的並行呼叫只執行一次，等待者拿到獨立的複本
+    """
+    group = SingleFlight("test-share")
+    release = threading.Event()
+    executions = []
+
+    def _work():
+        executions.append(1)
+        release.wait(5)
+        return {"value": 42}
+
+    def _call(index):
+        if index:
+            # leader 已開始執行後才加入
+            while not executions:
+                time.sleep(0.001)
+        return group.do("key", _work)
+
+    threading.Thread(target=lambda: (_wait_for_followers(group, 3), release.set())).start()
+    results, errors = _run_concurrently(4, _call)
+
+    assert errors == [None] * 4
+    assert len(executions) == 1
+    assert [coalesced for _, coalesced in results] == [False, True, True, True]
+    assert all(result == {"value": 42} for result, _ in results)
+    results[1][0]["value"] = 0
+    assert results[2][0]["value"] == 42
+    stats = group.stats()
+    assert stats["calls"] == 1 and stats["coalesced"] == 3 and stats["in_flight"] == 0
+
+
+def test_leader_error_is_shared():
+    group = SingleFlight("test-error")
+    started = threading.Event()
+
+    def _fail():
+        started.set()
+        _wait_for_followers(group, 1)
+        raise ValueError("boom")
+
+    def _call(index):
+        if index:
+            started.wait(5)
+            return group.do("key", lambda: "not used")
+        return group.do("key", _fail)
+
+    _, errors = _run_concurrently(2, _call)
+    assert all(isinstance(error, ValueError) for error in errors)
+    assert group.stats()["errors"] == 1
+
+
+def test_leader_deadline_is_not_shared():
+    """
+    leader 因自己的 deadline 到期而失敗時，等待者以自己的 func 與 deadline 重新執行
+    """
+    group = SingleFlight("test-deadline")
+    started = threading.Event()
+
+    def _leader_work():
+        started.set()
+        _wait_for_followers(group, 1)
+        raise DeadlineExceeded("leader deadline")
+
+    def _call(index):
+        if index:
+            started.wait(5)
+            return group.do("key", lambda: "follower result", Deadline(5))
+        return group.do("key", _leader_work, Deadline(0.5))
+
+    results, errors = _run_concurrently(2, _call)
+    assert isinstance(errors[0], DeadlineExceeded)
+    assert errors[1] is None
+    assert results[1] == ("follower result", False)
+
+
+def test_follower_gives_up_at_own_deadline():
+    group = SingleFlight("test-abandon")
+    release = threading.Event()
+    leader = threading.Thread(target=lambda: group.do("key", lambda: release.wait(5)))
+    leader.start()
+    while not group.stats()["in_flight"]:
+        time.sleep(0.001)
+
+    with pytest.raises(DeadlineExceeded):
+        group.do("key", lambda: None, Deadline(0.05))
+    release.set()
+    leader.join(5)
+    assert group.stats()["abandoned"] == 1
+
+
+def test_do_async_coalesces_and_survives_cancellation():
+    group = SingleFlight("test-async")
+    executions = []
+
+    async def _work():
+        executions.append(1)
+        await asyncio.sleep(0.05)
+        return {"draft": "ok"}
+
+    async def _main():
+        leader = asyncio.ensure_future(group.do_async("key", _work))
+        await asyncio.sleep(0)
+        followers = [asyncio.ensure_future(group.do_async("key", _work)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        # leader 被取消不會取消共用的呼叫
+        leader.cancel()
+        return await asyncio.gather(*followers)
+
+    results = asyncio.run(_main())
+    assert len(executions) == 1
+    assert results == [({"draft": "ok"}, True)] * 3
+
+
+def test_ret_and_gen_coalesces_identical_requests(simulator):
+    """
+    以模擬器同時送出相同的草稿請求：只呼叫一次 RetrieveAndGenerate，其餘回應標記為 coalesced
+    """
+    before = retrieve_generate._flight.stats()
+    barrier = threading.Barrier(4)
+
+    def _call(_):
+        barrier.wait(5)
+        return retrieve_generate.ret_and_gen("幫我生成 DataStage 續約簽呈", "KB-SF", MODEL_ARN,
+                                             use_semantic_cache=False)
+
+    results, errors = _run_concurrently(4, _call)
+    after = retrieve_generate._flight.stats()
+
+    assert errors == [None] * 4
+    assert len({result["output"]["text"] for result in results}) == 1
+    assert sum(1 for result in results if result.get("coalesced")) == 3
+    assert after["calls"] - before["calls"] == 1
+
+
+def test_aio_ret_and_gen_waiters_do_not_hold_threads(simulator, monkeypatch):
+    """
+    async 版本在 event loop 上合併：thread pool 只有一個 thread 時，20 個相同請求仍只呼叫一次 RetrieveAndGenerate
+    """
+    executions = []
+    original = retrieve_generate._ret_and_gen
+
+    def _ret_and_gen(*args):
+        executions.append(args[0])
+        return original(*args)
+
+    monkeypatch.setattr(retrieve_generate, "_ret_and_gen", _ret_and_gen)
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(aio, "_executor", executor)
+
+    async def _main():
+        return await asyncio.gather(*[
+            aio.ret_and_gen("幫我生成 SAS 續約簽呈", "KB-AIO-SF", MODEL_ARN, use_semantic_cache=False, timeout=5)
+            for _ in range(20)
+        ])
+
+    try:
+        results = asyncio.run(_main())
+    finally:
+        executor.shutdown()
+    assert len(executions) == 1
+    assert len({result["output"]["text"] for result in results}) == 1
+    assert sum(1 for result in results if result.get("coalesced")) == 19
@@ -0,0 +1,25 @@
+from tools.stats import latency_summary, percentile
+
+
+def test_percentile_nearest_rank():
+    """
+    最近排名法：第 ceil(fraction * n) 個值
+    """
+    assert percentile([], 0.5) == 0.0
+    assert percentile([1, 2], 0.5) == 1
+    assert percentile(list(range(1, 11)), 0.5) == 5
+    assert percentile(list(range(1, 11)), 0.7) == 7
+    assert percentile(list(range(1, 21)), 0.95) == 19
+    assert percentile(list(range(1, 101)), 0.99) == 99
+    assert percentile([3], 0.99) == 3
+    assert percentile([1, 2, 3], 0.0) == 1
+    assert percentile([1, 2, 3], 1.0) == 3
+
+
+def test_latency_summary():
+    summary = latency_summary([40.0, 10.0, 30.0, 20.0])
+    assert summary["count"] == 4
+    assert summary["mean_ms"] == 25.0
+    assert summary["p50_ms"] == 20.0
+    assert summary["max_ms"] == 40.0
+    assert latency_summary([]) == {"count": 0}
@@ -1,9 +1,29 @@
 """AWS Bedrock Knowledge Base helper package."""
 
 __all__ = [
+    "aio",
+    "batch",
+    "bedrock",
+    "bench",
+    "cache",
+    "clients",
     "config",
+    "deadline",
+    "fanout",
+    "fused",
+    "local_index",
     "metadata",
+    "pipeline",
+    "ratelimit",
     "rephrase",
     "retrieve",
-    "retrieve_generate"
+    "retrieve_generate",
+    "sections",
+    "semantic_cache",
+    "server",
+    "session",
+    "simulator",
+    "stats",
+    "telemetry",
+    "text"
 ]
@@ -0,0 +1,194 @@
+import asyncio
+import functools
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from tools import rephrase as _rephrase
+from tools import retrieve as _retrieve
+from tools import retrieve_generate as _retrieve_generate
+from tools import semantic_cache as _semantic_cache
+from tools.cache import normalize_query
+from tools.config import AsyncConfig, RetrieveConfig, RetrieveGenerateConfig, SemanticCacheConfig
+from tools.deadline import Deadline
+from tools.singleflight import SingleFlight, make_key
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=AsyncConfig.MAX_CONCURRENCY,
+                                               thread_name_prefix="kb-aio")
+    return _executor
+
+
+def _get_semaphore(loop: asyncio.AbstractEventLoop) -> asyncio.Semaphore:
+    # asyncio.Semaphore 綁定建立時的 event loop，因此每個 loop 各自一個
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(AsyncConfig.MAX_CONCURRENCY)
+        _semaphores[loop] = semaphore
+    return semaphore
+
+
+async def _run(func: Callable[..., Any], *args: Any, timeout: Optional[float] = None, **kwargs: Any) -> Any:
+    """
+    在共用的有界 thread pool 上執行同步的 Bedrock 呼叫。
+    逾時或被取消時，呼叫端會立即收到 TimeoutError / CancelledError，
+    背景執行緒則在 botocore 回應後自行結束並釋放連線。
+    """
+    loop = asyncio.get_running_loop()
+    timeout = AsyncConfig.DEFAULT_TIMEOUT if timeout is None else timeout
+    async with _get_semaphore(loop):
+        future = loop.run_in_executor(_get_executor(), functools.partial(func, *args, **kwargs))
+        return await asyncio.wait_for(future, timeout)
+
+
+async def _coalesced(group: SingleFlight, key: str, func: Callable[..., Any], *args: Any,
+                     timeout: Optional[float] = None, **kwargs: Any) -> Any:
+    """
+    以 single-flight 合併相同 key 的並行呼叫，等待者不佔用 thread。
+    共用的呼叫使用 leader 的 timeout 與 deadline；每個呼叫端另以自己的 timeout 等待，
+    逾時或被取消只會影響該呼叫端。
+    """
+    result, coalesced = await asyncio.wait_for(
+        group.do_async(key, lambda: _run(func, *args, timeout=timeout, **kwargs)), timeout)
+    if coalesced and isinstance(result, dict):
+        result["coalesced"] = True
+    return result
+
+
+def _timeout(timeout: Optional[float], deadline: Optional[Deadline]) -> Optional[float]:
+    # 未指定 timeout 時，以 deadline 的剩餘時間作為等待上限
+    if timeout is None and deadline is not None:
+        return deadline.remaining()
+    return timeout
+
+
+async def rephrase_question(question: str,
+                            region: Optional[str] = None,
+                            timeout: Optional[float] = None,
+                            deadline: Optional[Deadline] = None) -> str:
+    """tools.rephrase.rephrase_question 的 async 版本。"""
+    return await _run(_rephrase.rephrase_question, question, region, deadline=deadline,
+                      timeout=_timeout(timeout, deadline))
+
+
+async def generate_metadata_filter(question: str,
+                                   use_cache: bool = True,
+                                   use_rules: bool = True,
+                                   timeout: Optional[float] = None,
+                                   deadline: Optional[Deadline] = None) -> Optional[dict]:
+    """tools.retrieve.generate_metadata_filter 的 async 版本；規則或快取命中時不佔用 thread。"""
+    found, metadata_filter = _retrieve.lookup_local_filter(question, use_cache=use_cache, use_rules=use_rules)
+    if found:
+        return metadata_filter
+    result, _ = await asyncio.wait_for(_retrieve._filter_flight.do_async(
+        make_key(normalize_query(question), use_cache, use_rules),
+        lambda: _run(_retrieve.generate_metadata_filter, question, use_cache, use_rules, deadline=deadline,
+                     timeout=_timeout(timeout, deadline)),
+    ), _timeout(timeout, deadline))
+    return result
+
+
+async def retrieve_from_kb(question: str,
+                           knowledge_base_id: str,
+                           region: str = RetrieveConfig.REGION,
+                           number_of_results: Optional[int] = None,
+                           metadata_filter: Optional[dict] = None,
+                           use_filter_cache: bool = True,
+                           speculative: Optional[bool] = None,
+                           timeout: Optional[float] = None,
+                           deadline: Optional[Deadline] = None,
+                           use_retrieval_cache: bool = True,
+                           backend: Optional[str] = None,
+                           rerank: Optional[bool] = None,
+                           fetch_k: Optional[int] = None,
+                           use_rules: bool = True) -> dict:
+    """tools.retrieve.retrieve_from_kb 的 async 版本；相同參數的並行呼叫會合併為一次。"""
+    key = _retrieve._retrieve_flight_key(question, knowledge_base_id, region, number_of_results, metadata_filter,
+                                         use_filter_cache, speculative, use_retrieval_cache, backend, rerank,
+                                         fetch_k, use_rules)
+    return await _coalesced(
+        _retrieve._retrieve_flight,
+        key,
+        _retrieve.retrieve_from_kb,
+        question,
+        knowledge_base_id,
+        region=region,
+        number_of_results=number_of_results,
+        metadata_filter=metadata_filter,
+        use_filter_cache=use_filter_cache,
+        speculative=speculative,
+        deadline=deadline,
+        use_retrieval_cache=use_retrieval_cache,
+        backend=backend,
+        rerank=rerank,
+        fetch_k=fetch_k,
+        use_rules=use_rules,
+        timeout=_timeout(timeout, deadline),
+    )
+
+
+async def ret_and_gen(prompt_question: str,
+                      knowledge_base_id: str,
+                      model_arn: str,
+                      region: str = RetrieveGenerateConfig.REGION,
+                      number_of_results: Optional[int] = None,
+                      timeout: Optional[float] = None,
+                      deadline: Optional[Deadline] = None,
+                      metadata_filter: Optional[dict] = None,
+                      use_semantic_cache: Optional[bool] = None) -> dict:
+    """
+    tools.retrieve_generate.ret_and_gen 的 async 版本；相同參數的並行呼叫以 single-flight 合併為一次，
+    等待者不佔用 thread（與執行緒中的同步呼叫分開合併）。
+    開啟語意快取時與同步版本相同：未指定 metadata_filter 時先產生 filter，再查詢快取。
+    """
+    if SemanticCacheConfig.ENABLED if use_semantic_cache is None else use_semantic_cache:
+        if metadata_filter is None:
+            metadata_filter = await generate_metadata_filter(prompt_question, timeout=timeout, deadline=deadline) or {}
+        # 查詢與寫入都需要計算 embedding（bedrock embedder 會呼叫 API），因此放在 thread pool 執行
+        cache_args = (prompt_question, knowledge_base_id, model_arn, region, number_of_results, metadata_filter)
+        cached = await _run(_semantic_cache.lookup_draft, *cache_args, timeout=_timeout(timeout, deadline))
+        if cached is not None:
+            return cached
+        response = await _coalesced_ret_and_gen(prompt_question, knowledge_base_id, model_arn, region,
+                                                number_of_results, timeout, deadline, metadata_filter)
+        await _run(_semantic_cache.store_draft, response, *cache_args, timeout=_timeout(timeout, deadline))
+        return response
+    return await _coalesced_ret_and_gen(prompt_question, knowledge_base_id, model_arn, region, number_of_results,
+                                        timeout, deadline, metadata_filter)
+
+
+async def _coalesced_ret_and_gen(prompt_question: str,
+                                 knowledge_base_id: str,
+                                 model_arn: str,
+                                 region: str,
+                                 number_of_results: Optional[int],
+                                 timeout: Optional[float],
+                                 deadline: Optional[Deadline],
+                                 metadata_filter: Optional[dict]) -> dict:
+    # leader 直接呼叫未合併的 _ret_and_gen，避免在 thread 中再經過一次同步的 single-flight
+    key = _retrieve_generate._flight_key(prompt_question, knowledge_base_id, model_arn, region, number_of_results,
+                                         metadata_filter)
+    return await _coalesced(
+        _retrieve_generate._flight,
+        key,
+        _retrieve_generate._ret_and_gen,
+        prompt_question,
+        knowledge_base_id,
+        model_arn,
+        region,
+        number_of_results,
+        deadline,
+        metadata_filter,
+        timeout=_timeout(timeout, deadline),
+    )
@@ -0,0 +1,141 @@
+import csv
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from tools.stats import latency_summary
+
+
+def load_prompts(path: str, prompt_field: str = "prompt", id_field: str = "id") -> List[Dict[str, str]]:
+    """
+    讀取 JSONL 或 CSV（依副檔名判斷）中的 prompt，回傳 [{"id": ..., "prompt": ...}]。
+    缺少 id 欄位時以行號作為 id。
+    """
+    source = Path(path)
+    with source.open(encoding="utf-8", newline="") as handle:
+        if source.suffix.lower() == ".csv":
+            rows: Iterable[Dict[str, Any]] = list(csv.DictReader(handle))
+        else:
+            rows = [json.loads(line) for line in handle if line.strip()]
+
+    records = []
+    for index, row in enumerate(rows):
+        prompt = row.get(prompt_field)
+        if not prompt:
+            raise ValueError(f"Row {index} in {path} has no '{prompt_field}' field.")
+        record_id = row.get(id_field)
+        records.append({"id": str(index if record_id in (None, "") else record_id), "prompt": prompt})
+    return records
+
+
+def completed_ids(output_path: str) -> Set[str]:
+    """讀取既有輸出檔，回傳已成功完成的 id，供中斷後續跑使用。"""
+    path = Path(output_path)
+    if not path.exists():
+        return set()
+    done = set()
+    with path.open(encoding="utf-8") as handle:
+        for line in handle:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                # 中斷時可能留下寫到一半的最後一行
+                continue
+            if row.get("ok"):
+                done.add(str(row.get("id")))
+    return done
+
+
+def _truncate_partial_line(path: Path, block_size: int = 64 * 1024) -> None:
+    """中斷時最後一行可能只寫了一半：從檔尾往前找到最後一個換行並截掉之後的內容，續寫時才不會與下一筆接在同一行。"""
+    if not path.exists():
+        return
+    with path.open("rb+") as handle:
+        end = handle.seek(0, 2)
+        position = end
+        while position > 0:
+            start = max(0, position - block_size)
+            handle.seek(start)
+            block = handle.read(position - start)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position != end:
+            handle.truncate(position)
+
+
+def run_batch(records: List[Dict[str, str]],
+              operation: Callable[[str], Dict[str, Any]],
+              output_path: str,
+              concurrency: int = 8,
+              resume: bool = False,
+              on_result: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """
+    以有界的 thread pool 對每筆 prompt 執行 operation，完成一筆就寫入一行 JSONL。
+    resume=True 時會略過輸出檔中已成功的 id，先截掉寫到一半的最後一行，再以附加模式續寫。
+    """
+    done = completed_ids(output_path) if resume else set()
+    pending = [record for record in records if record["id"] not in done]
+
+    path = Path(output_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if resume:
+        _truncate_partial_line(path)
+    latencies: List[float] = []
+    failures = 0
+
+    def _execute(record: Dict[str, str]) -> Dict[str, Any]:
+        started = time.perf_counter()
+        row: Dict[str, Any] = {"id": record["id"], "prompt": record["prompt"]}
+        try:
+            row["result"] = operation(record["prompt"])
+            row["ok"] = True
+        except Exception as exc:  # 單筆失敗不影響整批，錯誤記錄在輸出中
+            row["error"] = f"{type(exc).__name__}: {exc}"
+            row["ok"] = False
+        row["latency_ms"] = (time.perf_counter() - started) * 1000
+        return row
+
+    started = time.perf_counter()
+    with path.open("a" if resume else "w", encoding="utf-8") as output, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="kb-batch") as executor:
+        queue = iter(pending)
+        in_flight: Set["Future[Dict[str, Any]]"] = set()
+        # 只保留固定數量的在途工作，避免一次送出數千個 future
+        window = concurrency * 2
+        while True:
+            while len(in_flight) < window:
+                record = next(queue, None)
+                if record is None:
+                    break
+                in_flight.add(executor.submit(_execute, record))
+            if not in_flight:
+                break
+            finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                row = future.result()
+                # 每筆寫入後立即 flush，輸出檔本身即為續跑用的 checkpoint
+                output.write(json.dumps(row, ensure_ascii=False) + "\n")
+                output.flush()
+                latencies.append(row["latency_ms"])
+                if not row["ok"]:
+                    failures += 1
+                if on_result is not None:
+                    on_result(row)
+
+    elapsed = time.perf_counter() - started
+    return {
+        "total": len(records),
+        "skipped": len(records) - len(pending),
+        "processed": len(pending),
+        "succeeded": len(pending) - failures,
+        "failed": failures,
+        "concurrency": concurrency,
+        "elapsed_s": elapsed,
+        "throughput_per_s": len(pending) / elapsed if elapsed > 0 else 0.0,
+        "latency": latency_summary(latencies),
+    }
@@ -0,0 +1,195 @@
+import json
+import threading
+from typing import Any, Dict, List, Optional
+
+from tools import ratelimit, telemetry
+from tools.clients import ClientOptions, get_client
+from tools.config import PromptCacheConfig
+from tools.deadline import Deadline
+
+
+# 每個執行緒最後一次模型呼叫的 usage，讓只回傳文字的函式（例如 rephrase_question）也能取得 token 數
+_local = threading.local()
+
+
+def cache_point() -> Dict[str, Any]:
+    return {"cachePoint": {"type": "default"}}
+
+
+def build_messages_body(system_prompt: str,
+                        user_text: str,
+                        inference_config: Dict[str, Any],
+                        user_prefix: str = "",
+                        system_suffix: str = "",
+                        cache: Optional[bool] = None) -> Dict[str, Any]:
+    """
+    組出 Nova 的 messages request body，並在固定不變的前綴後加入 prompt cache checkpoint。
+    固定前綴依序為 system_prompt、user_prefix；system_suffix 與 user_text 為每次呼叫會變動的部分。
+    cache 為 None 時依 PromptCacheConfig.ENABLED 決定。
+    """
+    cache = PromptCacheConfig.ENABLED if cache is None else cache
+
+    system: List[Dict[str, Any]] = [{"text": system_prompt}]
+    if cache and not user_prefix:
+        system.append(cache_point())
+    if system_suffix:
+        system.append({"text": system_suffix})
+
+    content: List[Dict[str, Any]] = []
+    if user_prefix:
+        content.append({"text": user_prefix})
+        if cache:
+            content.append(cache_point())
+    content.append({"text": user_text})
+
+    return {
+        "system": system,
+        "messages": [{"role": "user", "content": content}],
+        "inferenceConfig": inference_config,
+    }
+
+
+def parse_json_response(raw_text: str) -> Any:
+    """
+    解析模型輸出的 JSON，容許前後空白與 Markdown fenced code block（```json ... ```）。
+    無法解析時回傳 None。
+    """
+    raw_text = raw_text.strip()
+    if raw_text.startswith("```"):
+        # Remove Markdown-style fenced code blocks to keep the JSON valid.
+        if raw_text.startswith("```json"):
+            raw_text = raw_text[len("```json"):].lstrip()
+        else:
+            raw_text = raw_text[3:].lstrip()
+        if raw_text.endswith("```"):
+            raw_text = raw_text[:-3].rstrip()
+    if not raw_text:
+        return None
+    try:
+        return json.loads(raw_text)
+    except json.JSONDecodeError:
+        return None
+
+
+def usage_summary(usage: Optional[Dict[str, Any]]) -> Dict[str, int]:
+    """將 Nova usage 轉成 input/output 與 prompt cache 讀寫 token 數（缺少的欄位為 0）。"""
+    usage = usage or {}
+    return {
+        "input_tokens": usage.get("inputTokens", 0),
+        "output_tokens": usage.get("outputTokens", 0),
+        "cache_read_input_tokens": usage.get("cacheReadInputTokenCount", 0),
+        "cache_write_input_tokens": usage.get("cacheWriteInputTokenCount", 0),
+    }
+
+
+def record_usage(attributes: Dict[str, Any], usage: Optional[Dict[str, Any]]) -> None:
+    """寫入 telemetry span 屬性，並保存為此執行緒的 last_usage()。"""
+    telemetry.record_usage(attributes, usage)
+    _local.usage = usage_summary(usage)
+
+
+def last_usage() -> Optional[Dict[str, int]]:
+    """回傳此執行緒最後一次經由本模組呼叫模型的 usage（含 prompt cache 讀寫 token 數）。"""
+    return getattr(_local, "usage", None)
+
+
+def invoke(client: Any, model_id: str, body: Dict[str, Any], attributes: Dict[str, Any]) -> Dict[str, Any]:
+    """以 invoke_model 送出 body，回傳解析後的回應 body，並記錄 usage。"""
+    response = client.invoke_model(
+        modelId=model_id,
+        contentType="application/json",
+        accept="application/json",
+        body=json.dumps(body),
+    )
+    resp_body = json.loads(response["body"].read().decode("utf-8"))
+    record_usage(attributes, resp_body.get("usage"))
+    return resp_body
+
+
+def invoke_model(model_id: str,
+                 body: Dict[str, Any],
+                 attributes: Dict[str, Any],
+                 region: Optional[str],
+                 client_options: Optional[ClientOptions] = None,
+                 deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+    """
+    經由 tools.ratelimit 呼叫 invoke()：開啟流量控制時 throttling 會降低並行上限並在 deadline 內退避重試；
+    region 為 None 且設定 BEDROCK_REGIONS 時依延遲與 throttling 比例選擇 region。
+    """
+    def _call(chosen_region: str) -> Dict[str, Any]:
+        client = get_client("bedrock-runtime", chosen_region, client_options)
+        return invoke(client, model_id, body, attributes)
+
+    return ratelimit.call("InvokeModel", model_id, region, _call, deadline, attributes)
+
+
+_CONVERSE_INFERENCE_KEYS = {"max_new_tokens": "maxTokens", "temperature": "temperature", "top_p": "topP",
+                            "stopSequences": "stopSequences"}
+_CONVERSE_USAGE_KEYS = {"cacheReadInputTokens": "cacheReadInputTokenCount",
+                        "cacheWriteInputTokens": "cacheWriteInputTokenCount"}
+
+
+def converse_request(model_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    將 build_messages_body() 的 body 轉成 Converse API 的參數：inferenceConfig 改用 Converse 的欄位名稱，
+    模型不支援 prompt cache（PromptCacheConfig.supports）時移除 cachePoint。
+    """
+    keep_cache = PromptCacheConfig.supports(model_id)
+
+    def _blocks(blocks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return [block for block in blocks if keep_cache or "cachePoint" not in block]
+
+    request: Dict[str, Any] = {
+        "messages": [dict(message, content=_blocks(message["content"])) for message in body["messages"]],
+        "inferenceConfig": {_CONVERSE_INFERENCE_KEYS[key]: value
+                            for key, value in body.get("inferenceConfig", {}).items()
+                            if key in _CONVERSE_INFERENCE_KEYS},
+    }
+    if body.get("system"):
+        request["system"] = _blocks(body["system"])
+    return request
+
+
+def converse(model_id: str,
+             body: Dict[str, Any],
+             attributes: Dict[str, Any],
+             region: Optional[str],
+             client_options: Optional[ClientOptions] = None,
+             deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+    """
+    以 Converse API 送出 build_messages_body() 的 body，適用於任何支援 Converse 的模型（Nova、Claude 等），
+    供使用者設定的 MODEL_ARN 生成草稿。回傳與 invoke() 相同格式的 output / usage / stopReason；
+    流量控制與 region 選擇同 invoke_model()。
+    """
+    request = converse_request(model_id, body)
+
+    def _call(chosen_region: str) -> Dict[str, Any]:
+        client = get_client("bedrock-runtime", chosen_region, client_options)
+        return client.converse(modelId=model_id, **request)
+
+    response = ratelimit.call("Converse", model_id, region, _call, deadline, attributes)
+    usage = {_CONVERSE_USAGE_KEYS.get(key, key): value for key, value in (response.get("usage") or {}).items()}
+    record_usage(attributes, usage)
+    return {"output": response["output"], "usage": usage, "stopReason": response.get("stopReason")}
+
+
+def invoke_model_stream(model_id: str,
+                        body: Dict[str, Any],
+                        attributes: Dict[str, Any],
+                        region: Optional[str],
+                        client_options: Optional[ClientOptions] = None,
+                        deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+    """
+    以 invoke_model_with_response_stream 開始串流，回傳含事件串流的 response。
+    流量控制只涵蓋建立串流的呼叫（throttling 會在此時發生），不包含之後讀取事件的時間。
+    """
+    def _call(chosen_region: str) -> Dict[str, Any]:
+        client = get_client("bedrock-runtime", chosen_region, client_options)
+        return client.invoke_model_with_response_stream(
+            modelId=model_id,
+            contentType="application/json",
+            accept="application/json",
+            body=json.dumps(body),
+        )
+
+    return ratelimit.call("InvokeModelWithResponseStream", model_id, region, _call, deadline, attributes)
@@ -0,0 +1,208 @@
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+try:
+    import resource
+except ImportError:  # Windows 沒有 resource 模組
+    resource = None
+
+from tools.config import SingleFlightConfig
+from tools.rephrase import rephrase_question
+from tools.retrieve import generate_metadata_filter, retrieve_from_kb
+from tools.retrieve_generate import ret_and_gen
+from tools.stats import latency_summary
+
+
+DEFAULT_PROMPTS = [
+    "幫我生成SAS軟體採購簽呈",
+    "幫我生成2025 SAS Viya雲端簽呈。",
+    "幫我生成SAS地端簽呈，這份簽呈屬於軟體續約，軟體類別為SAS",
+    "請協助撰寫 DataStage 維護續約簽呈",
+]
+
+STAGES = ("rephrase", "metadata_filter", "retrieve", "generate")
+
+
+class _StageTimer:
+    def __init__(self) -> None:
+        self.timings: Dict[str, float] = {}
+
+    def run(self, stage: str, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.timings[stage] = (time.perf_counter() - started) * 1000
+
+
+def run_pipeline_once(prompt: str,
+                      knowledge_base_id: str,
+                      model_arn: str,
+                      use_llm_filter: bool = True) -> Dict[str, float]:
+    """
+    依序執行 rephrase → metadata filter → retrieve → generate，回傳各階段耗時（毫秒）。
+    use_llm_filter=True 時略過規則與快取，量測模型產生 filter 的實際成本。
+    retrieve 不使用檢索快取、generate 不使用語意快取，否則第一次之後量到的只是快取命中。
+    """
+    timer = _StageTimer()
+    rephrased = timer.run("rephrase", rephrase_question, prompt)
+    metadata_filter = timer.run("metadata_filter", generate_metadata_filter, prompt,
+                                use_cache=not use_llm_filter, use_rules=not use_llm_filter)
+    timer.run("retrieve", retrieve_from_kb, rephrased, knowledge_base_id,
+              metadata_filter=metadata_filter if metadata_filter is not None else {}, use_retrieval_cache=False)
+    timer.run("generate", ret_and_gen, rephrased, knowledge_base_id, model_arn, use_semantic_cache=False)
+    return timer.timings
+
+
+def measure_cold_import(modules: Sequence[str] = ("tools.rephrase", "tools.retrieve", "tools.retrieve_generate"),
+                        repeats: int = 3) -> Dict[str, float]:
+    """以全新的 interpreter 量測 import tools 模組所需時間（毫秒）。"""
+    script = (
+        "import time\n"
+        "started = time.perf_counter()\n"
+        + "".join(f"import {module}\n" for module in modules)
+        + "print((time.perf_counter() - started) * 1000)\n"
+    )
+    samples = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, "-c", script], check=True, capture_output=True, text=True)
+        samples.append(float(output.stdout.strip().splitlines()[-1]))
+    return {"median_ms": statistics.median(samples), "min_ms": min(samples), "samples": samples}
+
+
+def run_level(prompts: Sequence[str],
+              knowledge_base_id: str,
+              model_arn: str,
+              concurrency: int,
+              requests: int,
+              use_llm_filter: bool = True) -> Dict[str, Any]:
+    """
+    以固定並行數送出 requests 次完整流程，統計各階段與端到端延遲及吞吐量。
+    量測期間停用 single-flight，相同問題的並行請求各自呼叫 API，不會合併成一次。
+    """
+    stage_latencies: Dict[str, List[float]] = {stage: [] for stage in STAGES}
+    end_to_end: List[float] = []
+    errors: List[str] = []
+    lock = threading.Lock()
+
+    def _one(index: int) -> None:
+        started = time.perf_counter()
+        try:
+            timings = run_pipeline_once(prompts[index % len(prompts)], knowledge_base_id, model_arn, use_llm_filter)
+        except Exception as exc:
+            with lock:
+                errors.append(f"{type(exc).__name__}: {exc}")
+            return
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            end_to_end.append(elapsed)
+            for stage, value in timings.items():
+                stage_latencies[stage].append(value)
+
+    coalescing = SingleFlightConfig.ENABLED
+    SingleFlightConfig.ENABLED = False
+    try:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="kb-bench") as executor:
+            list(executor.map(_one, range(requests)))
+        wall = time.perf_counter() - started
+    finally:
+        SingleFlightConfig.ENABLED = coalescing
+
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "wall_s": wall,
+        "throughput_per_s": len(end_to_end) / wall if wall > 0 else 0.0,
+        "end_to_end": latency_summary(end_to_end),
+        "stages": {stage: latency_summary(values) for stage, values in stage_latencies.items()},
+    }
+
+
+def run_benchmark(prompts: Sequence[str],
+                  knowledge_base_id: str,
+                  model_arn: str,
+                  concurrency_levels: Sequence[int] = (1, 4, 16),
+                  requests_per_level: int = 20,
+                  backend: str = "aws",
+                  use_llm_filter: bool = True,
+                  measure_import: bool = True) -> Dict[str, Any]:
+    """執行完整的 benchmark，回傳可寫成 JSON 的結果。"""
+    result: Dict[str, Any] = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "backend": backend,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "prompts": len(prompts),
+            "requests_per_level": requests_per_level,
+            "use_llm_filter": use_llm_filter,
+        },
+    }
+    if measure_import:
+        result["cold_import"] = measure_cold_import()
+
+    tracemalloc.start()
+    try:
+        result["levels"] = [
+            run_level(prompts, knowledge_base_id, model_arn, concurrency, requests_per_level, use_llm_filter)
+            for concurrency in concurrency_levels
+        ]
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    result["memory"] = {"python_peak_mb": peak / (1024 * 1024)}
+    if resource is not None:
+        # Linux 的 ru_maxrss 單位為 KB，macOS 為 bytes
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result["memory"]["max_rss_mb"] = max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+    return result
+
+
+def compare_results(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float = 0.10) -> List[str]:
+    """
+    與先前的結果比較，回傳超過 threshold（比例）的退步項目：
+    各並行數下的端到端 / 各階段 p95 延遲、吞吐量，以及 cold import 時間。
+    """
+    regressions = []
+
+    def _check(name: str, now: Optional[float], before: Optional[float], higher_is_worse: bool = True) -> None:
+        if not now or not before:
+            return
+        change = (now - before) / before if higher_is_worse else (before - now) / before
+        if change > threshold:
+            regressions.append(f"{name}: {before:.1f} -> {now:.1f} ({change:+.0%})")
+
+    baseline_levels = {level["concurrency"]: level for level in baseline.get("levels", [])}
+    for level in current.get("levels", []):
+        previous = baseline_levels.get(level["concurrency"])
+        if previous is None:
+            continue
+        prefix = f"c={level['concurrency']}"
+        _check(f"{prefix} end_to_end p95_ms", level["end_to_end"].get("p95_ms"), previous["end_to_end"].get("p95_ms"))
+        _check(f"{prefix} throughput_per_s", level["throughput_per_s"], previous["throughput_per_s"],
+               higher_is_worse=False)
+        for stage, summary in level["stages"].items():
+            _check(f"{prefix} {stage} p95_ms", summary.get("p95_ms"),
+                   previous["stages"].get(stage, {}).get("p95_ms"))
+
+    _check("cold_import median_ms", current.get("cold_import", {}).get("median_ms"),
+           baseline.get("cold_import", {}).get("median_ms"))
+    return regressions
+
+
+def load_result(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as handle:
+        return json.load(handle)
@@ -0,0 +1,162 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+_MISSING = object()
+
+
+def normalize_query(query: str) -> str:
+    """正規化查詢字串（全半形、大小寫、空白），作為快取 key。"""
+    text = unicodedata.normalize("NFKC", query).casefold()
+    text = " ".join(text.split())
+    return text.rstrip("。.!！?？ ")
+
+
+def json_size(value: Any) -> int:
+    """以 JSON 編碼後的 UTF-8 位元組數估計值的大小。"""
+    return len(json.dumps(value, ensure_ascii=False, default=str).encode("utf-8"))
+
+
+class TTLCache:
+    """
+    具 TTL 的有界 LRU 快取，thread-safe。
+    get() 找不到或過期時回傳 default；peek() 連同過期（尚未被移除）的項目一併回傳。
+    指定 max_bytes 時另以 sizeof(value) 計算總大小，超過時從最久未使用的項目開始淘汰；
+    單一項目大於 max_bytes 時不會寫入。
+    """
+
+    def __init__(self,
+                 max_entries: int,
+                 ttl_seconds: float,
+                 max_bytes: Optional[int] = None,
+                 sizeof: Callable[[Any], int] = json_size):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data: "OrderedDict[Hashable, Tuple[float, Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "rejected": 0}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self._stats["misses"] += 1
+                return default
+            expires_at, value, _ = item
+            if expires_at <= now:
+                self._pop(key)
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return default
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """回傳 key 的值，即使已過期也回傳；不更新 LRU 順序與統計，也不移除過期項目。"""
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            return default if item is _MISSING else item[1]
+
+    def set(self, key: Hashable, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            self._pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                self._stats["rejected"] += 1
+                return
+            self._data[key] = (time.monotonic() + ttl, value, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or (
+                    self.max_bytes is not None and self._bytes > self.max_bytes):
+                _, (_, _, evicted_size) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+                self._stats["evictions"] += 1
+
+    def _pop(self, key: Hashable) -> None:
+        item = self._data.pop(key, _MISSING)
+        if item is not _MISSING:
+            self._bytes -= item[2]
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._pop(key)
+
+    def delete_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """刪除 key 符合 predicate 的所有項目，回傳刪除筆數。"""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self._pop(key)
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats, size=len(self._data))
+            if self.max_bytes is not None:
+                stats["bytes"] = self._bytes
+            return stats
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteStore:
+    """
+    以 SQLite 實作的簡易持久化 key/value 儲存（值以 JSON 保存），
+    可放在 Lambda 的 /tmp 或 CLI 主機上，跨 process 保留快取。
+    """
+
+    def __init__(self, path: str, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            if row[1] <= time.time():
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._conn.commit()
+                return default
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        payload = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, payload, time.time() + self.ttl_seconds),
+            )
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
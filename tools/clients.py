@@ -0,0 +1,109 @@
+import copy
+import json
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Tuple, Union
+
+from tools.config import ClientPoolConfig
+from tools.telemetry import instrument_client
+
+if TYPE_CHECKING:
+    from botocore.config import Config
+
+# boto3 / botocore 的 import 佔 cold start 的大部分時間，延後到第一次建立 client 才載入。
+# 呼叫端可傳入 botocore Config，或以 dict 描述相同的選項（避免在 import 時載入 botocore）。
+ClientOptions = Union["Config", Dict[str, Any]]
+
+
+_lock = threading.Lock()
+_clients: Dict[Tuple[str, str, str], Any] = {}
+_stats = {"hits": 0, "misses": 0}
+
+# (service_name, region_name, config) -> client；None 代表使用 boto3.client
+ClientFactory = Callable[[str, str, Optional["Config"]], Any]
+_factory: Optional[ClientFactory] = None
+_factory_loaded = False
+
+
+def _config_key(config: Optional[ClientOptions]) -> str:
+    """將 botocore Config（或選項 dict）轉為可雜湊的 key（Config 本身不可雜湊）。"""
+    if config is None:
+        return ""
+    options = config if isinstance(config, dict) else getattr(config, "_user_provided_options", {})
+    return json.dumps(options, sort_keys=True, default=repr)
+
+
+def get_client(service_name: str, region_name: str, config: Optional[ClientOptions] = None) -> Any:
+    """
+    取得以 (service, region, Config) 為 key 的共用 boto3 client。
+    第一次呼叫時才建立，之後在同一個 process（含 warm Lambda）內重複使用。
+    """
+    key = (service_name, region_name, _config_key(config))
+    client = _clients.get(key)
+    if client is not None:
+        with _lock:
+            _stats["hits"] += 1
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            _stats["hits"] += 1
+            return client
+
+        from botocore.config import Config
+
+        pool_config = Config(max_pool_connections=ClientPoolConfig.MAX_POOL_CONNECTIONS)
+        if config is not None:
+            # botocore 會改寫 retries 等巢狀設定，先複製以免影響 key 計算
+            options = copy.deepcopy(config)
+            pool_config = pool_config.merge(Config(**options) if isinstance(options, dict) else options)
+        factory = _get_factory()
+        if factory is not None:
+            client = factory(service_name, region_name, pool_config)
+        else:
+            import boto3
+
+            client = boto3.client(service_name, region_name=region_name, config=pool_config)
+        instrument_client(client)
+        _clients[key] = client
+        _stats["misses"] += 1
+        return client
+
+
+def _get_factory() -> Optional[ClientFactory]:
+    # 第一次建立 client 時才依 BEDROCK_BACKEND 載入模擬器，避免一般情況多 import
+    global _factory, _factory_loaded
+    if not _factory_loaded:
+        _factory_loaded = True
+        backend = os.environ.get("BEDROCK_BACKEND", "")
+        if _factory is None and backend and backend != "aws":
+            from tools.simulator import factory_from_env
+            _factory = factory_from_env(backend)
+    return _factory
+
+
+def set_client_factory(factory: Optional[ClientFactory]) -> None:
+    """
+    替換建立 client 的方式（例如改用 tools.simulator 的模擬器），並清空既有的 client。
+    傳入 None 則恢復使用 boto3。
+    """
+    global _factory, _factory_loaded
+    with _lock:
+        _factory = factory
+        _factory_loaded = True
+        _clients.clear()
+
+
+def client_pool_stats() -> Dict[str, int]:
+    """回傳 client pool 的命中統計。"""
+    with _lock:
+        return {"hits": _stats["hits"], "misses": _stats["misses"], "size": len(_clients)}
+
+
+def clear_client_pool() -> None:
+    """清空所有快取的 client 與統計（測試或切換認證時使用）。"""
+    with _lock:
+        _clients.clear()
+        _stats["hits"] = 0
+        _stats["misses"] = 0
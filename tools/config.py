@@ -1,8 +1,14 @@
+import os
 from typing import Dict, Optional
 
 DEFAULT_REGION = "us-east-1"
 
 
+class ClientPoolConfig:
+    # 每個 boto3 client 底層 urllib3 連線池的大小，可透過環境變數調整
+    MAX_POOL_CONNECTIONS = int(os.environ.get("BEDROCK_MAX_POOL_CONNECTIONS", "50"))
+
+
 class BasicModelConfig:
     REGION = DEFAULT_REGION
     MODEL_ID = "amazon.nova-pro-v1:0"
@@ -21,10 +27,128 @@ class BasicModelConfig:
         }
 
 
+class PromptCacheConfig:
+    # 在固定的 system prompt / few-shot 前綴後加入 Bedrock prompt cache checkpoint（cachePoint）
+    # 模型不支援或前綴低於最小 token 數時不會寫入快取；設為 0 可完全停用
+    ENABLED = os.environ.get("PROMPT_CACHE", "1") != "0"
+    # 以 Converse API 呼叫時，只有這些模型（model ID、ARN 或 inference profile 含有其一）保留 cachePoint，
+    # 其他模型（例如 Claude 3 Sonnet）收到 cachePoint 會回應 ValidationException
+    MODEL_PATTERNS = ("amazon.nova", "anthropic.claude-3-7", "anthropic.claude-3-5-haiku",
+                      "anthropic.claude-sonnet-4", "anthropic.claude-opus-4", "anthropic.claude-haiku-4")
+
+    @classmethod
+    def supports(cls, model_id: str) -> bool:
+        return any(pattern in model_id for pattern in cls.MODEL_PATTERNS)
+
+
+class TelemetryConfig:
+    # none（預設）、log、emf（CloudWatch Embedded Metric Format）或 otel
+    SINK = os.environ.get("TELEMETRY_SINK", "none").lower()
+    NAMESPACE = os.environ.get("TELEMETRY_NAMESPACE", "KbRag")
+
+
+class LambdaConfig:
+    # 是否在 Lambda init 階段（模組載入時）就建立 client；預設只在 Lambda 環境中啟用
+    INIT_ON_IMPORT = os.environ.get(
+        "LAMBDA_INIT_ON_IMPORT", "1" if os.environ.get("AWS_LAMBDA_FUNCTION_NAME") else "0"
+    ) == "1"
+    # 視為 warm-up（預熱）呼叫的 event source；只列出專用於預熱的來源，
+    # EventBridge 的其他事件（source 同為 aws.events）不能因此略過處理，排程 ping 請以 {"warmup": true} 作為輸入
+    WARMUP_SOURCES = ("serverless-plugin-warmup",)
+
+
+class DeadlineConfig:
+    # 每個階段可使用「當下剩餘時間」的比例；generate 是最後一個階段，可用完全部剩餘時間
+    STAGE_SHARES = {"rephrase": 0.3, "metadata_filter": 0.25, "retrieve": 0.4, "generate": 1.0}
+    # 剩餘時間少於此秒數時略過非必要的 metadata filter 產生（改為不過濾的檢索）
+    MIN_FILTER_SECONDS = float(os.environ.get("DEADLINE_MIN_FILTER_SECONDS", "3"))
+    # Lambda 保留給序列化與回傳結果的時間
+    LAMBDA_RESERVE_MS = int(os.environ.get("LAMBDA_DEADLINE_RESERVE_MS", "500"))
+    # client 逾時以固定級距（秒）取整，避免 client pool 因逾時值不同而建立過多 client
+    TIMEOUT_BUCKETS = (1, 2, 3, 5, 8, 13, 20, 30, 45, 60, 90, 120)
+
+
+class AsyncConfig:
+    # 同時在途的 Bedrock 呼叫上限，預設與 client 連線池大小一致
+    MAX_CONCURRENCY = int(os.environ.get("BEDROCK_MAX_CONCURRENCY", str(ClientPoolConfig.MAX_POOL_CONNECTIONS)))
+    # 每次呼叫的預設逾時秒數；None 代表不限制
+    DEFAULT_TIMEOUT: Optional[float] = None
+
+
+def _parse_rate_limits(spec: str) -> Dict[str, float]:
+    # 格式："model_id=rate" 或 "model_id/Operation=rate"，以逗號分隔
+    rates = {}
+    for item in spec.split(","):
+        key, _, rate = item.strip().rpartition("=")
+        if key and rate:
+            rates[key.strip()] = float(rate)
+    return rates
+
+
+class RateLimitConfig:
+    # 選用的用戶端 Bedrock 模型呼叫流量控制（token bucket + AIMD 並行上限），依 (model, operation, region) 分開計算；
+    # 預設關閉，開啟後每個 (model, operation, region) 從 INITIAL_CONCURRENCY 個並行呼叫開始
+    ENABLED = os.environ.get("BEDROCK_RATE_LIMIT", "0") == "1"
+    # 每秒請求數上限；0 代表只做 AIMD 並行控制，不限制速率
+    RATE_PER_SECOND = float(os.environ.get("BEDROCK_RATE_PER_SECOND", "0"))
+    # 個別模型或操作的速率上限，例如 "amazon.nova-pro-v1:0=5,amazon.nova-pro-v1:0/InvokeModelWithResponseStream=2"
+    RATE_OVERRIDES = _parse_rate_limits(os.environ.get("BEDROCK_RATE_LIMITS", ""))
+    # AIMD：成功時上限約每輪 +1，throttling 時乘上 DECREASE_FACTOR（每輪最多減一次，一輪為成功呼叫的平均延遲）
+    INITIAL_CONCURRENCY = int(os.environ.get("BEDROCK_INITIAL_CONCURRENCY", "4"))
+    MIN_CONCURRENCY = 1
+    MAX_CONCURRENCY = AsyncConfig.MAX_CONCURRENCY
+    DECREASE_FACTOR = 0.5
+    MIN_COOLDOWN_SECONDS = 0.05
+    # throttling 時的重試次數與退避基準秒數（full jitter，指數成長），重試不會超過 deadline
+    MAX_THROTTLE_RETRIES = int(os.environ.get("BEDROCK_THROTTLE_RETRIES", "3"))
+    BACKOFF_SECONDS = 0.2
+    # 選用的多 region 路由，例如 "us-east-1,us-west-2"；依觀察到的延遲與 throttling 比例加權選擇
+    # 只用於呼叫端未指定 region 的呼叫，模型須在各 region 皆可用；以 ARN 指定的模型不做路由
+    REGIONS = [region.strip() for region in os.environ.get("BEDROCK_REGIONS", "").split(",") if region.strip()]
+    EWMA_ALPHA = 0.2
+
+    @classmethod
+    def rate_for(cls, model_id: str, operation: str) -> float:
+        return cls.RATE_OVERRIDES.get(f"{model_id}/{operation}", cls.RATE_OVERRIDES.get(model_id, cls.RATE_PER_SECOND))
+
+
+class ServeConfig:
+    # kb-cli serve 的監聽位址；在容器（ECS）中請設為 0.0.0.0
+    HOST = os.environ.get("SERVE_HOST", "127.0.0.1")
+    PORT = int(os.environ.get("SERVE_PORT", "8080"))
+    # 同時處理的請求數上限，以及額外可排隊的請求數；兩者都滿時回應 503
+    MAX_CONCURRENCY = int(os.environ.get("SERVE_MAX_CONCURRENCY", str(AsyncConfig.MAX_CONCURRENCY)))
+    MAX_QUEUE = int(os.environ.get("SERVE_MAX_QUEUE", str(AsyncConfig.MAX_CONCURRENCY)))
+    # 每個請求的端到端 deadline 秒數（請求 body 的 deadline 只能再縮短）
+    REQUEST_TIMEOUT = float(os.environ.get("SERVE_REQUEST_TIMEOUT", "60"))
+    KEEPALIVE_TIMEOUT = 15
+    MAX_BODY_BYTES = 1024 * 1024
+    # /metrics 計算各路由延遲百分位時保留的最近筆數
+    LATENCY_WINDOW = 1000
+
+
+class MetadataFilterCacheConfig:
+    ENABLED = os.environ.get("METADATA_FILTER_CACHE", "1") != "0"
+    MAX_ENTRIES = int(os.environ.get("METADATA_FILTER_CACHE_SIZE", "1024"))
+    TTL_SECONDS = float(os.environ.get("METADATA_FILTER_CACHE_TTL", "86400"))
+    # 選用的 SQLite 持久化路徑，例如 Lambda 上的 /tmp/metadata_filter_cache.db；未設定則只用記憶體
+    PERSIST_PATH = os.environ.get("METADATA_FILTER_CACHE_PATH")
+
+
+class MetadataRuleConfig:
+    ENABLED = os.environ.get("METADATA_RULES", "1") != "0"
+    # 選用的 JSON 規則檔，格式同 tools.metadata.DEFAULT_METADATA_SCHEMA
+    SCHEMA_PATH = os.environ.get("METADATA_RULES_PATH")
+    # 規則完全沒有比對到時是否仍交給 LLM 判斷（預設交給 LLM；設為 0 則直接視為不需 filter）
+    FALLBACK_ON_NO_MATCH = os.environ.get("METADATA_RULES_FALLBACK_ON_NO_MATCH", "1") != "0"
+
+
 class RetrieveConfig:
     REGION = DEFAULT_REGION
     NUMBER_OF_RESULTS = 3
     OVERRIDE_SEARCH_TYPE = "SEMANTIC"
+    # kb：Bedrock Knowledge Base（預設）；local：tools.local_index 的本地向量索引（需要 numpy）
+    BACKEND = os.environ.get("RETRIEVE_BACKEND", "kb").lower()
 
     @classmethod
     def retrieval_configuration(cls,
@@ -40,6 +164,123 @@ class RetrieveConfig:
         return {"vectorSearchConfiguration": vector_search_config}
 
 
+class LocalIndexConfig:
+    # 以 kb-cli index-build 建立的索引目錄
+    PATH = os.environ.get("LOCAL_INDEX_PATH", "index")
+    # 預設 HashingEmbedder 的維度
+    DIM = 512
+    # 由原始文件切塊時每塊的字元數與重疊字元數
+    CHUNK_CHARS = 500
+    CHUNK_OVERLAP = 50
+    # IVF 查詢時搜尋的最近 cluster 數
+    NPROBE = int(os.environ.get("LOCAL_INDEX_NPROBE", "4"))
+    KMEANS_ITERATIONS = 10
+    # 快取各 filter 對應的候選 chunk，供 metadata 預先過濾使用
+    FILTER_CACHE_SIZE = 256
+    BEDROCK_EMBED_MODEL_ID = "amazon.titan-embed-text-v2:0"
+
+
+class FanoutConfig:
+    # 多個 knowledge base 的合併方式：rrf（reciprocal-rank fusion）或 score（min-max 正規化後加總）
+    FUSION = os.environ.get("RETRIEVE_FUSION", "rrf").lower()
+    RRF_K = 60
+    MAX_WORKERS = int(os.environ.get("RETRIEVE_FANOUT_WORKERS", "16"))
+
+
+class RerankConfig:
+    # 開啟後 retrieve_from_kb 先多取 FETCH_K 筆候選，再以 BM25 重新排序並保留 top-k
+    ENABLED = os.environ.get("RETRIEVE_RERANK", "0") == "1"
+    FETCH_K = int(os.environ.get("RETRIEVE_RERANK_FETCH_K", "20"))
+    # 最終分數中原本語意分數所佔的比例，其餘為 BM25
+    SEMANTIC_WEIGHT = float(os.environ.get("RETRIEVE_RERANK_SEMANTIC_WEIGHT", "0.3"))
+    K1 = 1.2
+    B = 0.75
+
+
+class RetrievalCacheConfig:
+    # 相同 (knowledge base, 查詢, filter, top-k) 的 retrieve 結果在 TTL 內直接取用
+    ENABLED = os.environ.get("RETRIEVAL_CACHE", "1") != "0"
+    MAX_ENTRIES = int(os.environ.get("RETRIEVAL_CACHE_SIZE", "512"))
+    # 以 JSON 大小計算的記憶體上限，chunk 較大的結果會較早被淘汰
+    MAX_BYTES = int(float(os.environ.get("RETRIEVAL_CACHE_MAX_MB", "64")) * 1024 * 1024)
+    TTL_SECONDS = float(os.environ.get("RETRIEVAL_CACHE_TTL", "300"))
+
+
+class SemanticCacheConfig:
+    # 選用的語意草稿快取：問題與已生成的草稿夠相近且 filter 相同時直接回傳該草稿（需要 numpy）
+    ENABLED = os.environ.get("SEMANTIC_CACHE", "0") == "1"
+    # hashing-<dim>（預設，本地計算）或 bedrock:<model_id>:<dim>，格式同 LocalIndexConfig 的 embedder 名稱
+    EMBEDDER = os.environ.get("SEMANTIC_CACHE_EMBEDDER", f"hashing-{LocalIndexConfig.DIM}")
+    # cosine 相似度門檻；hashing embedder 只反映字面重疊，改用 bedrock embedder 時可依資料調低。
+    # hashing embedder 下只差產品或雲端／地端的問題相似度（約 0.89–0.92）高於改寫措辭的問題（約 0.85–0.88），
+    # 無法只靠門檻區分，因此這些詞另以 GUARD_TERMS 與規則擷取的 metadata 要求完全相同
+    THRESHOLD = float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.85"))
+    # 問題中出現時必須完全相同才可共用草稿的詞（逗號分隔）
+    GUARD_TERMS = [term.strip() for term in
+                   os.environ.get("SEMANTIC_CACHE_GUARD_TERMS", "雲端,地端,續約,新約,採購").split(",") if term.strip()]
+    MAX_ENTRIES = int(os.environ.get("SEMANTIC_CACHE_SIZE", "1024"))
+    TTL_SECONDS = float(os.environ.get("SEMANTIC_CACHE_TTL", "86400"))
+
+
+class SingleFlightConfig:
+    # 合併相同參數的並行呼叫（ret_and_gen、retrieve_from_kb、模型產生 filter），設為 0 可停用
+    ENABLED = os.environ.get("SINGLE_FLIGHT", "1") != "0"
+
+
+class SpeculativeRetrieveConfig:
+    # 預設關閉；開啟後 retrieve_from_kb 會在產生 filter 的同時先送出未過濾的 retrieve
+    ENABLED = os.environ.get("SPECULATIVE_RETRIEVE", "0") == "1"
+    # 未過濾的推測檢索多取幾倍結果，方便之後在本地依 metadata 過濾
+    OVERFETCH_FACTOR = 3
+    MAX_WORKERS = int(os.environ.get("SPECULATIVE_RETRIEVE_WORKERS", "8"))
+
+
+class HedgeConfig:
+    # retrieve 為冪等呼叫：超過近期延遲的百分位仍未回應時，再送出一個相同的請求
+    ENABLED = os.environ.get("RETRIEVE_HEDGE", "1") != "0"
+    PERCENTILE = float(os.environ.get("RETRIEVE_HEDGE_PERCENTILE", "0.95"))
+    # 累積足夠樣本前不做 hedge
+    MIN_SAMPLES = 20
+    WINDOW = 200
+    MIN_DELAY_MS = 20
+    MAX_WORKERS = 8
+
+
+class PipelineConfig:
+    # ret-gen 的模式：kb（RetrieveAndGenerate，預設）、split（retrieve_from_kb 後直接呼叫模型）
+    # 或 sections（檢索一次後，四個段落各自一次模型呼叫、同時生成）
+    MODE = os.environ.get("RET_GEN_MODE", "kb").lower()
+    # split 模式放入 prompt 的檢索內容 token 上限
+    CONTEXT_TOKEN_BUDGET = int(os.environ.get("RET_GEN_CONTEXT_TOKENS", "1500"))
+    # 去重與打包前先取回的候選數
+    FETCH_K = int(os.environ.get("RET_GEN_FETCH_K", "8"))
+    # 近似重複判斷：字元 shingle 長度與包含度門檻
+    SHINGLE_SIZE = 5
+    NEAR_DUPLICATE_THRESHOLD = 0.8
+
+
+class SectionConfig:
+    # sections 模式依序組成草稿的段落：(標題, 撰寫指示, 輸出 token 上限)；總和不超過 RetrieveGenerateConfig.MAX_TOKENS
+    SECTIONS = (
+        ("一、【主旨】", "以一至兩句說明本簽呈的目的與請求核示的事項。", 150),
+        ("二、【內文】", "說明需求背景與內容，並保留金額、期間、對象、預算來源等關鍵資訊。", 800),
+        ("三、【建議附件】", "條列建議檢附的文件。", 250),
+        ("四、【審核流程】", "列出建議的簽核層級與順序。", 200),
+    )
+    # 所有請求共用的段落生成 thread 數
+    MAX_WORKERS = int(os.environ.get("RET_GEN_SECTION_WORKERS", "16"))
+
+
+class SessionConfig:
+    # 草稿修訂的 session：保存問題、最新草稿與引用來源，修訂時只送出草稿與修改指示，不重新檢索
+    MAX_ENTRIES = int(os.environ.get("DRAFT_SESSION_SIZE", "256"))
+    TTL_SECONDS = float(os.environ.get("DRAFT_SESSION_TTL", "86400"))
+    # 選用的 SQLite 持久化路徑；設定後即保存 session（Lambda 的 /tmp 只屬於單一執行環境）
+    PERSIST_PATH = os.environ.get("DRAFT_SESSION_PATH")
+    # 預設不保存 session；設為 1 時只保存在記憶體（適合 kb-cli serve 這類常駐 process）
+    ENABLED = os.environ.get("DRAFT_SESSIONS", "0") == "1" or bool(PERSIST_PATH)
+
+
 class RetrieveGenerateConfig:
     REGION = DEFAULT_REGION
     NUMBER_OF_RESULTS = 3
@@ -61,18 +302,22 @@ class RetrieveGenerateConfig:
     TEMPERATURE = 0.2
     TOP_P = 0.9
     @classmethod
-    def retrieve_and_gen_config(cls, knowledge_base_id: str, model_arn: str, number_of_results: Optional[int] = None) -> Dict[str, object]:
+    def retrieve_and_gen_config(cls, knowledge_base_id: str, model_arn: str, number_of_results: Optional[int] = None,
+                                metadata_filter: Optional[Dict[str, object]] = None) -> Dict[str, object]:
         results = cls.NUMBER_OF_RESULTS if number_of_results is None else number_of_results
+        vector_search_config: Dict[str, object] = {
+            "numberOfResults": results,
+            "overrideSearchType": RetrieveConfig.OVERRIDE_SEARCH_TYPE,
+        }
+        if metadata_filter:
+            vector_search_config["filter"] = metadata_filter
         return {
             "type": "KNOWLEDGE_BASE",
             "knowledgeBaseConfiguration": {
                 "knowledgeBaseId": knowledge_base_id,
                 "modelArn": model_arn,
                 "retrievalConfiguration": {
-                    "vectorSearchConfiguration": {
-                        "numberOfResults": results,
-                        "overrideSearchType": RetrieveConfig.OVERRIDE_SEARCH_TYPE,
-                    }
+                    "vectorSearchConfiguration": vector_search_config
                 },
                 "generationConfiguration": {
                     "promptTemplate": {
@@ -0,0 +1,77 @@
+import time
+from typing import Any, Dict, Optional
+
+from tools.config import DeadlineConfig
+
+
+class DeadlineExceeded(TimeoutError):
+    """剩餘時間已不足以執行下一個階段。"""
+
+
+class Deadline:
+    """
+    端到端的截止時間（以 time.monotonic() 計算），由 Lambda / CLI 建立後傳入各個 tools 函式。
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_lambda_context(cls, context: Any, reserve_ms: Optional[int] = None) -> Optional["Deadline"]:
+        """以 context.get_remaining_time_in_millis() 扣除保留時間建立；本地測試的 context 沒有此方法時回傳 None。"""
+        get_remaining = getattr(context, "get_remaining_time_in_millis", None)
+        if get_remaining is None:
+            return None
+        reserve_ms = DeadlineConfig.LAMBDA_RESERVE_MS if reserve_ms is None else reserve_ms
+        return cls(max(0, get_remaining() - reserve_ms) / 1000)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def check(self, stage: str) -> None:
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline exceeded before stage '{stage}'.")
+
+    def budget(self, stage: str) -> float:
+        """該階段可使用的秒數：剩餘時間乘上 DeadlineConfig.STAGE_SHARES 中的比例。"""
+        return self.remaining() * DeadlineConfig.STAGE_SHARES.get(stage, 1.0)
+
+    def __repr__(self) -> str:
+        return f"Deadline(remaining={self.remaining():.3f}s)"
+
+
+def bucket_timeout(seconds: float) -> int:
+    """取不超過 seconds 的最大級距（至少為最小級距）。"""
+    buckets = DeadlineConfig.TIMEOUT_BUCKETS
+    chosen = buckets[0]
+    for bucket in buckets:
+        if bucket > seconds:
+            break
+        chosen = bucket
+    return chosen
+
+
+def stage_client_config(base: Dict[str, Any], deadline: Optional[Deadline], stage: str) -> Dict[str, Any]:
+    """
+    依 deadline 分配給該階段的預算縮短 client 的 connect/read timeout；沒有 deadline 時原樣回傳。
+    預算會平均分給每一次重試，讓含重試在內的總耗時仍落在預算內。
+    """
+    if deadline is None:
+        return base
+    deadline.check(stage)
+    attempts = base.get("retries", {}).get("max_attempts", 1)
+    limit = bucket_timeout(deadline.budget(stage) / attempts)
+    options = dict(base)
+    options["connect_timeout"] = min(base.get("connect_timeout", limit), limit)
+    options["read_timeout"] = min(base.get("read_timeout", limit), limit)
+    return options
+
+
+def check(deadline: Optional[Deadline], stage: str) -> None:
+    """deadline 可為 None 的 Deadline.check。"""
+    if deadline is not None:
+        deadline.check(stage)
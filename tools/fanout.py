@@ -0,0 +1,184 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from tools import telemetry
+from tools.cache import normalize_query
+from tools.config import FanoutConfig, RetrieveConfig
+from tools.deadline import Deadline, check
+from tools.retrieve import generate_metadata_filter, retrieve_from_kb
+
+
+KnowledgeBase = Union[str, Tuple[str, str]]
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=FanoutConfig.MAX_WORKERS, thread_name_prefix="kb-fanout")
+    return _executor
+
+
+def parse_knowledge_bases(spec: str, region: str = RetrieveConfig.REGION) -> List[Tuple[str, str]]:
+    """解析 "KB1,KB2@us-west-2" 格式：以逗號分隔，@ 之後為該 knowledge base 的 region。"""
+    knowledge_bases = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        knowledge_base_id, _, kb_region = item.partition("@")
+        knowledge_bases.append((knowledge_base_id.strip(), kb_region.strip() or region))
+    return knowledge_bases
+
+
+def _normalize(knowledge_bases: Sequence[KnowledgeBase], region: str) -> List[Tuple[str, str]]:
+    return [(kb, region) if isinstance(kb, str) else (kb[0], kb[1]) for kb in knowledge_bases]
+
+
+def _location_uri(location: Dict[str, Any]) -> str:
+    """取出 location 中的來源 URI（s3Location.uri、webLocation.url 等）。"""
+    for value in location.values():
+        if isinstance(value, dict):
+            uri = value.get("uri") or value.get("url")
+            if uri:
+                return uri
+    return ""
+
+
+def chunk_key(result: Dict[str, Any]) -> Tuple[str, str]:
+    """以來源 URI 與正規化後內容的雜湊識別相同的 chunk。"""
+    text = normalize_query(result.get("content", {}).get("text", ""))
+    return _location_uri(result.get("location", {})), hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def fuse_results(ranked_lists: Sequence[Tuple[str, List[Dict[str, Any]]]],
+                 method: str = FanoutConfig.FUSION,
+                 rrf_k: int = FanoutConfig.RRF_K) -> List[Dict[str, Any]]:
+    """
+    合併多個 knowledge base 的排序結果，並移除重複的 chunk（同一 URI 且內容相同）。
+    rrf：reciprocal-rank fusion，分數為 Σ 1 / (rrf_k + 名次)；
+    score：各 knowledge base 的 score 以 min-max 正規化到 0–1 後加總。
+    每筆結果附上 fusedScore 與出現過的 knowledgeBaseIds。
+    """
+    if method not in ("rrf", "score"):
+        raise ValueError(f"Unknown fusion method: {method}")
+    fused: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    for knowledge_base_id, results in ranked_lists:
+        scores = [result.get("score", 0.0) or 0.0 for result in results]
+        low, high = (min(scores), max(scores)) if scores else (0.0, 0.0)
+        for rank, result in enumerate(results, start=1):
+            if method == "rrf":
+                contribution = 1.0 / (rrf_k + rank)
+            else:
+                contribution = 1.0 if high == low else ((result.get("score", 0.0) or 0.0) - low) / (high - low)
+            key = chunk_key(result)
+            entry = fused.get(key)
+            if entry is None:
+                entry = fused[key] = dict(result, fusedScore=0.0, knowledgeBaseIds=[])
+            entry["fusedScore"] += contribution
+            if knowledge_base_id not in entry["knowledgeBaseIds"]:
+                entry["knowledgeBaseIds"].append(knowledge_base_id)
+    return sorted(fused.values(), key=lambda entry: -entry["fusedScore"])
+
+
+def retrieve_from_kbs(question: str,
+                      knowledge_bases: Sequence[KnowledgeBase],
+                      region: str = RetrieveConfig.REGION,
+                      number_of_results: Optional[int] = None,
+                      metadata_filter: Optional[dict] = None,
+                      fusion: str = FanoutConfig.FUSION,
+                      quorum: Optional[int] = None,
+                      deadline: Optional[Deadline] = None,
+                      use_filter_cache: bool = True,
+                      use_retrieval_cache: bool = True,
+                      backend: Optional[str] = None,
+                      rerank: Optional[bool] = None,
+                      fetch_k: Optional[int] = None) -> dict:
+    """
+    同時對多個 knowledge base（可跨 region，以 (id, region) 指定）執行 retrieve_from_kb，合併後回傳前 number_of_results 筆。
+    backend、rerank、fetch_k 原樣傳給每個 knowledge base 的 retrieve_from_kb（rerank 在合併前對各自的候選進行）。
+    quorum 個 knowledge base 成功回應（預設全部）或 deadline 到期時就回傳，不等待較慢的 knowledge base；
+    response["knowledge_bases"] 記錄每個 knowledge base 的狀態（ok / error / pending）與延遲。
+    metadata filter 只產生一次，套用到所有 knowledge base。
+    """
+    targets = _normalize(knowledge_bases, region)
+    if not targets:
+        raise ValueError("At least one knowledge base is required.")
+    top_k = RetrieveConfig.NUMBER_OF_RESULTS if number_of_results is None else number_of_results
+    quorum = len(targets) if quorum is None else max(1, min(quorum, len(targets)))
+
+    if metadata_filter is None:
+        metadata_filter = generate_metadata_filter(question, use_cache=use_filter_cache, deadline=deadline)
+    check(deadline, "retrieve")
+
+    with telemetry.span("retrieve_fanout", knowledge_bases=len(targets), quorum=quorum) as attributes:
+        started = time.perf_counter()
+        futures: Dict[Future, Tuple[str, str]] = {}
+        for knowledge_base_id, kb_region in targets:
+            future = _get_executor().submit(
+                retrieve_from_kb,
+                question,
+                knowledge_base_id,
+                region=kb_region,
+                number_of_results=top_k,
+                # 空 dict 代表「已確認不需要 filter」，避免每個 knowledge base 再產生一次
+                metadata_filter=metadata_filter if metadata_filter is not None else {},
+                use_filter_cache=use_filter_cache,
+                speculative=False,
+                deadline=deadline,
+                use_retrieval_cache=use_retrieval_cache,
+                backend=backend,
+                rerank=rerank,
+                fetch_k=fetch_k,
+            )
+            futures[future] = (knowledge_base_id, kb_region)
+
+        statuses: Dict[Future, Dict[str, Any]] = {}
+        ranked_lists: List[Tuple[str, List[Dict[str, Any]]]] = []
+        pending = set(futures)
+        while pending and len(ranked_lists) < quorum:
+            timeout = None if deadline is None else deadline.remaining()
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                knowledge_base_id, kb_region = futures[future]
+                status: Dict[str, Any] = {"latency_ms": (time.perf_counter() - started) * 1000}
+                try:
+                    results = future.result().get("retrievalResults", [])
+                except Exception as exc:
+                    status.update(status="error", error=str(exc), error_code=telemetry.error_code(exc))
+                else:
+                    status.update(status="ok", results=len(results))
+                    ranked_lists.append((knowledge_base_id, results))
+                statuses[future] = status
+
+        # 已達 quorum 或 deadline：尚未開始的呼叫直接取消，進行中的在背景完成（結果仍會寫入 retrieve 快取）
+        for future in pending:
+            future.cancel()
+        attributes["responded"] = len(ranked_lists)
+        attributes["pending"] = len(pending)
+
+    if not ranked_lists:
+        errors = [status for status in statuses.values() if status["status"] == "error"]
+        if errors:
+            raise RuntimeError(f"All knowledge bases failed: {errors[0]['error']}")
+        check(deadline, "retrieve")
+
+    return {
+        "retrievalResults": fuse_results(ranked_lists, fusion)[:top_k],
+        "metadata_filter": metadata_filter,
+        "fusion": fusion,
+        "knowledge_bases": [
+            dict({"knowledgeBaseId": knowledge_base_id, "region": kb_region},
+                 **statuses.get(future, {"status": "pending"}))
+            for future, (knowledge_base_id, kb_region) in futures.items()
+        ],
+    }
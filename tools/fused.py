@@ -0,0 +1,125 @@
+from typing import Any, Dict, Optional
+
+from tools import telemetry
+from tools.bedrock import build_messages_body, invoke_model, parse_json_response
+from tools.config import BasicModelConfig, DeadlineConfig
+from tools.deadline import Deadline, stage_client_config
+from tools.rephrase import rephrase_question
+from tools.retrieve import (
+    METADATA_FILTER_SYSTEM_PROMPT,
+    QUERY_CONTEXT_TEMPLATE,
+    generate_metadata_filter,
+    lookup_local_filter,
+    parse_generated_filter,
+    store_metadata_filter,
+)
+
+
+# 一次呼叫同時完成重述與 filter 擷取，讀取逾時取兩者中較長的 rephrase
+_CLIENT_CONFIG = dict(
+    connect_timeout=5,
+    read_timeout=60,
+    retries={"max_attempts": 1}
+)
+
+FUSED_SYSTEM_PROMPT = """
+    你在 RAG 流程中同時負責兩件事，並且只輸出一個 JSON 物件：
+
+    1. rephrased：扮演「問題重述 Agent」，把使用者對保險公司內部簽呈（內部公文）的需求改寫成一段第一人稱、
+       正式通順的繁體中文敘述，好像你就是使用者本人，正在向公司內部提出簽呈需求。
+       只能根據使用者輸入的資訊改寫，不要加入使用者沒有提到的內容，並保留金額、日期、部門、對象、原因等關鍵資訊。
+    2. query 與 filter：依照下方規則，把使用者的查詢轉成檢索用的 query（不含 filter 條件）與 metadata filter。
+
+    << Output Format >>
+    ```json
+    {
+    "rephrased": string \\ first-person rephrased request
+    "query": string \\ transformed query that excludes the filters
+    "filter": {
+        "op": [{comparison / statement 1}, {comparison / logical statement 2}, ...]
+    }
+    }
+    ```
+""" + METADATA_FILTER_SYSTEM_PROMPT.split("<< Output Format >>", 1)[1].split("```\n", 1)[1]
+
+
+def _build_request_body(question: str) -> dict:
+    # system prompt 與 few-shot 範例固定不變，放在 prompt cache checkpoint 之前
+    query_prefix, query_suffix = QUERY_CONTEXT_TEMPLATE.split("<<USER_QUERY>>", 1)
+    return build_messages_body(FUSED_SYSTEM_PROMPT,
+                               question + query_suffix,
+                               BasicModelConfig.inference_config(),
+                               user_prefix=query_prefix)
+
+
+def _invoke_fused_model(question: str,
+                        region: Optional[str],
+                        attributes: Dict[str, Any],
+                        deadline: Optional[Deadline]) -> Optional[Dict[str, Any]]:
+    """呼叫模型並解析 JSON，輸出不完整或無法解析時回傳 None。"""
+    try:
+        resp_body = invoke_model(BasicModelConfig.MODEL_ID, _build_request_body(question), attributes, region,
+                                 stage_client_config(_CLIENT_CONFIG, deadline, "rephrase"), deadline)
+    except Exception as exc:
+        attributes["error_code"] = telemetry.error_code(exc)
+        return None
+
+    content = resp_body.get("output", {}).get("message", {}).get("content") or [{}]
+    generated = parse_json_response(content[0].get("text", ""))
+    if not isinstance(generated, dict):
+        return None
+    rephrased = generated.get("rephrased")
+    if not isinstance(rephrased, str) or not rephrased.strip():
+        return None
+    metadata_filter, valid = parse_generated_filter(generated.get("filter"))
+    if not valid:
+        return None
+    query = generated.get("query")
+    return {
+        "rephrased": rephrased.strip(),
+        "query": query.strip() if isinstance(query, str) and query.strip() else question,
+        "metadata_filter": metadata_filter,
+    }
+
+
+def rephrase_and_extract(question: str,
+                         region: Optional[str] = None,
+                         use_cache: bool = True,
+                         use_rules: bool = True,
+                         deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+    """
+    以一次模型呼叫同時取得第一人稱的重述文字、檢索用 query 與 metadata filter：
+    {"rephrased": ..., "query": ..., "metadata_filter": ..., "mode": "fused" | "local" | "fallback"}。
+    本地規則或快取已能決定 filter 時不送出較大的 fused prompt，只以 rephrase_question 重述（mode 為 local，
+    query 為原始問題）；模型輸出無法解析時改走 rephrase_question + generate_metadata_filter 兩次呼叫
+    （mode 為 fallback，query 為原始問題）。
+    """
+    found, local_filter = lookup_local_filter(question, use_cache=use_cache, use_rules=use_rules)
+    if found:
+        return {
+            "rephrased": rephrase_question(question, region=region, deadline=deadline),
+            "query": question,
+            "metadata_filter": local_filter,
+            "mode": "local",
+        }
+
+    with telemetry.span("rephrase_and_extract", model_id=BasicModelConfig.MODEL_ID) as attributes:
+        result = _invoke_fused_model(question, region, attributes, deadline)
+        attributes["mode"] = "fused" if result is not None else "fallback"
+
+    if result is None:
+        metadata_filter = None
+        if deadline is None or deadline.remaining() >= DeadlineConfig.MIN_FILTER_SECONDS:
+            metadata_filter = generate_metadata_filter(question, use_cache=use_cache, use_rules=use_rules,
+                                                       deadline=deadline)
+        return {
+            "rephrased": rephrase_question(question, region=region, deadline=deadline),
+            "query": question,
+            "metadata_filter": metadata_filter,
+            "mode": "fallback",
+        }
+
+    if use_cache:
+        store_metadata_filter(question, result["metadata_filter"])
+    result["mode"] = "fused"
+    return result
@@ -0,0 +1,348 @@
+import json
+import math
+import os
+import threading
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy 為選用套件：pip install -e .[local-index]
+    np = None
+
+from tools.cache import TTLCache
+from tools.clients import get_client
+from tools.config import BasicModelConfig, LocalIndexConfig
+from tools.metadata import canonical_filter, matches_filter
+from tools.text import chunk_text, tokenize
+
+
+_VECTORS_FILE = "vectors.npy"
+_CHUNKS_FILE = "chunks.jsonl"
+_MANIFEST_FILE = "manifest.json"
+_CENTROIDS_FILE = "ivf_centroids.npy"
+_ASSIGNMENTS_FILE = "ivf_assignments.npy"
+
+# Bedrock Knowledge Base 資料來源的格式：<檔名> 搭配 <檔名>.metadata.json
+_DOCUMENT_SUFFIXES = (".md", ".txt")
+_METADATA_SUFFIX = ".metadata.json"
+
+_EMBED_CLIENT_CONFIG = dict(connect_timeout=5, read_timeout=30, retries={"max_attempts": 2})
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise RuntimeError("The local index backend requires numpy. Install it with: pip install numpy")
+
+
+def _normalize_rows(matrix: Any) -> Any:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+
+class HashingEmbedder:
+    """
+    不需網路、結果固定的 embedding：以 tools.text.tokenize 的詞與中文字元 n-gram 做 feature hashing，
+    再正規化為單位向量。適合測試與小型語料；要與知識庫的向量一致時改用 BedrockEmbedder。
+    """
+
+    def __init__(self, dim: int = LocalIndexConfig.DIM):
+        _require_numpy()
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def embed(self, texts: Sequence[str]) -> Any:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token, count in Counter(tokenize(text)).items():
+                # crc32 在不同 process 間結果相同（內建 hash() 會隨機化）
+                digest = zlib.crc32(token.encode("utf-8"))
+                sign = 1.0 if digest & 0x80000000 else -1.0
+                matrix[row, digest % self.dim] += sign * (1.0 + math.log(count))
+        return _normalize_rows(matrix)
+
+
+class BedrockEmbedder:
+    """以 Bedrock 的 Titan Text Embeddings 產生向量（與 Knowledge Base 使用相同模型時結果可互相比較）。"""
+
+    def __init__(self,
+                 model_id: str = LocalIndexConfig.BEDROCK_EMBED_MODEL_ID,
+                 region: str = BasicModelConfig.REGION,
+                 dim: int = 1024):
+        _require_numpy()
+        self.model_id = model_id
+        self.region = region
+        self.dim = dim
+        self.name = f"bedrock:{model_id}:{dim}"
+
+    def embed(self, texts: Sequence[str]) -> Any:
+        client = get_client("bedrock-runtime", self.region, _EMBED_CLIENT_CONFIG)
+        rows = []
+        for text in texts:
+            response = client.invoke_model(
+                modelId=self.model_id,
+                contentType="application/json",
+                accept="application/json",
+                body=json.dumps({"inputText": text, "dimensions": self.dim, "normalize": True}),
+            )
+            rows.append(json.loads(response["body"].read().decode("utf-8"))["embedding"])
+        return _normalize_rows(np.asarray(rows, dtype=np.float32).reshape(len(texts), self.dim))
+
+
+def embedder_from_name(name: str) -> Any:
+    """由 manifest 中記錄的名稱（hashing-<dim> 或 bedrock:<model_id>:<dim>）建立 embedder。"""
+    if name.startswith("hashing-"):
+        return HashingEmbedder(int(name[len("hashing-"):]))
+    if name.startswith("bedrock:"):
+        model_id, _, dim = name[len("bedrock:"):].rpartition(":")
+        return BedrockEmbedder(model_id=model_id, dim=int(dim))
+    raise ValueError(f"Unknown embedder '{name}'. Use hashing-<dim> or bedrock:<model_id>:<dim>.")
+
+
+def load_export(export_dir: str) -> List[Dict[str, Any]]:
+    """
+    讀取匯出目錄，回傳 [{"text", "metadata", "uri", "embedding"(選用)}]：
+    - 若有 chunks.jsonl，每行即為一個 chunk（可附上預先計算的 embedding）；
+    - 否則讀取 *.md / *.txt 原始文件與同名的 .metadata.json（{"metadataAttributes": {...}}），依段落切塊。
+    """
+    root = Path(export_dir)
+    chunks_path = root / _CHUNKS_FILE
+    if chunks_path.exists():
+        with chunks_path.open(encoding="utf-8") as handle:
+            records = [json.loads(line) for line in handle if line.strip()]
+        for index, record in enumerate(records):
+            if not record.get("text"):
+                raise ValueError(f"Chunk {index} in {chunks_path} has no 'text' field.")
+            record.setdefault("metadata", {})
+            record.setdefault("uri", f"local://{index}")
+        return records
+
+    records = []
+    for path in sorted(root.rglob("*")):
+        if path.suffix.lower() not in _DOCUMENT_SUFFIXES or not path.is_file():
+            continue
+        metadata: Dict[str, Any] = {}
+        sidecar = path.with_name(path.name + _METADATA_SUFFIX)
+        if sidecar.exists():
+            metadata = json.loads(sidecar.read_text(encoding="utf-8")).get("metadataAttributes", {})
+        uri = path.relative_to(root).as_posix()
+        for text in chunk_text(path.read_text(encoding="utf-8")):
+            records.append({"text": text, "metadata": dict(metadata), "uri": uri})
+    return records
+
+
+def _kmeans(vectors: Any, clusters: int, iterations: int = LocalIndexConfig.KMEANS_ITERATIONS,
+            seed: int = 0) -> Tuple[Any, Any]:
+    """spherical k-means（以內積分群），回傳 (centroids, 每個向量所屬的 cluster)。"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=clusters, replace=False)].copy()
+    assignments = np.zeros(len(vectors), dtype=np.int32)
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+        for cluster in range(clusters):
+            members = vectors[assignments == cluster]
+            # 空的 cluster 重新以隨機向量初始化
+            centroids[cluster] = members.sum(axis=0) if len(members) else vectors[rng.integers(len(vectors))]
+        centroids = _normalize_rows(centroids)
+    return centroids, assignments
+
+
+def _write_atomic(path: Path, write: Any) -> None:
+    temporary = path.with_name(path.name + ".tmp")
+    with temporary.open("wb") as handle:
+        write(handle)
+    os.replace(temporary, path)
+
+
+def build_index(export_dir: str,
+                index_dir: str = LocalIndexConfig.PATH,
+                embedder: Any = None,
+                ivf_lists: int = 0,
+                batch_size: int = 256) -> Dict[str, Any]:
+    """
+    由匯出目錄建立本地索引：vectors.npy（正規化後的 float32 矩陣）、chunks.jsonl、manifest.json，
+    ivf_lists > 0 時另外建立 IVF 的 centroids 與分群結果。回傳 manifest。
+    """
+    _require_numpy()
+    embedder = embedder or HashingEmbedder()
+    records = load_export(export_dir)
+    if not records:
+        raise ValueError(f"No chunks found in {export_dir}.")
+
+    provided = [record.get("embedding") is not None for record in records]
+    if all(provided):
+        # 預先計算的 embedding 必須與查詢時使用的 embedder 屬於同一個向量空間
+        vectors = _normalize_rows(np.asarray([record["embedding"] for record in records], dtype=np.float32))
+        if vectors.shape[1] != embedder.dim:
+            raise ValueError(f"Exported embeddings have {vectors.shape[1]} dimensions but {embedder.name} "
+                             f"produces {embedder.dim}.")
+    elif any(provided):
+        raise ValueError("Either every chunk or no chunk in the export may carry an 'embedding'.")
+    else:
+        texts = [record["text"] for record in records]
+        vectors = np.concatenate([embedder.embed(texts[start:start + batch_size])
+                                  for start in range(0, len(texts), batch_size)])
+
+    target = Path(index_dir)
+    target.mkdir(parents=True, exist_ok=True)
+    _write_atomic(target / _VECTORS_FILE, lambda handle: np.save(handle, vectors))
+
+    ivf_lists = min(ivf_lists, len(records))
+    if ivf_lists > 0:
+        centroids, assignments = _kmeans(vectors, ivf_lists)
+        _write_atomic(target / _CENTROIDS_FILE, lambda handle: np.save(handle, centroids))
+        _write_atomic(target / _ASSIGNMENTS_FILE, lambda handle: np.save(handle, assignments))
+    else:
+        for name in (_CENTROIDS_FILE, _ASSIGNMENTS_FILE):
+            (target / name).unlink(missing_ok=True)
+
+    lines = "".join(
+        json.dumps({"text": record["text"], "metadata": record["metadata"], "uri": record["uri"]},
+                   ensure_ascii=False) + "\n"
+        for record in records
+    )
+    _write_atomic(target / _CHUNKS_FILE, lambda handle: handle.write(lines.encode("utf-8")))
+
+    manifest = {
+        "count": len(records),
+        "dim": int(vectors.shape[1]),
+        "embedder": embedder.name,
+        "ivf_lists": ivf_lists,
+        "source": str(export_dir),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    # manifest 最後寫入，讀取端看到 manifest 時其餘檔案皆已就緒
+    _write_atomic(target / _MANIFEST_FILE,
+                  lambda handle: handle.write(json.dumps(manifest, indent=2, ensure_ascii=False).encode("utf-8")))
+    return manifest
+
+
+class LocalIndex:
+    """
+    以 memory-mapped 的向量矩陣提供與 bedrock-agent-runtime retrieve() 相同格式的檢索結果。
+    metadata filter 以 tools.metadata.matches_filter 在向量搜尋前套用；無法確定是否符合的 chunk 一律排除。
+    """
+
+    # retrieve 不需對本地索引做 hedge 或結果快取
+    remote = False
+
+    def __init__(self, index_dir: str = LocalIndexConfig.PATH, embedder: Any = None,
+                 nprobe: int = LocalIndexConfig.NPROBE):
+        _require_numpy()
+        root = Path(index_dir)
+        self.manifest = json.loads((root / _MANIFEST_FILE).read_text(encoding="utf-8"))
+        self.embedder = embedder or embedder_from_name(self.manifest["embedder"])
+        if self.embedder.dim != self.manifest["dim"]:
+            raise ValueError(f"Index {index_dir} has {self.manifest['dim']} dimensions but {self.embedder.name} "
+                             f"produces {self.embedder.dim}.")
+        self.vectors = np.load(root / _VECTORS_FILE, mmap_mode="r")
+        with (root / _CHUNKS_FILE).open(encoding="utf-8") as handle:
+            self.chunks = [json.loads(line) for line in handle]
+        self.nprobe = nprobe
+
+        self.centroids = None
+        self._lists: List[Any] = []
+        if self.manifest.get("ivf_lists"):
+            self.centroids = np.load(root / _CENTROIDS_FILE)
+            assignments = np.load(root / _ASSIGNMENTS_FILE)
+            order = np.argsort(assignments, kind="stable")
+            boundaries = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+            self._lists = [order[boundaries[index]:boundaries[index + 1]] for index in range(len(self.centroids))]
+        self._filter_candidates = TTLCache(LocalIndexConfig.FILTER_CACHE_SIZE, float("inf"))
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def _candidates(self, metadata_filter: Optional[dict]) -> Optional[Any]:
+        """符合 filter 的 chunk 編號（已排序）；沒有 filter 時回傳 None 代表全部。"""
+        if not metadata_filter:
+            return None
+        key = canonical_filter(metadata_filter)
+        candidates = self._filter_candidates.get(key)
+        if candidates is None:
+            candidates = np.array([index for index, chunk in enumerate(self.chunks)
+                                   if matches_filter(metadata_filter, chunk.get("metadata", {}))], dtype=np.int64)
+            self._filter_candidates.set(key, candidates)
+        return candidates
+
+    def search(self, query: str, k: int, metadata_filter: Optional[dict] = None) -> List[Tuple[int, float]]:
+        """回傳前 k 個 (chunk 編號, 餘弦相似度)，依分數由高到低排序。"""
+        query_vector = self.embedder.embed([query])[0]
+        candidates = self._candidates(metadata_filter)
+
+        if self.centroids is not None:
+            probe = np.argsort(self.centroids @ query_vector)[-self.nprobe:]
+            probed = np.sort(np.concatenate([self._lists[cluster] for cluster in probe]))
+            if candidates is not None:
+                probed = np.intersect1d(probed, candidates, assume_unique=True)
+            # 探測到的 cluster 湊不滿 k 筆時退回完整搜尋
+            if len(probed) >= k:
+                candidates = probed
+
+        if candidates is None:
+            scores = self.vectors @ query_vector
+            ids = None
+        else:
+            if len(candidates) == 0:
+                return []
+            scores = self.vectors[candidates] @ query_vector
+            ids = candidates
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(top_index if ids is None else ids[top_index]), float(scores[top_index])) for top_index in top]
+
+    def retrieve(self,
+                 knowledgeBaseId: Optional[str] = None,
+                 retrievalQuery: Optional[Dict[str, Any]] = None,
+                 retrievalConfiguration: Optional[Dict[str, Any]] = None,
+                 **_: Any) -> Dict[str, Any]:
+        """與 bedrock-agent-runtime 的 retrieve() 相同的參數與回傳格式，可直接取代 client。"""
+        vector_config = (retrievalConfiguration or {}).get("vectorSearchConfiguration", {})
+        hits = self.search((retrievalQuery or {})["text"], vector_config.get("numberOfResults", 5),
+                           vector_config.get("filter"))
+        return {
+            "retrievalResults": [
+                {
+                    "content": {"text": self.chunks[index]["text"], "type": "TEXT"},
+                    "location": _location(self.chunks[index]["uri"]),
+                    "metadata": dict(self.chunks[index].get("metadata", {})),
+                    "score": score,
+                }
+                for index, score in hits
+            ]
+        }
+
+
+def _location(uri: str) -> Dict[str, Any]:
+    if uri.startswith("s3://"):
+        return {"type": "S3", "s3Location": {"uri": uri}}
+    return {"type": "CUSTOM", "customDocumentLocation": {"id": uri}}
+
+
+_indexes: Dict[str, LocalIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(index_dir: str = LocalIndexConfig.PATH) -> LocalIndex:
+    """每個索引目錄在 process 內只載入一次。"""
+    key = os.path.abspath(index_dir)
+    index = _indexes.get(key)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(key)
+            if index is None:
+                index = LocalIndex(index_dir)
+                _indexes[key] = index
+    return index
+
+
+def clear_indexes() -> None:
+    """丟棄已載入的索引（重新建立索引後呼叫）。"""
+    with _indexes_lock:
+        _indexes.clear()
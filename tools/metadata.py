@@ -0,0 +1,240 @@
+import json
+import re
+import time
+import unicodedata
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from tools.config import MetadataRuleConfig
+
+
+# 宣告式的 metadata 規則：每個欄位可用 values（正式值 -> 別名清單）或 pattern（正規表示式）描述。
+# 新增欄位只需擴充此結構，或透過 METADATA_RULES_PATH 指向同格式的 JSON 檔。
+DEFAULT_METADATA_SCHEMA: List[Dict[str, Any]] = [
+    {
+        "key": "product_name",
+        "type": "STRING",
+        "values": {
+            "SAS Viya": ["SAS Viya", "SASViya", "Viya"],
+            "SAS": ["SAS"],
+            "DataStage": ["DataStage", "Data Stage", "IBM DataStage"],
+        },
+    },
+]
+
+MATCHED = "matched"
+NO_MATCH = "no_match"
+AMBIGUOUS = "ambiguous"
+
+
+def load_schema(path: Optional[str] = None) -> List[Dict[str, Any]]:
+    """讀取 metadata 規則；未指定路徑時使用 DEFAULT_METADATA_SCHEMA。"""
+    path = path or MetadataRuleConfig.SCHEMA_PATH
+    if not path:
+        return DEFAULT_METADATA_SCHEMA
+    with open(path, encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).casefold()
+
+
+def _alias_pattern(alias: str) -> "re.Pattern[str]":
+    # 英數別名需以非英數字元為邊界，避免 SAS 比對到 SASE 之類的字；中文字元則不受影響
+    escaped = r"\s*".join(re.escape(part) for part in _normalize(alias).split())
+    return re.compile(r"(?<![0-9a-z])" + escaped + r"(?![0-9a-z])")
+
+
+def _coerce(value: str, value_type: str) -> Any:
+    if value_type == "NUMBER":
+        return int(value) if value.isdigit() else float(value)
+    if value_type == "BOOLEAN":
+        return value.lower() in ("true", "1", "yes")
+    return value
+
+
+class RuleExtractor:
+    """
+    依宣告式規則從查詢中擷取 metadata filter。
+    同一欄位多個別名重疊時採最長比對（例如 "SAS Viya" 優先於 "SAS"）。
+    """
+
+    def __init__(self, schema: Optional[List[Dict[str, Any]]] = None):
+        self.schema = schema if schema is not None else load_schema()
+        self._fields: List[Tuple[str, str, List[Tuple["re.Pattern[str]", Any]], Optional["re.Pattern[str]"]]] = []
+        for field in self.schema:
+            value_type = field.get("type", "STRING")
+            aliases = []
+            for canonical, names in field.get("values", {}).items():
+                for name in [canonical, *names]:
+                    aliases.append((_alias_pattern(name), canonical))
+            pattern = re.compile(field["pattern"], re.IGNORECASE) if field.get("pattern") else None
+            self._fields.append((field["key"], value_type, aliases, pattern))
+
+    def _field_values(self, text: str, aliases, pattern) -> List[Any]:
+        spans: List[Tuple[int, int, Any]] = []
+        for alias_pattern, canonical in aliases:
+            for match in alias_pattern.finditer(text):
+                spans.append((match.start(), match.end(), canonical))
+        if pattern is not None:
+            for match in pattern.finditer(text):
+                value = match.group(1) if match.groups() else match.group(0)
+                spans.append((match.start(), match.end(), value))
+
+        # 最長比對優先，接受互不重疊的區段
+        spans.sort(key=lambda span: (-(span[1] - span[0]), span[0]))
+        taken: List[Tuple[int, int]] = []
+        values: List[Any] = []
+        for start, end, value in spans:
+            if any(start < t_end and t_start < end for t_start, t_end in taken):
+                continue
+            taken.append((start, end))
+            if value not in values:
+                values.append(value)
+        return values
+
+    def extract(self, query: str) -> Tuple[str, Optional[dict]]:
+        """回傳 (狀態, filter)；狀態為 MATCHED、NO_MATCH 或 AMBIGUOUS。"""
+        text = _normalize(query)
+        conditions = []
+        for key, value_type, aliases, pattern in self._fields:
+            values = self._field_values(text, aliases, pattern)
+            if len(values) > 1:
+                return AMBIGUOUS, None
+            if values:
+                conditions.append({"equals": {"key": key, "value": _coerce(str(values[0]), value_type)}})
+
+        if not conditions:
+            return NO_MATCH, None
+        if len(conditions) == 1:
+            return MATCHED, conditions[0]
+        return MATCHED, {"andAll": conditions}
+
+
+_default_extractor: Optional[RuleExtractor] = None
+
+
+def default_extractor() -> RuleExtractor:
+    global _default_extractor
+    if _default_extractor is None:
+        _default_extractor = RuleExtractor()
+    return _default_extractor
+
+
+def extract_metadata_filter(query: str) -> Tuple[bool, Optional[dict]]:
+    """
+    以規則擷取 metadata filter，回傳 (是否已決定, filter)。
+    未決定（比對結果模稜兩可，或沒有比對到任何規則且 FALLBACK_ON_NO_MATCH 開啟）時應改由 LLM 產生。
+    """
+    status, metadata_filter = default_extractor().extract(query)
+    if status == MATCHED:
+        return True, metadata_filter
+    if status == NO_MATCH and not MetadataRuleConfig.FALLBACK_ON_NO_MATCH:
+        return True, None
+    return False, None
+
+
+_COMPARATORS: Dict[str, Callable[[Any, Any], bool]] = {
+    "equals": lambda actual, expected: actual == expected,
+    "notEquals": lambda actual, expected: actual != expected,
+    "greaterThan": lambda actual, expected: actual > expected,
+    "greaterThanOrEquals": lambda actual, expected: actual >= expected,
+    "lessThan": lambda actual, expected: actual < expected,
+    "lessThanOrEquals": lambda actual, expected: actual <= expected,
+    "in": lambda actual, expected: actual in expected,
+    "notIn": lambda actual, expected: actual not in expected,
+    "startsWith": lambda actual, expected: str(actual).startswith(str(expected)),
+    "stringContains": lambda actual, expected: str(expected) in str(actual),
+    "listContains": lambda actual, expected: expected in actual,
+}
+_NEGATIVE_COMPARATORS = ("notEquals", "notIn")
+
+
+def matches_filter(metadata_filter: Optional[dict], metadata: Dict[str, Any]) -> Optional[bool]:
+    """
+    在本地以 chunk metadata 評估 Bedrock filter。
+    遇到不支援的運算子或無法確定的情況時回傳 None，呼叫端應改用伺服器端過濾。
+    """
+    if not metadata_filter:
+        return True
+    if len(metadata_filter) != 1:
+        return None
+    operator, operand = next(iter(metadata_filter.items()))
+
+    if operator in ("andAll", "orAll"):
+        results = [matches_filter(statement, metadata) for statement in operand]
+        if any(result is None for result in results):
+            return None
+        return all(results) if operator == "andAll" else any(results)
+
+    comparator = _COMPARATORS.get(operator)
+    if comparator is None or not isinstance(operand, dict):
+        return None
+    key, expected = operand.get("key"), operand.get("value")
+    if key not in metadata:
+        # 缺少欄位時否定運算的結果無法確定
+        return None if operator in _NEGATIVE_COMPARATORS else False
+    try:
+        return bool(comparator(metadata[key], expected))
+    except TypeError:
+        return None
+
+
+def canonical_filter(metadata_filter: Optional[dict]) -> str:
+    """將 filter 轉為排序過的 JSON 字串，方便比較是否相同。"""
+    return json.dumps(metadata_filter, sort_keys=True, ensure_ascii=False)
+
+
+def evaluate_rules(samples: Iterable[Dict[str, Any]],
+                   llm: Optional[Callable[[str], Optional[dict]]] = None,
+                   extractor: Optional[RuleExtractor] = None) -> Dict[str, Any]:
+    """
+    以標註資料（{"prompt": ..., "metadata_filter": ...}）評估規則擷取的正確率，
+    若提供 llm 則一併計算 LLM 的正確率與兩者的一致率。
+    """
+    extractor = extractor or default_extractor()
+    report: Dict[str, Any] = {
+        "total": 0,
+        "rule_decided": 0,
+        "rule_correct": 0,
+        "ambiguous": 0,
+        "rule_seconds": 0.0,
+        "mismatches": [],
+    }
+    if llm is not None:
+        report.update({"llm_correct": 0, "agreement": 0})
+
+    for sample in samples:
+        prompt = sample["prompt"]
+        expected = canonical_filter(sample.get("metadata_filter"))
+        report["total"] += 1
+
+        started = time.perf_counter()
+        status, rule_filter = extractor.extract(prompt)
+        report["rule_seconds"] += time.perf_counter() - started
+        decided = status == MATCHED or (status == NO_MATCH and not MetadataRuleConfig.FALLBACK_ON_NO_MATCH)
+        if decided:
+            report["rule_decided"] += 1
+            if canonical_filter(rule_filter) == expected:
+                report["rule_correct"] += 1
+            else:
+                report["mismatches"].append({"prompt": prompt, "expected": sample.get("metadata_filter"),
+                                             "rule": rule_filter})
+        else:
+            report["ambiguous"] += 1
+
+        if llm is not None:
+            llm_filter = llm(prompt)
+            if canonical_filter(llm_filter) == expected:
+                report["llm_correct"] += 1
+            if decided and canonical_filter(llm_filter) == canonical_filter(rule_filter):
+                report["agreement"] += 1
+
+    decided_count = report["rule_decided"] or 1
+    report["rule_accuracy"] = report["rule_correct"] / decided_count
+    report["coverage"] = report["rule_decided"] / (report["total"] or 1)
+    report["rule_avg_microseconds"] = report["rule_seconds"] / (report["total"] or 1) * 1e6
+    if llm is not None:
+        report["llm_accuracy"] = report["llm_correct"] / (report["total"] or 1)
+        report["agreement_rate"] = report["agreement"] / decided_count
+    return report
@@ -0,0 +1,195 @@
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+from tools import semantic_cache, telemetry
+from tools.bedrock import build_messages_body, converse
+from tools.cache import normalize_query
+from tools.clients import get_client
+from tools.config import PipelineConfig, RetrieveGenerateConfig, SemanticCacheConfig
+from tools.deadline import Deadline, stage_client_config
+from tools.retrieve import generate_metadata_filter, retrieve_from_kb
+from tools.text import estimate_tokens
+
+
+# 與 retrieve_generate 相同的生成逾時；有 deadline 時會再依剩餘預算縮短
+_CLIENT_CONFIG = dict(
+    connect_timeout=5,
+    read_timeout=120,
+    retries={"max_attempts": 2}
+)
+_SEARCH_RESULTS_PLACEHOLDER = "$search_results$"
+
+
+def _chunk_text(result: Dict[str, Any]) -> str:
+    return result.get("content", {}).get("text", "")
+
+
+def _shingles(text: str, size: int) -> Set[str]:
+    compact = "".join(normalize_query(text).split())
+    if len(compact) <= size:
+        return {compact} if compact else set()
+    return {compact[index:index + size] for index in range(len(compact) - size + 1)}
+
+
+def dedupe_results(results: Sequence[Dict[str, Any]],
+                   threshold: float = PipelineConfig.NEAR_DUPLICATE_THRESHOLD,
+                   shingle_size: int = PipelineConfig.SHINGLE_SIZE) -> List[Dict[str, Any]]:
+    """
+    依排名順序保留 chunk，移除與已保留 chunk 重複或高度重疊的段落。
+    以字元 shingle 的包含度（交集 / 較小的集合）判斷，完全相同、只差空白標點或被另一段包含的 chunk 都會被移除。
+    """
+    kept: List[Dict[str, Any]] = []
+    kept_shingles: List[Set[str]] = []
+    for result in results:
+        shingles = _shingles(_chunk_text(result), shingle_size)
+        if not shingles:
+            continue
+        if any(len(shingles & other) / min(len(shingles), len(other)) >= threshold for other in kept_shingles):
+            continue
+        kept.append(result)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def pack_context(results: Sequence[Dict[str, Any]], budget_tokens: int) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    依排名順序貪婪放入 chunk，放不下的略過並繼續嘗試後面較短的 chunk。
+    回傳 (放入的 chunk, 估計使用的 token 數)。
+    """
+    packed = []
+    used = 0
+    for result in results:
+        tokens = estimate_tokens(_chunk_text(result))
+        if used + tokens > budget_tokens:
+            continue
+        packed.append(result)
+        used += tokens
+    return packed, used
+
+
+def format_search_results(results: Sequence[Dict[str, Any]]) -> str:
+    return "\n".join(f"[{index}] {_chunk_text(result)}" for index, result in enumerate(results, start=1))
+
+
+def build_request_body(question: str, results: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    以 RetrieveGenerateConfig.PROMPT_TEMPLATE（填入檢索結果）作為 system prompt，問題作為 user 訊息。
+    檢索結果之前的指示文字固定不變，放在 prompt cache checkpoint 之前。
+    """
+    instructions, rest = RetrieveGenerateConfig.PROMPT_TEMPLATE.split(_SEARCH_RESULTS_PLACEHOLDER, 1)
+    return build_messages_body(
+        instructions,
+        question,
+        {
+            "max_new_tokens": RetrieveGenerateConfig.MAX_TOKENS,
+            "temperature": RetrieveGenerateConfig.TEMPERATURE,
+            "top_p": RetrieveGenerateConfig.TOP_P,
+        },
+        system_suffix=format_search_results(results) + rest,
+    )
+
+
+def _reference(result: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "content": result.get("content", {}),
+        "location": result.get("location", {}),
+        "metadata": result.get("metadata", {}),
+    }
+
+
+def generate_from_results(question: str,
+                          results: Sequence[Dict[str, Any]],
+                          model_arn: str,
+                          region: str = RetrieveGenerateConfig.REGION,
+                          token_budget: Optional[int] = None,
+                          deadline: Optional[Deadline] = None) -> dict:
+    """
+    以已檢索的 chunk 生成簽呈草稿：去除重複段落、依 token 預算打包後直接呼叫模型。
+    同一批檢索結果可重複用於多份草稿。回傳與 ret_and_gen 相同格式的 output / citations，另附 packing 統計。
+    以 Converse API 呼叫 model_arn，任何支援 Converse 的模型（Nova、Claude 等）皆可使用。
+    """
+    budget = PipelineConfig.CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    unique = dedupe_results(results)
+    packed, used = pack_context(unique, budget)
+    body = build_request_body(question, packed)
+
+    with telemetry.span("generate", model_id=model_arn, chunks=len(packed), context_tokens=used) as attributes:
+        resp_body = converse(model_arn, body, attributes, region,
+                             stage_client_config(_CLIENT_CONFIG, deadline, "generate"), deadline)
+
+    text = resp_body["output"]["message"]["content"][0]["text"]
+    return {
+        "output": {"text": text},
+        "citations": [{
+            "generatedResponsePart": {"textResponsePart": {"text": text, "span": {"start": 0, "end": len(text)}}},
+            "retrievedReferences": [_reference(result) for result in packed],
+        }],
+        "usage": resp_body.get("usage"),
+        "packing": {
+            "candidates": len(results),
+            "unique": len(unique),
+            "packed": len(packed),
+            "context_tokens": used,
+            "budget_tokens": budget,
+        },
+    }
+
+
+def retrieve_then_generate(prompt_question: str,
+                           knowledge_base_id: str,
+                           model_arn: str,
+                           region: str = RetrieveGenerateConfig.REGION,
+                           number_of_results: Optional[int] = None,
+                           metadata_filter: Optional[dict] = None,
+                           token_budget: Optional[int] = None,
+                           deadline: Optional[Deadline] = None,
+                           use_semantic_cache: Optional[bool] = None,
+                           retrieval_query: Optional[str] = None) -> dict:
+    """
+    ret_and_gen 的分離版本：以 retrieve_from_kb 取回候選（可使用檢索快取、規則 filter 與 rerank），
+    再以 generate_from_results 生成。number_of_results 為去重前取回的候選數。
+    retrieval_query 為檢索用的 query（例如 rephrase_and_extract 去除條件後的 query），未指定時以 prompt_question 檢索。
+    """
+    if SemanticCacheConfig.ENABLED if use_semantic_cache is None else use_semantic_cache:
+        # 語意快取需要比對 filter，先決定本次的 filter（空 dict 代表不需要過濾）
+        if metadata_filter is None:
+            metadata_filter = generate_metadata_filter(prompt_question, deadline=deadline) or {}
+        return semantic_cache.cached_draft(
+            lambda: _retrieve_then_generate(prompt_question, knowledge_base_id, model_arn, region,
+                                            number_of_results, metadata_filter, token_budget, deadline,
+                                            retrieval_query),
+            prompt_question, knowledge_base_id, model_arn, region, number_of_results, metadata_filter,
+        )
+    return _retrieve_then_generate(prompt_question, knowledge_base_id, model_arn, region, number_of_results,
+                                   metadata_filter, token_budget, deadline, retrieval_query)
+
+
+def _retrieve_then_generate(prompt_question: str,
+                            knowledge_base_id: str,
+                            model_arn: str,
+                            region: str,
+                            number_of_results: Optional[int],
+                            metadata_filter: Optional[dict],
+                            token_budget: Optional[int],
+                            deadline: Optional[Deadline],
+                            retrieval_query: Optional[str] = None) -> dict:
+    response = retrieve_from_kb(
+        retrieval_query or prompt_question,
+        knowledge_base_id,
+        region=region,
+        number_of_results=PipelineConfig.FETCH_K if number_of_results is None else number_of_results,
+        metadata_filter=metadata_filter,
+        deadline=deadline,
+    )
+    result = generate_from_results(prompt_question, response.get("retrievalResults", []), model_arn,
+                                   region=region, token_budget=token_budget, deadline=deadline)
+    if "retrieval_cache" in response:
+        result["retrieval_cache"] = response["retrieval_cache"]
+    return result
+
+
+def warm_up(region: str = RetrieveGenerateConfig.REGION, deadline: Optional[Deadline] = None) -> None:
+    """預先建立 split 模式使用的 retrieve 與 bedrock-runtime client，不會呼叫 Bedrock。"""
+    from tools.retrieve import _retrieve_client
+
+    _retrieve_client(region, deadline)
+    get_client("bedrock-runtime", region, stage_client_config(_CLIENT_CONFIG, deadline, "generate"))
@@ -0,0 +1,270 @@
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, TypeVar
+
+from tools import telemetry
+from tools.config import DEFAULT_REGION, RateLimitConfig
+from tools.deadline import Deadline, DeadlineExceeded
+
+
+T = TypeVar("T")
+
+_THROTTLE_CODES = ("ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException")
+
+
+def is_throttle(exc: BaseException) -> bool:
+    return telemetry.error_code(exc) in _THROTTLE_CODES
+
+
+class TokenBucket:
+    """每秒補充 rate 個 token、最多累積 burst 個的 token bucket，thread-safe。"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """取得一個 token；timeout 秒內取不到時回傳 False。"""
+        give_up = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+            if give_up is not None:
+                if now + wait > give_up:
+                    return False
+            time.sleep(wait)
+
+
+class AimdLimiter:
+    """
+    AIMD 並行上限：每次成功讓上限增加 1 / 上限（約每輪增加 1），遇到 throttling 時乘上 decrease_factor。
+    同一輪（成功呼叫的平均延遲，至少 min_cooldown 秒）內的多次 throttling 只減少一次，避免同時在途的呼叫把上限連續砍半。
+    """
+
+    def __init__(self, initial: float, minimum: float, maximum: float, decrease_factor: float, min_cooldown: float,
+                 alpha: float = RateLimitConfig.EWMA_ALPHA):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.min_cooldown = min_cooldown
+        self.alpha = alpha
+        self.latency: Optional[float] = None
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        give_up = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                remaining = None if give_up is None else give_up - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            self.in_flight += 1
+            return True
+
+    def release(self, outcome: str, latency: float = 0.0) -> None:
+        """outcome 為 ok、throttled 或 error（其他錯誤不調整上限）；latency 為該次呼叫的秒數。"""
+        with self._condition:
+            self.in_flight -= 1
+            if outcome == "ok":
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                self.latency = latency if self.latency is None else self.latency + self.alpha * (latency - self.latency)
+            elif outcome == "throttled":
+                now = time.monotonic()
+                if now - self._last_decrease >= max(self.min_cooldown, self.latency or 0.0):
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+            self._condition.notify_all()
+
+
+class RateLimiter:
+    """同一個 (model, operation, region) 共用的 token bucket 與 AIMD 並行上限。"""
+
+    def __init__(self, rate: float = RateLimitConfig.RATE_PER_SECOND, burst: Optional[float] = None):
+        self.bucket = TokenBucket(rate, burst or max(1.0, rate)) if rate > 0 else None
+        self.concurrency = AimdLimiter(RateLimitConfig.INITIAL_CONCURRENCY, RateLimitConfig.MIN_CONCURRENCY,
+                                       RateLimitConfig.MAX_CONCURRENCY, RateLimitConfig.DECREASE_FACTOR,
+                                       RateLimitConfig.MIN_COOLDOWN_SECONDS)
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "throttles": 0, "errors": 0, "wait_ms": 0.0}
+
+    def acquire(self, deadline: Optional[Deadline]) -> None:
+        started = time.perf_counter()
+        timeout = None if deadline is None else deadline.remaining()
+        if self.bucket is not None and not self.bucket.acquire(timeout):
+            raise DeadlineExceeded("Deadline exceeded while waiting for the Bedrock rate limit.")
+        timeout = None if deadline is None else deadline.remaining()
+        if not self.concurrency.acquire(timeout):
+            raise DeadlineExceeded("Deadline exceeded while waiting for a Bedrock concurrency slot.")
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["wait_ms"] += (time.perf_counter() - started) * 1000
+
+    def release(self, outcome: str, latency: float = 0.0) -> None:
+        self.concurrency.release(outcome, latency)
+        if outcome != "ok":
+            with self._lock:
+                self._stats["throttles" if outcome == "throttled" else "errors"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, limit=round(self.concurrency.limit, 2), in_flight=self.concurrency.in_flight)
+
+
+class RegionRouter:
+    """
+    依各 region 觀察到的延遲與 throttling 比例（指數移動平均）加權隨機選擇 region：
+    權重為 (1 - throttle 比例) / 延遲，並保留最低權重讓表現差的 region 仍會被偶爾嘗試。
+    """
+
+    def __init__(self, regions: Sequence[str], alpha: float = RateLimitConfig.EWMA_ALPHA):
+        self.regions = list(regions)
+        self.alpha = alpha
+        self._latency_ms: Dict[str, Optional[float]] = {region: None for region in self.regions}
+        self._throttle_rate: Dict[str, float] = {region: 0.0 for region in self.regions}
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    def choose(self, exclude: Sequence[str] = ()) -> str:
+        with self._lock:
+            candidates = [region for region in self.regions if region not in exclude] or self.regions
+            known = [latency for latency in self._latency_ms.values() if latency is not None]
+            # 尚未有量測的 region 以目前最快的延遲估計，讓它有機會被選到
+            default_latency = min(known) if known else 1.0
+            weights = []
+            for region in candidates:
+                latency = self._latency_ms[region] or default_latency
+                weights.append(max(0.02, 1.0 - self._throttle_rate[region]) / max(latency, 1.0))
+            return self._random.choices(candidates, weights=weights)[0]
+
+    def record(self, region: str, latency_ms: float, throttled: bool) -> None:
+        with self._lock:
+            self._throttle_rate[region] += self.alpha * ((1.0 if throttled else 0.0) - self._throttle_rate[region])
+            if not throttled:
+                previous = self._latency_ms[region]
+                self._latency_ms[region] = latency_ms if previous is None else \
+                    previous + self.alpha * (latency_ms - previous)
+
+    def stats(self) -> Dict[str, Dict[str, Optional[float]]]:
+        with self._lock:
+            return {region: {"latency_ms": self._latency_ms[region], "throttle_rate": self._throttle_rate[region]}
+                    for region in self.regions}
+
+
+_limiters: Dict[Tuple[str, str, str], RateLimiter] = {}
+_routers: Dict[Tuple[str, Tuple[str, ...]], RegionRouter] = {}
+_registry_lock = threading.Lock()
+
+
+def get_limiter(model_id: str, operation: str, region: str) -> RateLimiter:
+    key = (model_id, operation, region)
+    limiter = _limiters.get(key)
+    if limiter is None:
+        with _registry_lock:
+            limiter = _limiters.get(key)
+            if limiter is None:
+                limiter = _limiters[key] = RateLimiter(RateLimitConfig.rate_for(model_id, operation))
+    return limiter
+
+
+def _regions_for(model_id: str, region: Optional[str]) -> List[str]:
+    # 呼叫端指定的 region 一律照用；ARN（例如 foundation model 或 inference profile ARN）已綁定 region，也不做路由
+    if region is not None:
+        return [region]
+    if not RateLimitConfig.REGIONS or model_id.startswith("arn:"):
+        return [DEFAULT_REGION]
+    return list(RateLimitConfig.REGIONS)
+
+
+def _get_router(model_id: str, regions: Sequence[str]) -> RegionRouter:
+    key = (model_id, tuple(regions))
+    router = _routers.get(key)
+    if router is None:
+        with _registry_lock:
+            router = _routers.get(key)
+            if router is None:
+                router = _routers[key] = RegionRouter(regions)
+    return router
+
+
+def call(operation: str,
+         model_id: str,
+         region: Optional[str],
+         func: Callable[[str], T],
+         deadline: Optional[Deadline] = None,
+         attributes: Optional[Dict[str, Any]] = None) -> T:
+    """
+    執行 func(region)。region 為 None 代表呼叫端未指定：設定 BEDROCK_REGIONS 時依延遲與 throttling 比例選擇 region，
+    否則使用預設 region。開啟 BEDROCK_RATE_LIMIT 時在 (model, operation, region) 的 rate limit 與 AIMD 並行上限內執行。
+    有流量控制或多 region 路由時，throttling 會退避後重試（優先改試其他 region），
+    最多重試 RateLimitConfig.MAX_THROTTLE_RETRIES 次且不超過 deadline；其他錯誤直接拋出。
+    串流呼叫只在建立串流的期間佔用並行名額。
+    """
+    regions = _regions_for(model_id, region)
+    if not RateLimitConfig.ENABLED and len(regions) == 1:
+        return func(regions[0])
+
+    router = _get_router(model_id, regions) if len(regions) > 1 else None
+    tried: List[str] = []
+    attempt = 0
+    while True:
+        chosen = router.choose(exclude=tried) if router is not None else regions[0]
+        limiter = get_limiter(model_id, operation, chosen) if RateLimitConfig.ENABLED else None
+        if limiter is not None:
+            limiter.acquire(deadline)
+        started = time.perf_counter()
+        try:
+            result = func(chosen)
+        except Exception as exc:
+            throttled = is_throttle(exc)
+            elapsed = time.perf_counter() - started
+            if limiter is not None:
+                limiter.release("throttled" if throttled else "error", elapsed)
+            if router is not None:
+                router.record(chosen, elapsed * 1000, throttled)
+            if not throttled or attempt >= RateLimitConfig.MAX_THROTTLE_RETRIES:
+                raise
+            attempt += 1
+            tried.append(chosen)
+            if attributes is not None:
+                attributes["throttle_retries"] = attempt
+            # full jitter 退避；還有沒試過的 region 時立即改試
+            if router is None or len(set(tried)) >= len(regions):
+                backoff = random.uniform(0, RateLimitConfig.BACKOFF_SECONDS * (2 ** (attempt - 1)))
+                if deadline is not None and backoff >= deadline.remaining():
+                    raise
+                time.sleep(backoff)
+                tried.clear()
+            continue
+        elapsed = time.perf_counter() - started
+        if limiter is not None:
+            limiter.release("ok", elapsed)
+        if router is not None:
+            router.record(chosen, elapsed * 1000, False)
+            if attributes is not None:
+                attributes["region"] = chosen
+        return result
+
+
+def stats() -> Dict[str, Any]:
+    """回傳各 (model, operation, region) 的並行上限、呼叫與 throttling 次數，以及 region 路由的觀察值。"""
+    with _registry_lock:
+        limiters = list(_limiters.items())
+        routers = list(_routers.items())
+    return {
+        "limiters": {"/".join(key): limiter.stats() for key, limiter in limiters},
+        "regions": {model_id: router.stats() for (model_id, _), router in routers},
+    }
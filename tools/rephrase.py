@@ -1,38 +1,21 @@
-import boto3
 import json
-from botocore.config import Config
+import time
+from typing import Iterator, Optional
 
+from tools.bedrock import build_messages_body, invoke_model, invoke_model_stream, record_usage
+from tools import telemetry
 from tools.config import BasicModelConfig
+from tools.deadline import Deadline, check, stage_client_config
 
 
-def rephrase_question(question: str, region: str = BasicModelConfig.REGION) -> str:
-    """
-    接收一個問題，回傳模型重述後的問題文字。
-    """
-    # 建立 Bedrock Runtime 客戶端
-    client = boto3.client(
-        "bedrock-runtime",
-        region_name=region,
-        config=Config(
-            connect_timeout=3600,
-            read_timeout=3600,
-            retries={'max_attempts': 1}
-        )
-    )
-
-    # 準備 messages 結構（使用聊天式 API 的方式）
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"text": question}
-            ]
-        }
-    ]
+# 互動流程用的預設逾時；有 deadline 時會再依剩餘預算縮短
+_CLIENT_CONFIG = dict(
+    connect_timeout=5,
+    read_timeout=60,
+    retries={'max_attempts': 1}
+)
 
-    system_list = [
-            {
-                "text": "你現在是在 RAG 流程中扮演「問題重述 Agent」。\
+REPHRASE_SYSTEM_PROMPT = "你現在是在 RAG 流程中扮演「問題重述 Agent」。\
             使用者會輸入他對於保險公司內部簽呈（內部公文）相關的需求說明或問題。\
             你的任務是：根據使用者的輸入，將內容改寫成一段更清楚完整的敘述，\
             好像你就是使用者本人，正在向公司內部提出簽呈需求。\
@@ -44,30 +27,57 @@ def rephrase_question(question: str, region: str = BasicModelConfig.REGION) -> s
             4. 若使用者原本描述較口語或零碎，請幫忙整理成一段正式、通順、適合用在簽呈上的書面語敘述。\
             5. 不要詢問問題，不要解釋你的做法，也不要輸出任何說明文字或標題，只輸出改寫後的那一段敘述。\
             6. 請使用繁體中文。"
-            }
-    ]
 
-    # 組建 request body
-    body = {
-        "messages": messages,
-        "system":system_list,
-        "inferenceConfig": BasicModelConfig.inference_config()
-    }
 
-    # 呼叫 invoke_model
-    response = client.invoke_model(
-        modelId=BasicModelConfig.MODEL_ID,
-        contentType="application/json",
-        accept="application/json",
-        body=json.dumps(body)
-    )
+def _build_request_body(question: str) -> dict:
+    # system prompt 每次都相同，放在 prompt cache checkpoint 之前；使用者輸入是唯一會變動的部分
+    return build_messages_body(REPHRASE_SYSTEM_PROMPT, question, BasicModelConfig.inference_config())
+
+
+def rephrase_question(question: str,
+                      region: Optional[str] = None,
+                      deadline: Optional[Deadline] = None) -> str:
+    """
+    接收一個問題，回傳模型重述後的問題文字。
+    region 為 None 時使用預設 region（設定 BEDROCK_REGIONS 時由 tools.ratelimit 選擇）。
+    """
+    body = _build_request_body(question)
 
-    # 解析回傳結果
-    resp_body = json.loads(response["body"].read().decode('utf-8'))
+    with telemetry.span("rephrase", model_id=BasicModelConfig.MODEL_ID) as attributes:
+        # 呼叫 invoke_model（經過流量控制）並解析回傳結果；usage（含 prompt cache 讀寫 token）可由 tools.bedrock.last_usage() 取得
+        resp_body = invoke_model(BasicModelConfig.MODEL_ID, body, attributes, region,
+                                 stage_client_config(_CLIENT_CONFIG, deadline, "rephrase"), deadline)
     # 假設模型回傳格式為 output->message->content list, 取第一個 text
     rephrased = resp_body["output"]["message"]["content"][0]["text"]
     return rephrased
 
+
+def rephrase_question_stream(question: str,
+                             region: Optional[str] = None,
+                             deadline: Optional[Deadline] = None) -> Iterator[str]:
+    """
+    以 invoke_model_with_response_stream 重述問題，逐段 yield 模型產生的文字。
+    read_timeout 只限制每個事件之間的間隔，因此串流途中也會檢查 deadline。
+    """
+    with telemetry.span("rephrase_stream", model_id=BasicModelConfig.MODEL_ID) as attributes:
+        started = time.perf_counter()
+        response = invoke_model_stream(BasicModelConfig.MODEL_ID, _build_request_body(question), attributes, region,
+                                       stage_client_config(_CLIENT_CONFIG, deadline, "rephrase"), deadline)
+
+        for event in response["body"]:
+            check(deadline, "rephrase")
+            chunk = event.get("chunk")
+            if not chunk:
+                continue
+            payload = json.loads(chunk["bytes"].decode("utf-8"))
+            if "metadata" in payload:
+                record_usage(attributes, payload["metadata"].get("usage"))
+            # Nova 串流格式：contentBlockDelta -> delta -> text
+            text = payload.get("contentBlockDelta", {}).get("delta", {}).get("text")
+            if text:
+                attributes.setdefault("time_to_first_token_ms", (time.perf_counter() - started) * 1000)
+                yield text
+
 # if __name__ == "__main__":
 #     prompt = "我們公司的保險政策如何因應通貨膨脹？"
 #     print("Testing rephrase_question...")
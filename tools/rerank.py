@@ -0,0 +1,73 @@
+import math
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence
+
+from tools import telemetry
+from tools.config import RerankConfig
+from tools.text import tokenize
+
+
+def bm25_scores(query: str,
+                documents: Sequence[str],
+                k1: float = RerankConfig.K1,
+                b: float = RerankConfig.B) -> List[float]:
+    """
+    以 tools.text.tokenize 的字元 n-gram 計算每份文件對 query 的 BM25 分數。
+    IDF 以候選集合本身統計：只出現在少數候選中的詞（例如產品名稱）權重較高。
+    """
+    query_terms = Counter(tokenize(query))
+    if not documents or not query_terms:
+        return [0.0] * len(documents)
+
+    term_counts = [Counter(tokenize(document)) for document in documents]
+    lengths = [sum(counts.values()) for counts in term_counts]
+    average_length = (sum(lengths) / len(lengths)) or 1.0
+    total = len(documents)
+
+    # 依詞彙逐一計算所有候選的分數，只需走訪 query 中的詞
+    scores = [0.0] * total
+    norms = [k1 * (1 - b + b * length / average_length) for length in lengths]
+    for term, query_count in query_terms.items():
+        frequencies = [counts.get(term, 0) for counts in term_counts]
+        document_frequency = sum(1 for frequency in frequencies if frequency)
+        if not document_frequency:
+            continue
+        idf = math.log(1 + (total - document_frequency + 0.5) / (document_frequency + 0.5))
+        for index, frequency in enumerate(frequencies):
+            if frequency:
+                scores[index] += query_count * idf * frequency * (k1 + 1) / (frequency + norms[index])
+    return scores
+
+
+def _min_max(values: Sequence[float]) -> List[float]:
+    low, high = min(values), max(values)
+    if high == low:
+        return [1.0 if high else 0.0] * len(values)
+    return [(value - low) / (high - low) for value in values]
+
+
+def rerank_results(query: str,
+                   results: List[Dict[str, Any]],
+                   top_k: int,
+                   semantic_weight: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    依 BM25 與原本的語意分數（各自做 min-max 正規化後加權）重新排序 retrievalResults，保留前 top_k 筆。
+    每筆結果會加上 rerankScore；原本的 score 保持不變。
+    """
+    if not results:
+        return results
+    semantic_weight = RerankConfig.SEMANTIC_WEIGHT if semantic_weight is None else semantic_weight
+
+    with telemetry.span("rerank", candidates=len(results), top_k=top_k):
+        lexical = _min_max(bm25_scores(query, [result.get("content", {}).get("text", "") for result in results]))
+        semantic = _min_max([float(result.get("score") or 0.0) for result in results])
+        combined = [(1 - semantic_weight) * lexical_score + semantic_weight * semantic_score
+                    for lexical_score, semantic_score in zip(lexical, semantic)]
+        # 分數相同時維持原本（向量搜尋）的順序
+        order = sorted(range(len(results)), key=lambda index: (-combined[index], index))
+        reranked = []
+        for index in order[:top_k]:
+            result = dict(results[index])
+            result["rerankScore"] = round(combined[index], 6)
+            reranked.append(result)
+    return reranked
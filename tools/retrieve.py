@@ -1,10 +1,42 @@
-import boto3
+import copy
+import hashlib
 import json
-from typing import Any, Optional
-
-from botocore.config import Config
-
-from tools.config import BasicModelConfig, RetrieveConfig
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from tools.bedrock import build_messages_body, invoke_model, parse_json_response
+from tools.cache import SQLiteStore, TTLCache, normalize_query
+from tools import telemetry
+from tools.clients import get_client
+from tools.config import (
+    BasicModelConfig,
+    DeadlineConfig,
+    HedgeConfig,
+    LocalIndexConfig,
+    MetadataFilterCacheConfig,
+    MetadataRuleConfig,
+    RerankConfig,
+    RetrievalCacheConfig,
+    RetrieveConfig,
+    SpeculativeRetrieveConfig,
+)
+from tools.deadline import Deadline, stage_client_config
+from tools.metadata import canonical_filter, extract_metadata_filter, matches_filter
+from tools.rerank import rerank_results
+from tools.singleflight import SingleFlight, make_key
+from tools.stats import percentile
+
+
+# 互動流程用的預設逾時；有 deadline 時會再依剩餘預算縮短
+_FILTER_CLIENT_CONFIG = dict(connect_timeout=5, read_timeout=30, retries={"max_attempts": 1})
+_RETRIEVE_CLIENT_CONFIG = dict(
+    connect_timeout=5,
+    read_timeout=30,
+    retries={"max_attempts": 2}
+)
 
 
 # METADATA_FILTER_SYSTEM_PROMPT = (
@@ -151,117 +183,524 @@ QUERY_CONTEXT_TEMPLATE = """
 """
 
 
-def _generate_metadata_filter(query: str) -> Optional[dict]:
+_CACHE_MISS = object()
+_filter_flight = SingleFlight("metadata_filter")
+_retrieve_flight = SingleFlight("retrieve")
+_filter_cache = TTLCache(MetadataFilterCacheConfig.MAX_ENTRIES, MetadataFilterCacheConfig.TTL_SECONDS)
+_filter_store: Optional[SQLiteStore] = None
+_filter_store_lock = threading.Lock()
+_persistent_hits = 0
+
+
+def _get_filter_store() -> Optional[SQLiteStore]:
+    global _filter_store
+    if not MetadataFilterCacheConfig.PERSIST_PATH:
+        return None
+    if _filter_store is None:
+        with _filter_store_lock:
+            if _filter_store is None:
+                _filter_store = SQLiteStore(MetadataFilterCacheConfig.PERSIST_PATH,
+                                            MetadataFilterCacheConfig.TTL_SECONDS)
+    return _filter_store
+
+
+def lookup_local_filter(query: str, use_cache: bool = True, use_rules: bool = True) -> Tuple[bool, Optional[dict]]:
+    """
+    不呼叫模型，嘗試以規則或快取取得 filter，回傳 (是否找到, filter)。
+    """
+    if use_rules and MetadataRuleConfig.ENABLED:
+        decided, rule_filter = extract_metadata_filter(query)
+        if decided:
+            return True, rule_filter
+
+    if not (use_cache and MetadataFilterCacheConfig.ENABLED):
+        return False, None
+
+    key = normalize_query(query)
+    cached = _filter_cache.get(key, _CACHE_MISS)
+    if cached is _CACHE_MISS:
+        store = _get_filter_store()
+        if store is not None:
+            cached = store.get(key, _CACHE_MISS)
+            if cached is not _CACHE_MISS:
+                _record_persistent_hit()
+                _filter_cache.set(key, cached)
+    if cached is _CACHE_MISS:
+        return False, None
+    return True, copy.deepcopy(cached)
+
+
+def _generate_metadata_filter(query: str,
+                              use_cache: bool = True,
+                              use_rules: bool = True,
+                              deadline: Optional[Deadline] = None) -> Optional[dict]:
     """
     透過 Nova Pro 產生 metadata filter，方便 Knowledge Base vector search 使用。
+    會先以本地規則擷取，規則無法判斷時才查快取或呼叫模型。
+    相同（正規化後）的查詢會直接使用快取結果，不再呼叫模型。
+    filter 不是必要的階段：deadline 剩餘時間不足時直接回傳 None（不過濾），也不寫入快取。
     """
-    client = boto3.client(
-        "bedrock-runtime",
-        region_name=BasicModelConfig.REGION,
-        config=Config(connect_timeout=3600, read_timeout=3600, retries={"max_attempts": 1}),
-    )
+    with telemetry.span("metadata_filter") as attributes:
+        found, metadata_filter = lookup_local_filter(query, use_cache=use_cache, use_rules=use_rules)
+        attributes["source"] = "local" if found else "model"
+        if found:
+            return metadata_filter
+        if deadline is not None and deadline.remaining() < DeadlineConfig.MIN_FILTER_SECONDS:
+            attributes["source"] = "skipped"
+            return None
+        # 相同（正規化後）查詢的並行請求只呼叫一次模型
+        (metadata_filter, cacheable), coalesced = _filter_flight.do(
+            normalize_query(query),
+            lambda: _invoke_metadata_filter_model(query, attributes, deadline),
+            deadline,
+            "metadata_filter",
+        )
+        if coalesced:
+            attributes["source"] = "coalesced"
 
-    query_context = QUERY_CONTEXT_TEMPLATE.replace("<<USER_QUERY>>", query)
-
-    body = {
-        "system": [{"text": METADATA_FILTER_SYSTEM_PROMPT}],
-        "messages": [
-            {
-                "role": "user",
-                "content": [{"text": query_context}],
-            }
-        ],
-        "inferenceConfig": BasicModelConfig.inference_config(),
-    }
+    # 呼叫失敗或模型輸出無法解析時不寫入快取，下次仍會重新產生；合併的呼叫已由 leader 寫入
+    if cacheable and use_cache and not coalesced:
+        store_metadata_filter(query, metadata_filter)
+    return metadata_filter
+
+
+def store_metadata_filter(query: str, metadata_filter: Optional[dict]) -> None:
+    """將模型產生的 filter 寫入記憶體（與選用的持久化）快取。"""
+    if not MetadataFilterCacheConfig.ENABLED:
+        return
+    key = normalize_query(query)
+    _filter_cache.set(key, copy.deepcopy(metadata_filter))
+    store = _get_filter_store()
+    if store is not None:
+        store.set(key, metadata_filter)
+
+
+def _record_persistent_hit() -> None:
+    global _persistent_hits
+    with _filter_store_lock:
+        _persistent_hits += 1
 
-    try:
-        response = client.invoke_model(
-            modelId=BasicModelConfig.MODEL_ID,
-            contentType="application/json",
-            accept="application/json",
-            body=json.dumps(body),
-        )
-    except Exception:
-        return None
+
+def metadata_filter_cache_stats() -> Dict[str, int]:
+    """回傳 metadata filter 快取的 hit/miss/eviction 統計。"""
+    return dict(_filter_cache.stats(), persistent_hits=_persistent_hits)
+
+
+def clear_metadata_filter_cache() -> None:
+    """清除記憶體與持久化的 metadata filter 快取。"""
+    _filter_cache.clear()
+    store = _get_filter_store()
+    if store is not None:
+        store.clear()
+
+
+def _invoke_metadata_filter_model(query: str,
+                                  attributes: Optional[Dict[str, Any]] = None,
+                                  deadline: Optional[Deadline] = None) -> Tuple[Optional[dict], bool]:
+    """
+    實際呼叫模型產生 filter，回傳 (filter, 是否可快取)。
+    attributes 為 telemetry span 的屬性，用來記錄 token 數與被吞掉的錯誤。
+    """
+    attributes = {} if attributes is None else attributes
+    # system prompt 與 few-shot 範例（查詢之前的部分）每次都相同，放在 prompt cache checkpoint 之前
+    query_prefix, query_suffix = QUERY_CONTEXT_TEMPLATE.split("<<USER_QUERY>>", 1)
+    body = build_messages_body(METADATA_FILTER_SYSTEM_PROMPT,
+                               query + query_suffix,
+                               BasicModelConfig.inference_config(),
+                               user_prefix=query_prefix)
 
     try:
-        resp_body: dict[str, Any] = json.loads(response["body"].read().decode("utf-8"))
-    except Exception:
-        return None
+        resp_body: dict[str, Any] = invoke_model(BasicModelConfig.MODEL_ID, body, attributes, None,
+                                                 stage_client_config(_FILTER_CLIENT_CONFIG, deadline, "metadata_filter"),
+                                                 deadline)
+    except Exception as exc:
+        attributes["error_code"] = telemetry.error_code(exc)
+        return None, False
 
     content = resp_body["output"]["message"]["content"]
     if not content:
-        return None
-
-    raw_text = content[0].get("text", "").strip()
- 
-    if not raw_text:
-        return None
+        return None, False
 
-    if raw_text.startswith("```"):
-        # Remove Markdown-style fenced code blocks to keep the JSON valid.
-        if raw_text.startswith("```json"):
-            raw_text = raw_text[len("```json"):].lstrip()
-        elif raw_text.startswith("```"):
-            raw_text = raw_text[3:].lstrip()
-        if raw_text.endswith("```"):
-            raw_text = raw_text[:-3].rstrip()
+    generated = parse_json_response(content[0].get("text", ""))
+    if not isinstance(generated, dict):
+        return None, False
+    return parse_generated_filter(generated.get("filter"))
 
-    try:
-        generated = json.loads(raw_text)
-    except json.JSONDecodeError:
-        return None
 
-    metadata_filter = generated.get("filter")
+def parse_generated_filter(metadata_filter: Any) -> Tuple[Optional[dict], bool]:
+    """
+    檢查模型輸出的 filter 欄位，回傳 (filter, 是否可快取)。
+    null 表示不需要過濾（可快取）；格式錯誤時回傳 (None, False)。
+    """
     if metadata_filter in (None, "null"):
-        return None
+        return None, True
 
     if isinstance(metadata_filter, str):
         try:
             metadata_filter = json.loads(metadata_filter)
         except json.JSONDecodeError:
-            return None
+            return None, False
 
-    return metadata_filter if isinstance(metadata_filter, dict) else None
+    if not isinstance(metadata_filter, dict):
+        return None, False
+    return metadata_filter, True
 
 
 def retrieve_from_kb(question: str,
                      knowledge_base_id: str,
                      region: str = RetrieveConfig.REGION,
                      number_of_results: Optional[int] = None,
-                     metadata_filter: Optional[dict] = None) -> dict:
+                     metadata_filter: Optional[dict] = None,
+                     use_filter_cache: bool = True,
+                     speculative: Optional[bool] = None,
+                     deadline: Optional[Deadline] = None,
+                     use_retrieval_cache: bool = True,
+                     backend: Optional[str] = None,
+                     rerank: Optional[bool] = None,
+                     fetch_k: Optional[int] = None,
+                     use_rules: bool = True) -> dict:
     """
     從指定的知識庫進行檢索 (Retrieve API)，回傳最相關的內容塊。
+    未指定 metadata_filter 時依 use_filter_cache / use_rules 產生（同 generate_metadata_filter）。
+    speculative 開啟時，需要呼叫模型產生 filter 的查詢會同時先送出推測的 retrieve。
+    檢索結果會依 (knowledge base, 查詢, filter, top-k) 快取，response["retrieval_cache"] 記錄 hit / miss。
+    backend="local" 時改從 tools.local_index 的本地索引檢索（預設依 RETRIEVE_BACKEND），回傳格式相同。
+    rerank 開啟時先取 fetch_k 筆候選，再以 tools.rerank 的 BM25 重新排序後保留 number_of_results 筆。
+    相同參數的並行呼叫會合併為一次（response["coalesced"] 為 True 表示共用了其他呼叫的結果）。
     """
-    client = boto3.client(
-        "bedrock-agent-runtime",
-        region_name=region,
-        config=Config(
-            connect_timeout=300,
-            read_timeout=300,
-            retries={"max_attempts": 2}
-        )
+    key = _retrieve_flight_key(question, knowledge_base_id, region, number_of_results, metadata_filter,
+                               use_filter_cache, speculative, use_retrieval_cache, backend, rerank, fetch_k,
+                               use_rules)
+    response, coalesced = _retrieve_flight.do(
+        key,
+        lambda: _retrieve_and_rerank(question, knowledge_base_id, region, number_of_results, metadata_filter,
+                                     use_filter_cache, speculative, deadline, use_retrieval_cache, backend,
+                                     rerank, fetch_k, use_rules),
+        deadline,
+        "retrieve",
     )
+    if coalesced:
+        response["coalesced"] = True
+    return response
 
-    filter_to_use = metadata_filter if metadata_filter is not None else _generate_metadata_filter(question)
 
+def _retrieve_flight_key(question: str, knowledge_base_id: str, region: str, *options: Any) -> str:
+    """single-flight 的 key：查詢文字（去除前後空白）、knowledge base、region 與其餘參數（filter 以排序過的 JSON 表示）。"""
+    return make_key(question.strip(), knowledge_base_id, region,
+                    *[canonical_filter(option) if isinstance(option, dict) else option for option in options])
+
+
+def _retrieve_and_rerank(question: str,
+                         knowledge_base_id: str,
+                         region: str,
+                         number_of_results: Optional[int],
+                         metadata_filter: Optional[dict],
+                         use_filter_cache: bool,
+                         speculative: Optional[bool],
+                         deadline: Optional[Deadline],
+                         use_retrieval_cache: bool,
+                         backend: Optional[str],
+                         rerank: Optional[bool],
+                         fetch_k: Optional[int],
+                         use_rules: bool = True) -> dict:
+    rerank = RerankConfig.ENABLED if rerank is None else rerank
+    if not rerank:
+        return _retrieve_from_kb(question, knowledge_base_id, region, number_of_results, metadata_filter,
+                                 use_filter_cache, speculative, deadline, use_retrieval_cache, backend, use_rules)
+
+    top_k = RetrieveConfig.NUMBER_OF_RESULTS if number_of_results is None else number_of_results
+    candidates = max(top_k, RerankConfig.FETCH_K if fetch_k is None else fetch_k)
+    response = _retrieve_from_kb(question, knowledge_base_id, region, candidates, metadata_filter,
+                                 use_filter_cache, speculative, deadline, use_retrieval_cache, backend, use_rules)
+    response["retrievalResults"] = rerank_results(question, response.get("retrievalResults", []), top_k)
+    return response
+
+
+def _retrieve_from_kb(question: str,
+                      knowledge_base_id: str,
+                      region: str,
+                      number_of_results: Optional[int],
+                      metadata_filter: Optional[dict],
+                      use_filter_cache: bool,
+                      speculative: Optional[bool],
+                      deadline: Optional[Deadline],
+                      use_retrieval_cache: bool,
+                      backend: Optional[str],
+                      use_rules: bool = True) -> dict:
+    if metadata_filter is not None:
+        filter_to_use = metadata_filter
+    else:
+        if speculative is None:
+            speculative = SpeculativeRetrieveConfig.ENABLED
+        # 推測用的 filter 要在 lookup_local_filter 之前讀取：過期的項目會在查詢快取時被移除
+        guess = _filter_cache.peek(normalize_query(question)) if speculative else None
+        found, filter_to_use = lookup_local_filter(question, use_cache=use_filter_cache, use_rules=use_rules)
+        if not found:
+            if speculative:
+                return _speculative_retrieve(_retrieve_client(region, deadline, backend), question, knowledge_base_id,
+                                             number_of_results, use_filter_cache, deadline,
+                                             use_retrieval_cache, use_rules, guess)
+            filter_to_use = _generate_metadata_filter(question, use_cache=use_filter_cache, use_rules=use_rules,
+                                                      deadline=deadline)
+
+    # filter 產生完才建立 client，逾時依此時的剩餘預算計算
+    client = _retrieve_client(region, deadline, backend)
+    return _retrieve(client, question, knowledge_base_id, number_of_results, filter_to_use, deadline,
+                     use_retrieval_cache)
+
+
+def _retrieve_client(region: str, deadline: Optional[Deadline], backend: Optional[str] = None) -> Any:
+    """回傳提供 retrieve() 的物件：bedrock-agent-runtime client 或本地索引。"""
+    backend = RetrieveConfig.BACKEND if backend is None else backend
+    if backend == "local":
+        # 延後 import，未使用本地索引時不必載入 numpy
+        from tools.local_index import get_index
+        return get_index(LocalIndexConfig.PATH)
+    if backend != "kb":
+        raise ValueError(f"Unknown retrieve backend '{backend}'. Use kb or local.")
+    return get_client("bedrock-agent-runtime", region,
+                      stage_client_config(_RETRIEVE_CLIENT_CONFIG, deadline, "retrieve"))
+
+
+def _retrieve(client: Any,
+              question: str,
+              knowledge_base_id: str,
+              number_of_results: Optional[int],
+              metadata_filter: Optional[dict],
+              deadline: Optional[Deadline] = None,
+              use_cache: bool = True) -> dict:
     retrieval_configuration = RetrieveConfig.retrieval_configuration(
         number_of_results=number_of_results,
-        metadata_filter=filter_to_use,
+        metadata_filter=metadata_filter,
     )
 
-    response = client.retrieve(
-        knowledgeBaseId=knowledge_base_id,
-        retrievalQuery={"text": question},
-        retrievalConfiguration=retrieval_configuration
-    )
+    # 本地索引本身只需數毫秒，不做結果快取與 hedge
+    remote = getattr(client, "remote", True)
+    use_cache = use_cache and remote and RetrievalCacheConfig.ENABLED
+    if use_cache:
+        key = _retrieval_cache_key(client, knowledge_base_id, question, retrieval_configuration)
+        cached = _retrieval_cache.get(key)
+        if cached is not None:
+            response = copy.deepcopy(cached)
+            response["retrieval_cache"] = "hit"
+            return response
+
+    def _call() -> dict:
+        return client.retrieve(
+            knowledgeBaseId=knowledge_base_id,
+            retrievalQuery={"text": question},
+            retrievalConfiguration=retrieval_configuration
+        )
+
+    with telemetry.span("retrieve", knowledge_base_id=knowledge_base_id, filtered=bool(metadata_filter),
+                        backend="kb" if remote else "local") as attributes:
+        response = _hedged_call(_call, deadline, attributes) if remote else _call()
 
+    if use_cache:
+        stored = {name: value for name, value in response.items() if name != "ResponseMetadata"}
+        _retrieval_cache.set(key, copy.deepcopy(stored))
+        response["retrieval_cache"] = "miss"
     return response
 
 
-def generate_metadata_filter(question: str) -> Optional[dict]:
+_retrieval_cache = TTLCache(RetrievalCacheConfig.MAX_ENTRIES, RetrievalCacheConfig.TTL_SECONDS,
+                            max_bytes=RetrievalCacheConfig.MAX_BYTES)
+
+
+def _retrieval_cache_key(client: Any,
+                         knowledge_base_id: str,
+                         question: str,
+                         retrieval_configuration: Dict[str, Any]) -> Tuple[str, str, str]:
+    """
+    (knowledge base, region, 雜湊)；雜湊涵蓋查詢文字與 retrievalConfiguration
+    （filter 以排序過的 JSON 表示，另含 numberOfResults 與 search type）。
+    """
+    region = getattr(getattr(client, "meta", None), "region_name", None) or ""
+    canonical = json.dumps([question.strip(), retrieval_configuration], sort_keys=True, ensure_ascii=False)
+    return knowledge_base_id, region, hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def retrieval_cache_stats() -> Dict[str, int]:
+    """回傳 retrieve 結果快取的 hit/miss/eviction 與記憶體用量統計。"""
+    return _retrieval_cache.stats()
+
+
+def invalidate_knowledge_base(knowledge_base_id: str) -> int:
+    """
+    清除指定知識庫的所有快取檢索結果（例如 KB 完成 sync / ingestion 後呼叫），回傳清除筆數。
+    """
+    return _retrieval_cache.delete_where(lambda key: key[0] == knowledge_base_id)
+
+
+def clear_retrieval_cache() -> None:
+    _retrieval_cache.clear()
+
+
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+_hedge_lock = threading.Lock()
+_hedge_latencies: Deque[float] = deque(maxlen=HedgeConfig.WINDOW)
+_hedge_stats = {"calls": 0, "hedged": 0, "hedge_won": 0}
+
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    # 與推測檢索分開的 pool：推測的 retrieve 本身也會 hedge，共用同一個 pool 可能互相等待而卡住
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(max_workers=HedgeConfig.MAX_WORKERS,
+                                                     thread_name_prefix="kb-hedge")
+    return _hedge_executor
+
+
+def _hedge_delay() -> Optional[float]:
+    """近期 retrieve 延遲的 HedgeConfig.PERCENTILE 百分位（秒）；樣本不足時回傳 None（不 hedge）。"""
+    with _hedge_lock:
+        if len(_hedge_latencies) < HedgeConfig.MIN_SAMPLES:
+            return None
+        values = sorted(_hedge_latencies)
+    return max(HedgeConfig.MIN_DELAY_MS / 1000, percentile(values, HedgeConfig.PERCENTILE))
+
+
+def _timed(call: Callable[[], dict]) -> dict:
+    started = time.perf_counter()
+    response = call()
+    with _hedge_lock:
+        _hedge_latencies.append(time.perf_counter() - started)
+    return response
+
+
+def _hedged_call(call: Callable[[], dict],
+                 deadline: Optional[Deadline] = None,
+                 attributes: Optional[Dict[str, Any]] = None) -> dict:
+    """
+    retrieve 為冪等呼叫：第一個請求超過近期 p95 延遲仍未回應時，再送出一個相同的請求，採用先成功的結果。
+    較慢的請求無法中止，會在背景執行完畢後丟棄；依定義只有約 5% 的呼叫會多送一次。
+    """
+    attributes = {} if attributes is None else attributes
+    delay = _hedge_delay() if HedgeConfig.ENABLED else None
+    with _hedge_lock:
+        _hedge_stats["calls"] += 1
+    if delay is None or (deadline is not None and deadline.remaining() <= delay):
+        return _timed(call)
+
+    executor = _get_hedge_executor()
+    primary = executor.submit(_timed, call)
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+
+    hedge = executor.submit(_timed, call)
+    attributes["hedged"] = True
+    with _hedge_lock:
+        _hedge_stats["hedged"] += 1
+
+    pending = {primary, hedge}
+    error: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    attributes["hedge_won"] = True
+                    with _hedge_lock:
+                        _hedge_stats["hedge_won"] += 1
+                return future.result()
+            error = future.exception()
+    assert error is not None
+    raise error
+
+
+def hedge_stats() -> Dict[str, Any]:
+    """回傳 retrieve hedge 的累計次數與目前的 hedge 延遲。"""
+    delay = _hedge_delay()
+    with _hedge_lock:
+        return dict(_hedge_stats, delay_ms=None if delay is None else delay * 1000)
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+_speculation_lock = threading.Lock()
+_speculation_stats = {"requests": 0, "hit": 0, "post_filtered": 0, "miss": 0}
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=SpeculativeRetrieveConfig.MAX_WORKERS,
+                                               thread_name_prefix="kb-retrieve")
+    return _executor
+
+
+def _speculative_retrieve(client: Any,
+                          question: str,
+                          knowledge_base_id: str,
+                          number_of_results: Optional[int],
+                          use_filter_cache: bool,
+                          deadline: Optional[Deadline] = None,
+                          use_retrieval_cache: bool = True,
+                          use_rules: bool = True,
+                          guess: Optional[dict] = None) -> dict:
+    """
+    產生 filter 的同時送出推測的 retrieve：guess 為快取中（可能已過期，或因 use_filter_cache=False 而未採用）
+    的 filter 時以它過濾，否則不過濾。filter 相同時直接採用推測結果，
+    否則在本地依 metadata 過濾或重新送出過濾後的 retrieve。
+    """
+    top_k = RetrieveConfig.NUMBER_OF_RESULTS if number_of_results is None else number_of_results
+    # 未過濾時多取一些，讓本地過濾後仍可能湊滿 top_k
+    speculative_k = top_k if guess else top_k * SpeculativeRetrieveConfig.OVERFETCH_FACTOR
+
+    future = _get_executor().submit(_retrieve, client, question, knowledge_base_id, speculative_k, guess, deadline,
+                                    use_retrieval_cache)
+    actual = _generate_metadata_filter(question, use_cache=use_filter_cache, use_rules=use_rules, deadline=deadline)
+
+    if canonical_filter(actual) == canonical_filter(guess):
+        outcome = "hit"
+        response = future.result()
+        response["retrievalResults"] = response.get("retrievalResults", [])[:top_k]
+    else:
+        response = None
+        if guess is None:
+            speculative_response = future.result()
+            results = speculative_response.get("retrievalResults", [])
+            matches = [matches_filter(actual, result.get("metadata", {})) for result in results]
+            kept = [result for result, matched in zip(results, matches) if matched]
+            if None not in matches and len(kept) >= top_k:
+                outcome = "post_filtered"
+                speculative_response["retrievalResults"] = kept[:top_k]
+                response = speculative_response
+        else:
+            future.cancel()
+        if response is None:
+            outcome = "miss"
+            response = _retrieve(client, question, knowledge_base_id, number_of_results, actual, deadline,
+                                 use_retrieval_cache)
+
+    with _speculation_lock:
+        _speculation_stats["requests"] += 1
+        _speculation_stats[outcome] += 1
+    response["speculation"] = {
+        "outcome": outcome,
+        "speculated_filter": guess,
+        "metadata_filter": actual,
+    }
+    return response
+
+
+def speculation_stats() -> Dict[str, int]:
+    """回傳推測檢索的累計結果（hit / post_filtered / miss）。"""
+    with _speculation_lock:
+        return dict(_speculation_stats)
+
+
+def generate_metadata_filter(question: str,
+                             use_cache: bool = True,
+                             use_rules: bool = True,
+                             deadline: Optional[Deadline] = None) -> Optional[dict]:
     """Public helper that exposes the metadata filter generator for CLI usage."""
-    return _generate_metadata_filter(question)
+    return _generate_metadata_filter(question, use_cache=use_cache, use_rules=use_rules, deadline=deadline)
 
 # if __name__ == "__main__":
 #     KB_ID = "YOUR_KB_ID"
@@ -1,30 +1,92 @@
-import boto3
 import json
-from typing import Optional
+import time
+from typing import Any, Dict, Iterable, Iterator, Optional
 
-from botocore.config import Config
+from tools import semantic_cache, telemetry
+from tools.clients import get_client
+from tools.config import RetrieveGenerateConfig, SemanticCacheConfig
+from tools.deadline import Deadline, check, stage_client_config
+from tools.metadata import canonical_filter
+from tools.singleflight import SingleFlight, make_key
 
-from tools.config import RetrieveGenerateConfig
+
+# 互動流程用的預設逾時；有 deadline 時會再依剩餘預算縮短
+_CLIENT_CONFIG = dict(
+    connect_timeout=5,
+    read_timeout=120,
+    retries={"max_attempts": 2}
+)
+_flight = SingleFlight("ret_and_gen")
 
 
 def ret_and_gen(prompt_question: str,
                 knowledge_base_id: str,
                 model_arn: str,
                 region: str = RetrieveGenerateConfig.REGION,
-                number_of_results: Optional[int] = None) -> dict:
+                number_of_results: Optional[int] = None,
+                deadline: Optional[Deadline] = None,
+                metadata_filter: Optional[dict] = None,
+                use_semantic_cache: Optional[bool] = None) -> dict:
     """
     使用 RetrieveAndGenerate API：從知識庫檢索，再生成簽呈草稿。
-    回傳 dict，包含生成文本與引用來源。
+    回傳 dict，包含生成文本與引用來源。metadata_filter 會套用在檢索階段。
+    相同參數的並行呼叫會合併為一次（response["coalesced"] 為 True 表示共用了其他呼叫的結果）。
+    use_semantic_cache 為 None 時依 SemanticCacheConfig.ENABLED 決定是否先查詢語意相近的草稿；
+    開啟時若未指定 metadata_filter，會先產生 filter，同時用於快取比對與檢索。
     """
-    client = boto3.client(
-        "bedrock-agent-runtime",
-        region_name=region,
-        config=Config(
-            connect_timeout=300,
-            read_timeout=300,
-            retries={"max_attempts": 2}
+    if SemanticCacheConfig.ENABLED if use_semantic_cache is None else use_semantic_cache:
+        # 語意快取需要比對 filter，先決定本次的 filter（空 dict 代表不需要過濾）；只在開啟快取時才載入 tools.retrieve
+        if metadata_filter is None:
+            from tools.retrieve import generate_metadata_filter
+            metadata_filter = generate_metadata_filter(prompt_question, deadline=deadline) or {}
+        return semantic_cache.cached_draft(
+            lambda: _coalesced_ret_and_gen(prompt_question, knowledge_base_id, model_arn, region,
+                                           number_of_results, deadline, metadata_filter),
+            prompt_question, knowledge_base_id, model_arn, region, number_of_results, metadata_filter,
         )
+    return _coalesced_ret_and_gen(prompt_question, knowledge_base_id, model_arn, region, number_of_results,
+                                  deadline, metadata_filter)
+
+
+def _coalesced_ret_and_gen(prompt_question: str,
+                           knowledge_base_id: str,
+                           model_arn: str,
+                           region: str,
+                           number_of_results: Optional[int],
+                           deadline: Optional[Deadline],
+                           metadata_filter: Optional[dict]) -> dict:
+    key = _flight_key(prompt_question, knowledge_base_id, model_arn, region, number_of_results, metadata_filter)
+    response, coalesced = _flight.do(
+        key,
+        lambda: _ret_and_gen(prompt_question, knowledge_base_id, model_arn, region, number_of_results,
+                             deadline, metadata_filter),
+        deadline,
+        "generate",
     )
+    if coalesced:
+        response["coalesced"] = True
+    return response
+
+
+def _flight_key(prompt_question: str,
+                knowledge_base_id: str,
+                model_arn: str,
+                region: str,
+                number_of_results: Optional[int],
+                metadata_filter: Optional[dict]) -> str:
+    # 只合併空白差異；大小寫或標點不同的問題仍可能得到不同的草稿
+    return make_key(" ".join(prompt_question.split()), knowledge_base_id, model_arn, region,
+                    number_of_results, canonical_filter(metadata_filter) if metadata_filter else None)
+
+
+def _ret_and_gen(prompt_question: str,
+                 knowledge_base_id: str,
+                 model_arn: str,
+                 region: str,
+                 number_of_results: Optional[int],
+                 deadline: Optional[Deadline],
+                 metadata_filter: Optional[dict]) -> dict:
+    client = get_client("bedrock-agent-runtime", region, stage_client_config(_CLIENT_CONFIG, deadline, "generate"))
 
     # 準備輸入 prompt
     input_payload = {"text": prompt_question}
@@ -34,11 +96,88 @@ def ret_and_gen(prompt_question: str,
         knowledge_base_id=knowledge_base_id,
         model_arn=model_arn,
         number_of_results=number_of_results,
+        metadata_filter=metadata_filter,
     )
 
-    response = client.retrieve_and_generate(
-        input=input_payload,
-        retrieveAndGenerateConfiguration=retrieve_and_gen_config
+    with telemetry.span("retrieve_and_generate", knowledge_base_id=knowledge_base_id):
+        response = client.retrieve_and_generate(
+            input=input_payload,
+            retrieveAndGenerateConfiguration=retrieve_and_gen_config
+        )
+
+    return response
+
+
+def warm_up(region: str = RetrieveGenerateConfig.REGION, deadline: Optional[Deadline] = None) -> Any:
+    """
+    預先建立（並放入 pool）RetrieveAndGenerate 使用的 client，不會呼叫 Bedrock。
+    供 Lambda 在 init 階段或 warm-up 事件時使用；傳入 deadline 時會建立該預算對應逾時級距的 client。
+    """
+    return get_client("bedrock-agent-runtime", region, stage_client_config(_CLIENT_CONFIG, deadline, "generate"))
+
+
+def ret_and_gen_stream(prompt_question: str,
+                       knowledge_base_id: str,
+                       model_arn: str,
+                       region: str = RetrieveGenerateConfig.REGION,
+                       number_of_results: Optional[int] = None,
+                       deadline: Optional[Deadline] = None,
+                       metadata_filter: Optional[dict] = None) -> Iterator[Dict[str, Any]]:
+    """
+    使用 RetrieveAndGenerateStream API，邊生成邊回傳事件：
+    {"type": "session", "sessionId": ...}、{"type": "text", "text": ...}、{"type": "citation", "citation": ...}。
+    """
+    client = get_client("bedrock-agent-runtime", region, stage_client_config(_CLIENT_CONFIG, deadline, "generate"))
+
+    retrieve_and_gen_config = RetrieveGenerateConfig.retrieve_and_gen_config(
+        knowledge_base_id=knowledge_base_id,
+        model_arn=model_arn,
+        number_of_results=number_of_results,
+        metadata_filter=metadata_filter,
     )
 
-    return response
\ No newline at end of file
+    with telemetry.span("retrieve_and_generate_stream", knowledge_base_id=knowledge_base_id) as attributes:
+        started = time.perf_counter()
+        response = client.retrieve_and_generate_stream(
+            input={"text": prompt_question},
+            retrieveAndGenerateConfiguration=retrieve_and_gen_config
+        )
+
+        session_id = response.get("sessionId")
+        if session_id:
+            yield {"type": "session", "sessionId": session_id}
+
+        for event in response["stream"]:
+            check(deadline, "generate")
+            if "output" in event:
+                text = event["output"].get("text")
+                if text:
+                    attributes.setdefault("time_to_first_token_ms", (time.perf_counter() - started) * 1000)
+                    yield {"type": "text", "text": text}
+            elif "citation" in event:
+                citation = event["citation"]
+                # 與非串流回應的 citations 格式一致，只保留 generatedResponsePart / retrievedReferences
+                yield {
+                    "type": "citation",
+                    "citation": {
+                        "generatedResponsePart": citation.get("generatedResponsePart", {}),
+                        "retrievedReferences": citation.get("retrievedReferences", []),
+                    },
+                }
+
+
+def collect_stream(events: Iterable[Dict[str, Any]]) -> dict:
+    """將 ret_and_gen_stream 的事件組回與 ret_and_gen 相同格式的回應。"""
+    texts = []
+    citations = []
+    response: Dict[str, Any] = {}
+    for event in events:
+        if event["type"] == "text":
+            texts.append(event["text"])
+        elif event["type"] == "citation":
+            citations.append(event["citation"])
+        elif event["type"] == "session":
+            response["sessionId"] = event["sessionId"]
+    response["output"] = {"text": "".join(texts)}
+    response["citations"] = citations
+    return response
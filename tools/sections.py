@@ -0,0 +1,256 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from tools import semantic_cache, telemetry
+from tools.bedrock import build_messages_body, converse
+from tools.config import PipelineConfig, RetrieveGenerateConfig, SectionConfig, SemanticCacheConfig
+from tools.deadline import Deadline, DeadlineExceeded, check, stage_client_config
+from tools.pipeline import _CLIENT_CONFIG, _reference, dedupe_results, format_search_results, pack_context
+from tools.retrieve import generate_metadata_filter, retrieve_from_kb
+
+
+# 四個段落共用、固定不變的指示（放在 prompt cache checkpoint 之前）
+SECTION_SYSTEM_PROMPT = (
+    "你是保險公司內部的文件助手，負責將使用者所輸入的需求，撰寫成一份內部簽呈草稿。"
+    "請以正式公文語氣、繁體中文完成。"
+    "草稿分為【主旨】、【內文】、【建議附件】、【審核流程】四大項目，其他項目會另外撰寫，"
+    "這次只需要輸出指定項目的內容，不要輸出項目標題或其他項目。"
+)
+SECTION_CONTEXT_TEMPLATE = (
+    "\n\n以下為來自知識庫的檢索結果：\n"
+    "{search_results}\n"
+    "\n"
+    "請根據上述檢索結果撰寫草稿，並且保留使用者輸入的關鍵資訊，不新增使用者未提及的內容。\n"
+    "本次撰寫的項目：{heading}——{instruction}\n"
+    "{heading}內容："
+)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=SectionConfig.MAX_WORKERS, thread_name_prefix="kb-section")
+    return _executor
+
+
+def build_section_body(question: str,
+                       results: Sequence[Dict[str, Any]],
+                       heading: str,
+                       instruction: str,
+                       max_tokens: int) -> Dict[str, Any]:
+    return build_messages_body(
+        SECTION_SYSTEM_PROMPT,
+        question,
+        {
+            "max_new_tokens": max_tokens,
+            "temperature": RetrieveGenerateConfig.TEMPERATURE,
+            "top_p": RetrieveGenerateConfig.TOP_P,
+        },
+        system_suffix=SECTION_CONTEXT_TEMPLATE.format(search_results=format_search_results(results),
+                                                      heading=heading, instruction=instruction),
+    )
+
+
+def _strip_heading(text: str, heading: str) -> str:
+    """模型有時仍會重複項目標題（例如「一、【主旨】」或「【主旨】」），移除後只保留內容。"""
+    text = text.strip()
+    label = heading[heading.index("【"):] if "【" in heading else heading
+    for prefix in (heading, label):
+        if text.startswith(prefix):
+            return text[len(prefix):].lstrip("：: \n")
+    return text
+
+
+def _generate_section(question: str,
+                      packed: Sequence[Dict[str, Any]],
+                      index: int,
+                      model_arn: str,
+                      region: str,
+                      deadline: Optional[Deadline]) -> Dict[str, Any]:
+    heading, instruction, max_tokens = SectionConfig.SECTIONS[index]
+    body = build_section_body(question, packed, heading, instruction, max_tokens)
+    started = time.perf_counter()
+    with telemetry.span("generate_section", model_id=model_arn, section=index) as attributes:
+        resp_body = converse(model_arn, body, attributes, region,
+                             stage_client_config(_CLIENT_CONFIG, deadline, "generate"), deadline)
+    return {
+        "index": index,
+        "heading": heading,
+        "text": _strip_heading(resp_body["output"]["message"]["content"][0]["text"], heading),
+        "latency_ms": (time.perf_counter() - started) * 1000,
+        "usage": resp_body.get("usage"),
+    }
+
+
+def _format_section(section: Dict[str, Any]) -> str:
+    return f"{section['heading']}\n{section['text']}"
+
+
+def generate_sections_stream(question: str,
+                             results: Sequence[Dict[str, Any]],
+                             model_arn: str,
+                             region: str = RetrieveGenerateConfig.REGION,
+                             token_budget: Optional[int] = None,
+                             deadline: Optional[Deadline] = None) -> Iterator[Dict[str, Any]]:
+    """
+    以同一批檢索結果同時生成 SectionConfig.SECTIONS 的每個段落（各有自己的 token 上限），耗時約等於最慢的段落。
+    事件：
+    - {"type": "section", "index", "heading", "text", "latency_ms", "usage"}：依完成順序，每個段落完成時送出；
+    - {"type": "text", "text"}：依標準順序，前面的段落都完成後送出（與 ret_and_gen_stream 相同，串接即為完整草稿）；
+    - 最後為每個段落的 {"type": "citation", "citation"}，span 對應完整草稿中的位置。
+    任一段落失敗時取消尚未開始的段落並拋出該例外；deadline 到期時拋出 DeadlineExceeded。
+    """
+    budget = PipelineConfig.CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    packed, used = pack_context(dedupe_results(results), budget)
+    references = [_reference(result) for result in packed]
+
+    with telemetry.span("generate_sections", model_id=model_arn, sections=len(SectionConfig.SECTIONS),
+                        chunks=len(packed), context_tokens=used):
+        futures: Dict[Future, int] = {
+            _get_executor().submit(_generate_section, question, packed, index, model_arn, region, deadline): index
+            for index in range(len(SectionConfig.SECTIONS))
+        }
+        completed: Dict[int, Dict[str, Any]] = {}
+        emitted = 0
+        offset = 0
+        citations: List[Dict[str, Any]] = []
+        pending = set(futures)
+        try:
+            while pending:
+                timeout = None if deadline is None else deadline.remaining()
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    raise DeadlineExceeded("Deadline exceeded while generating draft sections.")
+                for future in done:
+                    section = future.result()
+                    completed[section["index"]] = section
+                    yield dict(section, type="section")
+                # 依標準順序送出已完成的連續段落，段落之間以空行分隔（與單次生成的草稿格式相同）
+                while emitted in completed:
+                    text = ("\n\n" if emitted else "") + _format_section(completed[emitted])
+                    start = offset + (2 if emitted else 0)
+                    offset += len(text)
+                    citations.append({
+                        "generatedResponsePart": {"textResponsePart": {
+                            "text": _format_section(completed[emitted]), "span": {"start": start, "end": offset},
+                        }},
+                        "retrievedReferences": references,
+                    })
+                    yield {"type": "text", "text": text}
+                    emitted += 1
+        finally:
+            for future in pending:
+                future.cancel()
+
+    for citation in citations:
+        yield {"type": "citation", "citation": citation}
+
+
+def collect_sections(events: Iterable[Dict[str, Any]]) -> dict:
+    """將 generate_sections_stream 的事件組回與 generate_from_results 相同格式的回應，另附各段落的延遲。"""
+    texts = []
+    citations = []
+    sections = []
+    usage: Dict[str, int] = {}
+    for event in events:
+        if event["type"] == "text":
+            texts.append(event["text"])
+        elif event["type"] == "citation":
+            citations.append(event["citation"])
+        elif event["type"] == "section":
+            sections.append({"index": event["index"], "heading": event["heading"],
+                             "latency_ms": event["latency_ms"]})
+            for key, value in (event.get("usage") or {}).items():
+                if isinstance(value, int):
+                    usage[key] = usage.get(key, 0) + value
+    return {
+        "output": {"text": "".join(texts)},
+        "citations": citations,
+        "usage": usage,
+        "sections": sorted(sections, key=lambda section: section["index"]),
+    }
+
+
+def generate_sections(question: str,
+                      results: Sequence[Dict[str, Any]],
+                      model_arn: str,
+                      region: str = RetrieveGenerateConfig.REGION,
+                      token_budget: Optional[int] = None,
+                      deadline: Optional[Deadline] = None) -> dict:
+    """generate_sections_stream 的非串流版本。"""
+    return collect_sections(generate_sections_stream(question, results, model_arn, region, token_budget, deadline))
+
+
+def _retrieve(query: str,
+              knowledge_base_id: str,
+              region: str,
+              number_of_results: Optional[int],
+              metadata_filter: Optional[dict],
+              deadline: Optional[Deadline]) -> dict:
+    return retrieve_from_kb(
+        query,
+        knowledge_base_id,
+        region=region,
+        number_of_results=PipelineConfig.FETCH_K if number_of_results is None else number_of_results,
+        metadata_filter=metadata_filter,
+        deadline=deadline,
+    )
+
+
+def retrieve_then_generate_sections_stream(prompt_question: str,
+                                           knowledge_base_id: str,
+                                           model_arn: str,
+                                           region: str = RetrieveGenerateConfig.REGION,
+                                           number_of_results: Optional[int] = None,
+                                           metadata_filter: Optional[dict] = None,
+                                           token_budget: Optional[int] = None,
+                                           deadline: Optional[Deadline] = None,
+                                           retrieval_query: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    檢索一次後以 generate_sections_stream 同時生成各段落（事件格式見該函式）。
+    retrieval_query 為檢索用的 query，未指定時以 prompt_question 檢索。
+    """
+    response = _retrieve(retrieval_query or prompt_question, knowledge_base_id, region, number_of_results, metadata_filter, deadline)
+    check(deadline, "generate")
+    yield from generate_sections_stream(prompt_question, response.get("retrievalResults", []), model_arn,
+                                        region=region, token_budget=token_budget, deadline=deadline)
+
+
+def retrieve_then_generate_sections(prompt_question: str,
+                                    knowledge_base_id: str,
+                                    model_arn: str,
+                                    region: str = RetrieveGenerateConfig.REGION,
+                                    number_of_results: Optional[int] = None,
+                                    metadata_filter: Optional[dict] = None,
+                                    token_budget: Optional[int] = None,
+                                    deadline: Optional[Deadline] = None,
+                                    use_semantic_cache: Optional[bool] = None,
+                                    retrieval_query: Optional[str] = None) -> dict:
+    """
+    sections 模式的 ret_and_gen：檢索一次，四個段落同時生成後依標準順序組成草稿，
+    回傳與 ret_and_gen 相同格式的 output / citations，另附各段落的延遲。
+    retrieval_query 為檢索用的 query，未指定時以 prompt_question 檢索。
+    """
+    def _generate() -> dict:
+        response = _retrieve(retrieval_query or prompt_question, knowledge_base_id, region, number_of_results, metadata_filter, deadline)
+        check(deadline, "generate")
+        result = generate_sections(prompt_question, response.get("retrievalResults", []), model_arn,
+                                   region=region, token_budget=token_budget, deadline=deadline)
+        if "retrieval_cache" in response:
+            result["retrieval_cache"] = response["retrieval_cache"]
+        return result
+
+    if SemanticCacheConfig.ENABLED if use_semantic_cache is None else use_semantic_cache:
+        # 語意快取需要比對 filter，先決定本次的 filter（空 dict 代表不需要過濾）
+        if metadata_filter is None:
+            metadata_filter = generate_metadata_filter(prompt_question, deadline=deadline) or {}
+        return semantic_cache.cached_draft(_generate, prompt_question, knowledge_base_id, model_arn, region,
+                                           number_of_results, metadata_filter)
+    return _generate()
@@ -0,0 +1,244 @@
+import copy
+import re
+import threading
+import time
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from tools import telemetry
+from tools.config import SemanticCacheConfig
+from tools.metadata import MATCHED, canonical_filter, default_extractor
+
+
+Scope = Tuple[str, str, str, Optional[int], str]
+
+# 只屬於原本那次呼叫的欄位，不隨快取的草稿回傳
+_PER_CALL_FIELDS = ("sessionId", "ResponseMetadata", "retrieval_cache", "coalesced")
+
+# 金額、年度等數字（含千分位與小數點）
+_NUMBER_PATTERN = re.compile(r"\d+(?:[,.]\d+)*")
+
+
+def _scope(knowledge_base_id: str,
+           model_arn: str,
+           region: str,
+           number_of_results: Optional[int],
+           metadata_filter: Optional[dict]) -> Scope:
+    # None 與 {} 都代表不過濾；filter 不同的草稿一律視為不同
+    return (knowledge_base_id, model_arn, region, number_of_results,
+            canonical_filter(metadata_filter) if metadata_filter else "")
+
+
+def _guard(prompt: str) -> Tuple[Tuple[str, ...], str, Tuple[str, ...]]:
+    """
+    必須完全相同才可共用草稿的部分：數字（金額、年度等）、規則擷取到的產品等 metadata，
+    以及 SemanticCacheConfig.GUARD_TERMS 中出現的詞（例如雲端／地端）。
+    """
+    # 全形先轉成半形；千分位逗號不影響比對
+    text = unicodedata.normalize("NFKC", prompt)
+    numbers = tuple(number.replace(",", "") for number in _NUMBER_PATTERN.findall(text))
+    status, rule_filter = default_extractor().extract(text)
+    folded = text.casefold()
+    terms = tuple(term for term in SemanticCacheConfig.GUARD_TERMS if term.casefold() in folded)
+    return numbers, canonical_filter(rule_filter) if status == MATCHED else status, terms
+
+
+class SemanticDraftCache:
+    """
+    以 prompt 的 embedding 查詢語意相近的已生成草稿。
+    向量存放在預先配置的矩陣中，一次矩陣乘法算出與所有項目的 cosine 相似度；
+    只比對 (knowledge base, 模型, region, top-k, metadata filter) 完全相同，且 prompt 中的數字、產品名稱與
+    GUARD_TERMS（見 _guard）也完全相同的項目：hashing embedder 對只差在這些詞的 prompt 相似度很高
+    （例如只差產品名稱約 0.91，高於改寫措辭的 0.85–0.88），單靠門檻無法區分，但草稿內容不能共用。
+    滿了之後淘汰最久未使用的項目，過期項目在查詢時略過、寫入時優先覆蓋。
+    """
+
+    def __init__(self,
+                 embedder: Any,
+                 threshold: float = SemanticCacheConfig.THRESHOLD,
+                 max_entries: int = SemanticCacheConfig.MAX_ENTRIES,
+                 ttl_seconds: float = SemanticCacheConfig.TTL_SECONDS):
+        import numpy as np
+
+        self._np = np
+        self.embedder = embedder
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._vectors = np.zeros((max_entries, embedder.dim), dtype=np.float32)
+        # 每個 slot 的 scope 編號（-1 為空）、到期時間與最後使用時間，與 _vectors 同列對應
+        self._scope_ids = np.full(max_entries, -1, dtype=np.int64)
+        self._expires = np.zeros(max_entries, dtype=np.float64)
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._entries: List[Optional[Dict[str, Any]]] = [None] * max_entries
+        # (scope, _guard(prompt)) → scope 編號；最後一個 slot 被覆蓋或清除時一併移除
+        self._scope_index: Dict[Tuple[Scope, Any], int] = {}
+        self._next_scope_id = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0}
+
+    def _embed(self, prompt: str) -> Any:
+        return self.embedder.embed([prompt])[0]
+
+    def lookup(self, prompt: str, scope: Scope) -> Optional[Dict[str, Any]]:
+        """回傳 {"response", "prompt", "similarity"}（response 為複本）；沒有夠相近的草稿時回傳 None。"""
+        vector = self._embed(prompt)
+        np = self._np
+        now = time.monotonic()
+        key = (scope, _guard(prompt))
+        with self._lock:
+            scope_id = self._scope_index.get(key)
+            if scope_id is None:
+                self._stats["misses"] += 1
+                return None
+            similarities = self._vectors @ vector
+            eligible = (self._scope_ids == scope_id) & (self._expires > now)
+            similarities[~eligible] = -1.0
+            slot = int(np.argmax(similarities))
+            similarity = float(similarities[slot])
+            if similarity < self.threshold:
+                self._stats["misses"] += 1
+                return None
+            self._last_used[slot] = now
+            self._stats["hits"] += 1
+            entry = self._entries[slot]
+            return {"response": copy.deepcopy(entry["response"]), "prompt": entry["prompt"],
+                    "similarity": similarity}
+
+    def store(self, prompt: str, scope: Scope, response: Dict[str, Any]) -> None:
+        vector = self._embed(prompt)
+        np = self._np
+        now = time.monotonic()
+        key = (scope, _guard(prompt))
+        entry = {"prompt": prompt, "key": key, "response": copy.deepcopy(response)}
+        with self._lock:
+            scope_id = self._scope_index.get(key)
+            if scope_id is None:
+                scope_id = self._scope_index[key] = self._next_scope_id
+                self._next_scope_id += 1
+            empty = np.flatnonzero((self._scope_ids < 0) | (self._expires <= now))
+            if empty.size:
+                slot = int(empty[0])
+            else:
+                slot = int(np.argmin(self._last_used))
+                self._stats["evictions"] += 1
+            replaced = self._entries[slot]
+            self._vectors[slot] = vector
+            self._scope_ids[slot] = scope_id
+            self._expires[slot] = now + self.ttl_seconds
+            self._last_used[slot] = now
+            self._entries[slot] = entry
+            self._stats["stores"] += 1
+            if replaced is not None and self._scope_index.get(replaced["key"]) not in self._scope_ids:
+                # 被覆蓋的是該 scope 的最後一筆
+                del self._scope_index[replaced["key"]]
+
+    def invalidate(self, knowledge_base_id: Optional[str] = None) -> int:
+        """清除指定知識庫（None 為全部）的草稿，回傳清除筆數。"""
+        with self._lock:
+            keys = [key for key in self._scope_index
+                    if knowledge_base_id is None or key[0][0] == knowledge_base_id]
+            slots = self._np.flatnonzero(self._np.isin(self._scope_ids, [self._scope_index[key] for key in keys]))
+            for slot in slots:
+                self._entries[slot] = None
+            self._scope_ids[slots] = -1
+            for key in keys:
+                del self._scope_index[key]
+            self._stats["invalidations"] += len(slots)
+            return len(slots)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return dict(self._stats,
+                        entries=int((self._scope_ids >= 0).sum()),
+                        hit_rate=self._stats["hits"] / lookups if lookups else 0.0)
+
+
+_cache: Optional[SemanticDraftCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> SemanticDraftCache:
+    """依 SemanticCacheConfig 建立（只建立一次）共用的快取；embedder 名稱格式同 tools.local_index.embedder_from_name。"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                from tools.local_index import embedder_from_name
+
+                _cache = SemanticDraftCache(embedder_from_name(SemanticCacheConfig.EMBEDDER))
+    return _cache
+
+
+def set_cache(cache: Optional[SemanticDraftCache]) -> None:
+    """替換共用的快取（例如使用自訂 embedder）；傳入 None 會在下次使用時依設定重新建立。"""
+    global _cache
+    with _cache_lock:
+        _cache = cache
+
+
+def cached_draft(generate: Callable[[], Dict[str, Any]],
+                 prompt_question: str,
+                 knowledge_base_id: str,
+                 model_arn: str,
+                 region: str,
+                 number_of_results: Optional[int] = None,
+                 metadata_filter: Optional[dict] = None) -> Dict[str, Any]:
+    """
+    先以語意快取查詢相近的草稿，命中時直接回傳（response["semantic_cache"] 記錄相似度與原本的問題），
+    否則呼叫 generate() 生成並寫入快取。sessionId 等只屬於原本那次呼叫的欄位不會寫入快取。
+    """
+    response = lookup_draft(prompt_question, knowledge_base_id, model_arn, region, number_of_results, metadata_filter)
+    if response is not None:
+        return response
+    response = generate()
+    store_draft(response, prompt_question, knowledge_base_id, model_arn, region, number_of_results, metadata_filter)
+    return response
+
+
+def lookup_draft(prompt_question: str,
+                 knowledge_base_id: str,
+                 model_arn: str,
+                 region: str,
+                 number_of_results: Optional[int] = None,
+                 metadata_filter: Optional[dict] = None) -> Optional[Dict[str, Any]]:
+    """cached_draft 的查詢部分：命中時回傳草稿的複本（附 response["semantic_cache"]），否則回傳 None。"""
+    cache = get_cache()
+    scope = _scope(knowledge_base_id, model_arn, region, number_of_results, metadata_filter)
+    with telemetry.span("semantic_cache", knowledge_base_id=knowledge_base_id) as attributes:
+        hit = cache.lookup(prompt_question, scope)
+        attributes["hit"] = hit is not None
+        if hit is not None:
+            attributes["similarity"] = hit["similarity"]
+    telemetry.metric("semantic_cache_hit", 1 if hit is not None else 0, knowledge_base_id=knowledge_base_id)
+    if hit is None:
+        return None
+    response = hit["response"]
+    response["semantic_cache"] = {"hit": True, "similarity": round(hit["similarity"], 4),
+                                  "matched_prompt": hit["prompt"]}
+    return response
+
+
+def store_draft(response: Dict[str, Any],
+                prompt_question: str,
+                knowledge_base_id: str,
+                model_arn: str,
+                region: str,
+                number_of_results: Optional[int] = None,
+                metadata_filter: Optional[dict] = None) -> None:
+    """cached_draft 的寫入部分：只寫入有生成文本、且不是合併呼叫得到的草稿（合併的結果已由 leader 寫入）。"""
+    if response.get("output", {}).get("text") and not response.get("coalesced"):
+        stored = {key: value for key, value in response.items() if key not in _PER_CALL_FIELDS}
+        scope = _scope(knowledge_base_id, model_arn, region, number_of_results, metadata_filter)
+        get_cache().store(prompt_question, scope, stored)
+
+
+def invalidate(knowledge_base_id: Optional[str] = None) -> int:
+    """清除指定知識庫的快取草稿（例如 KB 完成 sync 後），回傳清除筆數；尚未建立快取時回傳 0。"""
+    return _cache.invalidate(knowledge_base_id) if _cache is not None else 0
+
+
+def stats() -> Dict[str, Any]:
+    """回傳 hit/miss/store/eviction 次數、目前筆數與 hit rate；尚未建立快取時回傳空 dict。"""
+    return _cache.stats() if _cache is not None else {}
@@ -0,0 +1,476 @@
+import asyncio
+import json
+import signal
+import threading
+import time
+from collections import deque
+from http import HTTPStatus
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, Optional, Tuple
+from urllib.parse import urlsplit
+
+from tools import aio, semantic_cache, session, telemetry
+from tools.bedrock import last_usage
+from tools.config import PipelineConfig, RetrieveGenerateConfig, ServeConfig
+from tools.deadline import Deadline, DeadlineExceeded
+from tools.fused import rephrase_and_extract
+from tools.ratelimit import stats as rate_limit_stats
+from tools.rephrase import rephrase_question
+from tools import retrieve as _retrieve
+from tools import retrieve_generate as _retrieve_generate
+from tools.singleflight import stats as single_flight_stats
+from tools.stats import latency_summary
+
+
+Response = Tuple[int, Dict[str, Any]]
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class _Request:
+    def __init__(self, method: str, path: str, headers: Dict[str, str], body: bytes, keep_alive: bool):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self.keep_alive = keep_alive
+
+    def json(self) -> Dict[str, Any]:
+        if not self.body:
+            return {}
+        try:
+            payload = json.loads(self.body)
+        except (UnicodeDecodeError, json.JSONDecodeError) as exc:
+            raise HttpError(400, f"invalid JSON body: {exc}")
+        if not isinstance(payload, dict):
+            raise HttpError(400, "JSON body must be an object")
+        return payload
+
+
+# ---- 同步的作業（在 tools.aio 的 thread pool 上執行） ----
+
+def _prompt(body: Dict[str, Any]) -> str:
+    prompt_question = body.get("prompt_question")
+    if not prompt_question:
+        raise HttpError(400, "prompt_question is required")
+    return prompt_question
+
+
+def _draft(body: Dict[str, Any], knowledge_base_id: str, model_arn: str, deadline: Deadline) -> Dict[str, Any]:
+    """
+    與 lambda_handler 相同的輸入（prompt_question、rephrase、session_id）與輸出（draft_text、session_id、rephrase）。
+    """
+    prompt_question = _prompt(body)
+    session_id = body.get("session_id")
+    if session_id:
+        try:
+            response = session.revise_draft(session_id, prompt_question, deadline)
+        except session.SessionNotFound:
+            raise HttpError(404, f"session {session_id} was not found or has expired")
+        return {"draft_text": response["output"]["text"], "session_id": session_id, "revision": response["revision"]}
+
+    metadata_filter = None
+    result: Dict[str, Any] = {}
+    kwargs: Dict[str, Any] = {}
+    mode = body.get("mode", PipelineConfig.MODE)
+    if body.get("rephrase") is True:
+        rephrased = rephrase_and_extract(prompt_question, deadline=deadline)
+        prompt_question, metadata_filter = rephrased["rephrased"], rephrased["metadata_filter"] or {}
+        result["rephrase"] = rephrased
+        if mode in ("split", "sections"):
+            # 以去除條件後的 query 檢索；kb 模式的 RetrieveAndGenerate 只接受一段輸入
+            kwargs["retrieval_query"] = rephrased["query"]
+
+    if mode == "split":
+        from tools.pipeline import retrieve_then_generate
+        generate = retrieve_then_generate
+    elif mode == "sections":
+        from tools.sections import retrieve_then_generate_sections
+        generate = retrieve_then_generate_sections
+    else:
+        generate = _retrieve_generate.ret_and_gen
+    response = generate(prompt_question=prompt_question, knowledge_base_id=knowledge_base_id, model_arn=model_arn,
+                        deadline=deadline, metadata_filter=metadata_filter, **kwargs)
+    if "semantic_cache" in response:
+        result["semantic_cache"] = response["semantic_cache"]
+    if session.enabled():
+        result["session_id"] = session.start_session(prompt_question, response, knowledge_base_id, model_arn)
+    return dict({"draft_text": response["output"]["text"]}, **result)
+
+
+def _draft_events(body: Dict[str, Any],
+                  knowledge_base_id: str,
+                  model_arn: str,
+                  deadline: Deadline) -> Iterator[Dict[str, Any]]:
+    """與 stream_lambda_handler 相同的事件：rephrase、draft_delta、citation（sections 模式另有 section），最後為 done。"""
+    prompt_question = _prompt(body)
+    metadata_filter = None
+    kwargs: Dict[str, Any] = {}
+    sections = body.get("mode", PipelineConfig.MODE) == "sections"
+    if body.get("rephrase") is True:
+        rephrased = rephrase_and_extract(prompt_question, deadline=deadline)
+        prompt_question, metadata_filter = rephrased["rephrased"], rephrased["metadata_filter"] or {}
+        if sections:
+            kwargs["retrieval_query"] = rephrased["query"]
+        yield {"rephrase": rephrased}
+    if sections:
+        from tools.sections import retrieve_then_generate_sections_stream
+        stream = retrieve_then_generate_sections_stream
+    else:
+        stream = _retrieve_generate.ret_and_gen_stream
+    for chunk in stream(prompt_question, knowledge_base_id, model_arn, deadline=deadline,
+                        metadata_filter=metadata_filter, **kwargs):
+        if chunk["type"] == "text":
+            yield {"draft_delta": chunk["text"]}
+        elif chunk["type"] == "citation":
+            yield {"citation": chunk["citation"]}
+        elif chunk["type"] == "section":
+            yield {"section": {key: chunk[key] for key in ("index", "heading", "text")}}
+    yield {"done": True}
+
+
+def _rephrase(body: Dict[str, Any], deadline: Deadline) -> Dict[str, Any]:
+    prompt_question = _prompt(body)
+    if body.get("with_filter") is True:
+        result = rephrase_and_extract(prompt_question, deadline=deadline)
+    else:
+        result = {"rephrased": rephrase_question(prompt_question, deadline=deadline)}
+    # last_usage() 是 thread-local，必須在執行呼叫的同一個 thread 讀取
+    return dict({"input": prompt_question}, **result, usage=last_usage())
+
+
+class KbServer:
+    """
+    常駐的 asyncio HTTP/1.1 服務，提供與 cli.py 相同的作業（rephrase、retrieve、ret-gen、metadata filter）。
+    Bedrock client 在 process 內重複使用；同時處理的請求數超過 max_concurrency 時排隊，
+    排隊數也超過 max_queue 時直接回應 503（backpressure）。
+    """
+
+    def __init__(self,
+                 knowledge_base_id: Optional[str],
+                 model_arn: Optional[str],
+                 max_concurrency: int = ServeConfig.MAX_CONCURRENCY,
+                 max_queue: int = ServeConfig.MAX_QUEUE,
+                 request_timeout: float = ServeConfig.REQUEST_TIMEOUT):
+        self.knowledge_base_id = knowledge_base_id
+        self.model_arn = model_arn
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.request_timeout = request_timeout
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._admitted = 0
+        self._running = 0
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {}
+        self._statuses: Dict[str, int] = {}
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._routes: Dict[Tuple[str, str], Callable[[_Request], Awaitable[Response]]] = {
+            ("GET", "/health"): self._health,
+            ("GET", "/metrics"): self._metrics,
+            ("POST", "/rephrase"): self._rephrase,
+            ("POST", "/metadata-filter"): self._metadata_filter,
+            ("POST", "/retrieve"): self._retrieve,
+            ("POST", "/ret-gen"): self._ret_gen,
+            ("POST", "/invalidate"): self._invalidate,
+        }
+
+    # ---- 作業 ----
+
+    def _deadline(self, body: Dict[str, Any]) -> Deadline:
+        seconds = body.get("deadline", self.request_timeout)
+        if not isinstance(seconds, (int, float)) or seconds <= 0:
+            raise HttpError(400, "deadline must be a positive number of seconds")
+        return Deadline(min(float(seconds), self.request_timeout))
+
+    def _require(self, value: Optional[str], env: str) -> str:
+        if not value:
+            raise HttpError(500, f"{env} is not configured")
+        return value
+
+    async def _health(self, request: _Request) -> Response:
+        return 200, {"status": "ok", "running": self._running, "queued": self._admitted - self._running,
+                     "max_concurrency": self.max_concurrency, "max_queue": self.max_queue}
+
+    async def _metrics(self, request: _Request) -> Response:
+        with self._lock:
+            routes = {route: dict(latency_summary(self._latencies[route]), requests=count)
+                      for route, count in self._counts.items()}
+            statuses = dict(self._statuses)
+        return 200, {
+            "uptime_seconds": time.monotonic() - self._started,
+            "running": self._running,
+            "queued": self._admitted - self._running,
+            "routes": routes,
+            "statuses": statuses,
+            "single_flight": single_flight_stats(),
+            "metadata_filter_cache": _retrieve.metadata_filter_cache_stats(),
+            "retrieval_cache": _retrieve.retrieval_cache_stats(),
+            "hedge": _retrieve.hedge_stats(),
+            "rate_limit": rate_limit_stats(),
+            "semantic_cache": semantic_cache.stats(),
+        }
+
+    async def _invalidate(self, request: _Request) -> Response:
+        """知識庫完成 sync 後清除該知識庫的 retrieve 快取與語意草稿快取。"""
+        knowledge_base_id = request.json().get("knowledge_base_id") or self._require(self.knowledge_base_id,
+                                                                                      "KNOWLEDGE_BASE_ID")
+        return 200, {"knowledge_base_id": knowledge_base_id,
+                     "retrieval_cache": _retrieve.invalidate_knowledge_base(knowledge_base_id),
+                     "semantic_cache": semantic_cache.invalidate(knowledge_base_id)}
+
+    async def _rephrase(self, request: _Request) -> Response:
+        body = request.json()
+        deadline = self._deadline(body)
+        return 200, await aio._run(_rephrase, body, deadline, timeout=deadline.remaining())
+
+    async def _metadata_filter(self, request: _Request) -> Response:
+        body = request.json()
+        deadline = self._deadline(body)
+        metadata_filter = await aio.generate_metadata_filter(_prompt(body), deadline=deadline)
+        return 200, {"metadata_filter": metadata_filter}
+
+    async def _retrieve(self, request: _Request) -> Response:
+        body = request.json()
+        deadline = self._deadline(body)
+        response = await aio.retrieve_from_kb(
+            _prompt(body),
+            body.get("knowledge_base_id") or self._require(self.knowledge_base_id, "KNOWLEDGE_BASE_ID"),
+            number_of_results=body.get("top_k"),
+            metadata_filter=body.get("metadata_filter"),
+            rerank=body.get("rerank"),
+            deadline=deadline,
+        )
+        payload = {"chunks": response.get("retrievalResults", [])}
+        for field in ("retrieval_cache", "coalesced"):
+            if field in response:
+                payload[field] = response[field]
+        return 200, payload
+
+    async def _ret_gen(self, request: _Request) -> Response:
+        body = request.json()
+        deadline = self._deadline(body)
+        knowledge_base_id = self._require(self.knowledge_base_id, "KNOWLEDGE_BASE_ID")
+        model_arn = self._require(self.model_arn, "MODEL_ARN")
+        return 200, await aio._run(_draft, body, knowledge_base_id, model_arn, deadline,
+                                   timeout=deadline.remaining())
+
+    async def _ret_gen_stream(self, request: _Request, writer: asyncio.StreamWriter) -> int:
+        """以 Server-Sent Events 逐段送出草稿；client 中斷時通知背景 thread 停止讀取串流。"""
+        body = request.json()
+        if body.get("session_id"):
+            raise HttpError(400, "session_id is only supported by POST /ret-gen")
+        deadline = self._deadline(body)
+        knowledge_base_id = self._require(self.knowledge_base_id, "KNOWLEDGE_BASE_ID")
+        model_arn = self._require(self.model_arn, "MODEL_ARN")
+
+        loop = asyncio.get_running_loop()
+        queue: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
+        cancelled = threading.Event()
+
+        def _produce() -> None:
+            try:
+                for event in _draft_events(body, knowledge_base_id, model_arn, deadline):
+                    if cancelled.is_set():
+                        break
+                    loop.call_soon_threadsafe(queue.put_nowait, event)
+            except Exception as exc:
+                loop.call_soon_threadsafe(queue.put_nowait, {"error": str(exc)})
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, None)
+
+        writer.write(_head(200, [("Content-Type", "text/event-stream; charset=utf-8"),
+                                 ("Cache-Control", "no-cache"), ("Connection", "close")]))
+        producer = loop.run_in_executor(aio._get_executor(), _produce)
+        try:
+            while True:
+                event = await queue.get()
+                if event is None:
+                    break
+                writer.write(b"data: " + json.dumps(event, ensure_ascii=False).encode("utf-8") + b"\n\n")
+                await writer.drain()
+        except ConnectionError:
+            # client 已中斷連線（以 499 記錄），背景 thread 會在下一個事件時停止
+            return 499
+        finally:
+            cancelled.set()
+            await producer
+        return 200
+
+    # ---- HTTP ----
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(_read_request(reader), ServeConfig.KEEPALIVE_TIMEOUT)
+                except HttpError as exc:
+                    writer.write(_json_response(exc.status, {"error": str(exc)}, keep_alive=False))
+                    break
+                if request is None:
+                    break
+                keep_alive = await self._dispatch(request, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, request: _Request, writer: asyncio.StreamWriter) -> bool:
+        """處理一個請求，回傳連線是否可繼續使用（keep-alive）。"""
+        started = time.perf_counter()
+        route = f"{request.method} {request.path}"
+        streaming = request.method == "POST" and request.path == "/ret-gen/stream"
+        handler = self._routes.get((request.method, request.path))
+        if handler is None and not streaming:
+            known = any(path == request.path for _, path in self._routes) or request.path == "/ret-gen/stream"
+            status = 405 if known else 404
+            writer.write(_json_response(status, {"error": HTTPStatus(status).phrase}, request.keep_alive))
+            self._record("unmatched", status, started)
+            return request.keep_alive
+
+        # /health 與 /metrics 不受並行上限限制，忙碌時仍可回應
+        admitted = request.path not in ("/health", "/metrics")
+        if admitted:
+            if self._admitted >= self.max_concurrency + self.max_queue:
+                writer.write(_json_response(503, {"error": "server is at capacity, retry later"},
+                                            request.keep_alive, [("Retry-After", "1")]))
+                self._record(route, 503, started)
+                return request.keep_alive
+            self._admitted += 1
+
+        try:
+            with telemetry.span("http_request", route=route) as attributes:
+                if admitted:
+                    if self._semaphore is None:
+                        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+                    await self._semaphore.acquire()
+                    self._running += 1
+                try:
+                    if streaming:
+                        status = await self._ret_gen_stream(request, writer)
+                        attributes["status"] = status
+                        self._record(route, status, started)
+                        return False
+                    status, payload = await handler(request)
+                except HttpError as exc:
+                    status, payload = exc.status, {"error": str(exc)}
+                except (DeadlineExceeded, asyncio.TimeoutError) as exc:
+                    status, payload = 504, {"error": str(exc) or "deadline exceeded"}
+                except Exception as exc:
+                    status, payload = 500, {"error": str(exc)}
+                finally:
+                    if admitted:
+                        self._running -= 1
+                        self._semaphore.release()
+                attributes["status"] = status
+        finally:
+            if admitted:
+                self._admitted -= 1
+
+        writer.write(_json_response(status, payload, request.keep_alive))
+        self._record(route, status, started)
+        return request.keep_alive
+
+    def _record(self, route: str, status: int, started: float) -> None:
+        with self._lock:
+            self._counts[route] = self._counts.get(route, 0) + 1
+            self._statuses[str(status)] = self._statuses.get(str(status), 0) + 1
+            self._latencies.setdefault(route, deque(maxlen=ServeConfig.LATENCY_WINDOW)).append(
+                (time.perf_counter() - started) * 1000)
+
+    def warm_up(self) -> None:
+        """啟動時先建立 Bedrock client，第一個請求不必付出建立連線池的成本。"""
+        _retrieve_generate.warm_up(RetrieveGenerateConfig.REGION)
+        if PipelineConfig.MODE == "split":
+            from tools import pipeline
+            pipeline.warm_up(RetrieveGenerateConfig.REGION)
+
+    async def serve(self, host: str = ServeConfig.HOST, port: int = ServeConfig.PORT,
+                    ready: Optional[Callable[[Any], None]] = None) -> None:
+        """啟動服務直到收到 SIGTERM / SIGINT；停止接受新連線後，等候處理中的請求完成。"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(aio._get_executor(), self.warm_up)
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        stop = asyncio.Event()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        if ready is not None:
+            ready(server)
+        async with server:
+            await stop.wait()
+            server.close()
+            drain_until = time.monotonic() + self.request_timeout
+            while self._admitted and time.monotonic() < drain_until:
+                await asyncio.sleep(0.1)
+
+
+async def _read_request(reader: asyncio.StreamReader) -> Optional[_Request]:
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode("latin-1").split()
+    except ValueError:
+        raise HttpError(400, "malformed request line")
+
+    headers: Dict[str, str] = {}
+    while True:
+        header = await reader.readline()
+        if header in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = header.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HttpError(411, "chunked request bodies are not supported")
+    try:
+        length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise HttpError(400, "invalid Content-Length")
+    if length > ServeConfig.MAX_BODY_BYTES:
+        raise HttpError(413, "request body too large")
+    body = await reader.readexactly(length) if length else b""
+
+    connection = headers.get("connection", "").lower()
+    keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+    return _Request(method.upper(), urlsplit(target).path.rstrip("/") or "/", headers, body, keep_alive)
+
+
+def _head(status: int, headers: Any) -> bytes:
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"]
+    lines.extend(f"{name}: {value}" for name, value in headers)
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+def _json_response(status: int, payload: Dict[str, Any], keep_alive: bool, extra_headers: Any = ()) -> bytes:
+    body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+    headers = [("Content-Type", "application/json; charset=utf-8"), ("Content-Length", len(body)),
+               ("Connection", "keep-alive" if keep_alive else "close")]
+    headers.extend(extra_headers)
+    return _head(status, headers) + body
+
+
+def serve(knowledge_base_id: Optional[str],
+          model_arn: Optional[str],
+          host: str = ServeConfig.HOST,
+          port: int = ServeConfig.PORT,
+          max_concurrency: int = ServeConfig.MAX_CONCURRENCY,
+          max_queue: int = ServeConfig.MAX_QUEUE,
+          request_timeout: float = ServeConfig.REQUEST_TIMEOUT) -> None:
+    """以 asyncio.run 執行 KbServer（kb-cli serve 使用），阻塞直到收到停止訊號。"""
+    server = KbServer(knowledge_base_id, model_arn, max_concurrency, max_queue, request_timeout)
+
+    def _ready(started: Any) -> None:
+        addresses = ", ".join(str(sock.getsockname()) for sock in started.sockets)
+        print(f"Serving on {addresses}", flush=True)
+
+    asyncio.run(server.serve(host, port, ready=_ready))
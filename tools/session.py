@@ -0,0 +1,200 @@
+import threading
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+from tools import telemetry
+from tools.bedrock import build_messages_body, converse
+from tools.cache import SQLiteStore, TTLCache
+from tools.config import RetrieveGenerateConfig, SectionConfig, SessionConfig
+from tools.deadline import Deadline, stage_client_config
+
+
+# 修訂只需要原始需求、目前的草稿與修改指示；檢索結果已反映在草稿中，不再重新檢索或送出。
+# 模型只輸出有修改的項目，再依項目標題合併回草稿，輸出 token 數與延遲隨修改範圍而非草稿長度增加
+REVISION_SYSTEM_PROMPT = (
+    "你是保險公司內部的文件助手，負責依照使用者的修改指示修訂內部簽呈草稿。"
+    "草稿分為【主旨】、【內文】、【建議附件】、【審核流程】四大項目。"
+    "請以正式公文語氣、繁體中文，只輸出需要修改的項目：每個項目以原本的標題（例如「一、【主旨】」）開頭，"
+    "接著是該項目修訂後的完整內容；未修改的項目不要輸出，也不新增使用者未提及的內容。"
+)
+REVISION_CONTEXT_TEMPLATE = (
+    "\n\n原始需求：{question}\n"
+    "\n"
+    "目前的草稿：\n"
+    "{draft}\n"
+)
+REVISION_INSTRUCTION_PREFIX = "修改指示："
+
+# 與草稿生成相同的逾時；有 deadline 時會再依剩餘預算縮短
+_CLIENT_CONFIG = dict(
+    connect_timeout=5,
+    read_timeout=120,
+    retries={"max_attempts": 2}
+)
+
+
+class SessionNotFound(KeyError):
+    """找不到（或已過期的）草稿 session。"""
+
+
+_sessions = TTLCache(SessionConfig.MAX_ENTRIES, SessionConfig.TTL_SECONDS)
+_store: Optional[SQLiteStore] = None
+_store_path = SessionConfig.PERSIST_PATH
+_store_lock = threading.Lock()
+
+
+def configure(path: Optional[str]) -> None:
+    """設定 session 的 SQLite 持久化路徑（None 為只保存在記憶體），例如 CLI 讓多次執行共用 session。"""
+    global _store, _store_path
+    with _store_lock:
+        _store_path = path
+        _store = None
+
+
+def enabled() -> bool:
+    """是否保存草稿 session：DRAFT_SESSIONS=1，或已設定持久化路徑（DRAFT_SESSION_PATH 或 configure()）時。"""
+    return SessionConfig.ENABLED or bool(_store_path)
+
+
+def _get_store() -> Optional[SQLiteStore]:
+    global _store
+    if not _store_path:
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None and _store_path:
+                _store = SQLiteStore(_store_path, SessionConfig.TTL_SECONDS)
+    return _store
+
+
+def get_session(session_id: str) -> Optional[Dict[str, Any]]:
+    session = _sessions.get(session_id)
+    if session is None:
+        store = _get_store()
+        if store is not None:
+            session = store.get(session_id)
+            if session is not None:
+                _sessions.set(session_id, session)
+    return session
+
+
+def _save(session_id: str, session: Dict[str, Any]) -> None:
+    _sessions.set(session_id, session)
+    store = _get_store()
+    if store is not None:
+        store.set(session_id, session)
+
+
+def _references(response: Dict[str, Any]) -> List[Dict[str, Any]]:
+    # 各段引用可能指向同一個 chunk，只保留一份
+    references: List[Dict[str, Any]] = []
+    seen = set()
+    for citation in response.get("citations", []):
+        for reference in citation.get("retrievedReferences", []):
+            key = (str(reference.get("location")), reference.get("content", {}).get("text"))
+            if key not in seen:
+                seen.add(key)
+                references.append(reference)
+    return references
+
+
+def start_session(prompt_question: str,
+                  response: Dict[str, Any],
+                  knowledge_base_id: str,
+                  model_arn: str,
+                  region: str = RetrieveGenerateConfig.REGION) -> str:
+    """
+    保存第一次生成的草稿與引用來源，回傳之後以 revise_draft 修訂用的 session id。
+    session 只保存在本 process 的記憶體與選用的 SQLite 檔案中，不會送到 Bedrock。
+    """
+    session_id = uuid.uuid4().hex
+    _save(session_id, {
+        "question": prompt_question,
+        "draft": response.get("output", {}).get("text", ""),
+        "references": _references(response),
+        "knowledge_base_id": knowledge_base_id,
+        "model_arn": model_arn,
+        "region": region,
+        "revision": 0,
+    })
+    return session_id
+
+
+def build_revision_body(question: str, draft: str, instruction: str) -> Dict[str, Any]:
+    # 草稿每次修訂都會改變，放在 prompt cache checkpoint 之後；只有固定的指示會被快取
+    return build_messages_body(
+        REVISION_SYSTEM_PROMPT,
+        REVISION_INSTRUCTION_PREFIX + instruction,
+        {
+            "max_new_tokens": RetrieveGenerateConfig.MAX_TOKENS,
+            "temperature": RetrieveGenerateConfig.TEMPERATURE,
+            "top_p": RetrieveGenerateConfig.TOP_P,
+        },
+        system_suffix=REVISION_CONTEXT_TEMPLATE.format(question=question, draft=draft),
+    )
+
+
+def _labels() -> List[str]:
+    # 「一、【主旨】」→「【主旨】」；模型不一定保留編號
+    return [heading[heading.index("【"):] if "【" in heading else heading
+            for heading, _, _ in SectionConfig.SECTIONS]
+
+
+def _split_sections(text: str) -> List[Tuple[str, str]]:
+    """依項目標題把文字切成 [(標題, 含標題的整段文字)]，依出現順序；找不到任何標題時回傳空 list。"""
+    starts = []
+    for label in _labels():
+        position = text.find(label)
+        if position >= 0:
+            # 從標題所在行的行首開始，包含「一、」等編號
+            starts.append((text.rfind("\n", 0, position) + 1, label))
+    starts.sort()
+    return [(label, text[start:starts[index + 1][0] if index + 1 < len(starts) else len(text)].strip())
+            for index, (start, label) in enumerate(starts)]
+
+
+def merge_revision(draft: str, revised: str) -> str:
+    """
+    將只含修改項目的模型輸出合併回草稿：以標題取代草稿中對應的項目。
+    輸出沒有可辨識的標題，或草稿本身無法依標題切分時，視為修訂後的完整草稿。
+    """
+    changes = dict(_split_sections(revised))
+    sections = _split_sections(draft)
+    if not changes or not sections:
+        return revised.strip()
+    prefix = draft[:draft.find(sections[0][1])].strip()
+    merged = [changes.pop(label, text) for label, text in sections]
+    # 草稿原本沒有的項目接在最後
+    merged.extend(changes.values())
+    return "\n\n".join(([prefix] if prefix else []) + merged)
+
+
+def revise_draft(session_id: str, instruction: str, deadline: Optional[Deadline] = None) -> dict:
+    """
+    依修改指示修訂 session 中最新的草稿：只送出原始需求、目前的草稿與修改指示給模型，不重新檢索，
+    模型只輸出有修改的項目，再以 merge_revision 合併成完整草稿。
+    回傳與 ret_and_gen 相同格式的 output / citations（沿用第一次的引用來源），另附 usage 與修訂次數。
+    session 不存在或已過期時拋出 SessionNotFound（不會改為重新檢索與生成）。
+    """
+    session = get_session(session_id)
+    if session is None:
+        raise SessionNotFound(session_id)
+
+    body = build_revision_body(session["question"], session["draft"], instruction)
+    with telemetry.span("revise_draft", model_id=session["model_arn"], revision=session["revision"] + 1) as attributes:
+        resp_body = converse(session["model_arn"], body, attributes, session["region"],
+                             stage_client_config(_CLIENT_CONFIG, deadline, "generate"), deadline)
+
+    text = merge_revision(session["draft"], resp_body["output"]["message"]["content"][0]["text"])
+    session = dict(session, draft=text, revision=session["revision"] + 1)
+    _save(session_id, session)
+    return {
+        "output": {"text": text},
+        "citations": [{
+            "generatedResponsePart": {"textResponsePart": {"text": text, "span": {"start": 0, "end": len(text)}}},
+            "retrievedReferences": session["references"],
+        }],
+        "usage": resp_body.get("usage"),
+        "sessionId": session_id,
+        "revision": session["revision"],
+    }
@@ -0,0 +1,593 @@
+import base64
+import hashlib
+import io
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from botocore.exceptions import ClientError
+
+from tools.metadata import MATCHED, default_extractor, matches_filter
+from tools.text import estimate_tokens
+
+
+# 模擬知識庫的預設內容：少量簽呈範本片段
+DEFAULT_CORPUS: List[Dict[str, Any]] = [
+    {
+        "text": "主旨：擬辦理 SAS Viya 雲端平台新約採購案，簽請核示。",
+        "metadata": {"product_name": "SAS Viya"},
+        "uri": "s3://simulated-kb/sas_viya_cloud_new.md",
+    },
+    {
+        "text": "內文：本案為 SAS Viya 雲端訂閱，合約期間一年，費用由資訊處年度預算支應。",
+        "metadata": {"product_name": "SAS Viya"},
+        "uri": "s3://simulated-kb/sas_viya_cloud_new.md",
+    },
+    {
+        "text": "主旨：擬辦理 SAS 地端軟體續約案，簽請核示。建議附件：原合約、報價單。",
+        "metadata": {"product_name": "SAS"},
+        "uri": "s3://simulated-kb/sas_onprem_renewal.md",
+    },
+    {
+        "text": "審核流程：承辦人 → 科長 → 資訊處處長 → 總經理。",
+        "metadata": {"product_name": "SAS"},
+        "uri": "s3://simulated-kb/sas_onprem_renewal.md",
+    },
+    {
+        "text": "主旨：擬辦理 DataStage 軟體維護續約案。內文：維護期間自明年一月起算。",
+        "metadata": {"product_name": "DataStage"},
+        "uri": "s3://simulated-kb/datastage_renewal.md",
+    },
+]
+
+
+class SimulatorConfig:
+    """
+    模擬器的行為設定：延遲以對數常態分布取樣，生成時間與輸出 token 數成正比。
+    time_scale 可整體縮放所有等待時間（例如設為 0 讓測試不等待）。
+    max_concurrency 模擬每個 region 的模型呼叫配額：同時在途的 invoke_model 超過時回應 ThrottlingException。
+    """
+
+    def __init__(self,
+                 latency_median_ms: float = 80.0,
+                 latency_sigma: float = 0.35,
+                 per_output_token_ms: float = 15.0,
+                 throttle_rate: float = 0.0,
+                 time_scale: float = 1.0,
+                 seed: Optional[int] = None,
+                 corpus: Optional[List[Dict[str, Any]]] = None,
+                 max_concurrency: Optional[int] = None):
+        self.latency_median_ms = latency_median_ms
+        self.latency_sigma = latency_sigma
+        self.per_output_token_ms = per_output_token_ms
+        self.throttle_rate = throttle_rate
+        self.time_scale = time_scale
+        self.corpus = corpus if corpus is not None else DEFAULT_CORPUS
+        self.max_concurrency = max_concurrency
+        self._in_flight: Dict[str, int] = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "SimulatorConfig":
+        corpus = None
+        corpus_path = os.environ.get("BEDROCK_SIM_CORPUS")
+        if corpus_path:
+            with open(corpus_path, encoding="utf-8") as handle:
+                corpus = [json.loads(line) for line in handle if line.strip()]
+        seed = os.environ.get("BEDROCK_SIM_SEED")
+        max_concurrency = os.environ.get("BEDROCK_SIM_MAX_CONCURRENCY")
+        return cls(
+            latency_median_ms=float(os.environ.get("BEDROCK_SIM_LATENCY_MS", "80")),
+            latency_sigma=float(os.environ.get("BEDROCK_SIM_LATENCY_SIGMA", "0.35")),
+            per_output_token_ms=float(os.environ.get("BEDROCK_SIM_TOKEN_MS", "15")),
+            throttle_rate=float(os.environ.get("BEDROCK_SIM_THROTTLE_RATE", "0")),
+            time_scale=float(os.environ.get("BEDROCK_SIM_TIME_SCALE", "1")),
+            seed=int(seed) if seed else None,
+            corpus=corpus,
+            max_concurrency=int(max_concurrency) if max_concurrency else None,
+        )
+
+    def _sleep(self, milliseconds: float) -> None:
+        if self.time_scale > 0 and milliseconds > 0:
+            time.sleep(milliseconds * self.time_scale / 1000)
+
+    def wait_base_latency(self) -> None:
+        with self._lock:
+            sample = self.latency_median_ms * math.exp(self._random.gauss(0, self.latency_sigma))
+        self._sleep(sample)
+
+    def wait_for_tokens(self, tokens: int) -> None:
+        self._sleep(tokens * self.per_output_token_ms)
+
+    @staticmethod
+    def _throttling_error(operation_name: str) -> ClientError:
+        return ClientError(
+            {
+                "Error": {"Code": "ThrottlingException", "Message": "Rate exceeded (simulated)"},
+                "ResponseMetadata": {"HTTPStatusCode": 429},
+            },
+            operation_name,
+        )
+
+    def maybe_throttle(self, operation_name: str) -> None:
+        with self._lock:
+            throttled = self._random.random() < self.throttle_rate
+        if throttled:
+            raise self._throttling_error(operation_name)
+
+    @contextmanager
+    def quota(self, region_name: str, operation_name: str) -> Iterator[None]:
+        """在 region 的並行配額內執行；配額已滿時立即拋出 ThrottlingException。"""
+        if self.max_concurrency is None:
+            yield
+            return
+        with self._lock:
+            if self._in_flight.get(region_name, 0) >= self.max_concurrency:
+                raise self._throttling_error(operation_name)
+            self._in_flight[region_name] = self._in_flight.get(region_name, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight[region_name] -= 1
+
+
+def _chunks(text: str, size: int = 8) -> Iterator[str]:
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+
+def _response_metadata(input_tokens: int = 0, output_tokens: int = 0) -> Dict[str, Any]:
+    headers = {"x-amzn-requestid": str(uuid.uuid4())}
+    if input_tokens or output_tokens:
+        headers["x-amzn-bedrock-input-token-count"] = str(input_tokens)
+        headers["x-amzn-bedrock-output-token-count"] = str(output_tokens)
+    return {"RequestId": headers["x-amzn-requestid"], "HTTPStatusCode": 200, "HTTPHeaders": headers, "RetryAttempts": 0}
+
+
+_SEARCH_RESULTS_MARKER = "以下為來自知識庫的檢索結果："
+_INSTRUCTION_MARKER = "請根據上述檢索結果撰寫草稿"
+_SECTION_MARKER = "本次撰寫的項目："
+_REVISION_MARKER = "修改指示："
+_DRAFT_MARKER = "目前的草稿：\n"
+
+
+def _draft(prompt: str, contexts: List[str]) -> str:
+    context = "；".join(contexts)
+    return (
+        f"一、【主旨】\n{prompt}\n\n"
+        f"二、【內文】\n依據知識庫資料：{context}\n\n"
+        "三、【建議附件】\n報價單、原合約影本。\n\n"
+        "四、【審核流程】\n承辦人 → 科長 → 處長。"
+    )
+
+
+class SimulatedBedrockRuntime:
+    """模擬 bedrock-runtime 的 invoke_model / invoke_model_with_response_stream。"""
+
+    def __init__(self, config: SimulatorConfig, region_name: str = "us-east-1"):
+        self.config = config
+        self.region_name = region_name
+        self._prompt_cache: set = set()
+        self._prompt_cache_lock = threading.Lock()
+
+    def _generate(self, body: Dict[str, Any]) -> str:
+        texts = [block.get("text", "") for message in body.get("messages", [])
+                 for block in message.get("content", []) if "text" in block]
+        user_text = texts[-1] if texts else ""
+        prompt = "".join(texts)
+        system = "".join(block.get("text", "") for block in body.get("system", []))
+        if _SEARCH_RESULTS_MARKER in system:
+            # tools.pipeline 以 PROMPT_TEMPLATE 直接生成草稿的請求
+            context = system.split(_SEARCH_RESULTS_MARKER, 1)[1].split(_INSTRUCTION_MARKER, 1)[0]
+            draft = _draft(user_text, [line.strip() for line in context.splitlines() if line.strip()])
+            if _SECTION_MARKER not in system:
+                return draft
+            # tools.sections 的請求：只回傳指定段落的內容（不含標題）
+            heading = system.split(_SECTION_MARKER, 1)[1].split("——", 1)[0]
+            for section in draft.split("\n\n"):
+                if section.startswith(heading):
+                    return section[len(heading):].strip()
+            return draft
+        if user_text.startswith(_REVISION_MARKER) and _DRAFT_MARKER in system:
+            # tools.session 的修訂請求：只回傳指示提到的項目（預設為主旨），並附上已套用的修改指示
+            instruction = user_text[len(_REVISION_MARKER):].strip()
+            sections = [section.strip() for section in system.split(_DRAFT_MARKER, 1)[1].split("\n\n")
+                        if "【" in section]
+            if not sections:
+                return f"我想申請：{instruction}。（模擬回應）"
+            section = next((section for section in sections
+                            if section[section.index("【") + 1:section.index("】")] in instruction), sections[0])
+            return f"{section}\n（模擬修訂：{instruction}）"
+        if "# Output Structured Request" in prompt and '"rephrased"' in system:
+            # tools.fused 的請求：同時回傳重述、query 與 filter
+            query = prompt.split("# Input User Query:")[-1].split("# Output Structured Request")[0].strip()
+            status, metadata_filter = default_extractor().extract(query)
+            return "```json\n" + json.dumps({"rephrased": f"我想申請：{query}。（模擬回應）", "query": query,
+                                              "filter": metadata_filter if status == MATCHED else None},
+                                             ensure_ascii=False) + "\n```"
+        if "# Output Structured Request" in prompt:
+            # metadata filter 的請求：以規則擷取模擬模型輸出
+            query = prompt.split("# Input User Query:")[-1].split("# Output Structured Request")[0].strip()
+            status, metadata_filter = default_extractor().extract(query)
+            return "```json\n" + json.dumps({"query": query, "filter": metadata_filter if status == MATCHED else None},
+                                           ensure_ascii=False) + "\n```"
+        max_tokens = body.get("inferenceConfig", {}).get("max_new_tokens", 500)
+        text = f"我想申請：{user_text.strip()}。（模擬回應）"
+        return text[:max_tokens]
+
+    def _cached_prefix(self, body: Dict[str, Any]) -> str:
+        """回傳最後一個 cachePoint 之前的 system / messages 文字（沒有 checkpoint 時為空字串）。"""
+        blocks = list(body.get("system", []))
+        for message in body.get("messages", []):
+            blocks.extend(message.get("content", []))
+        last = max((index for index, block in enumerate(blocks) if "cachePoint" in block), default=None)
+        if last is None:
+            return ""
+        return "".join(block.get("text", "") for block in blocks[:last])
+
+    def _usage(self, body: Dict[str, Any], output: str) -> Dict[str, int]:
+        input_tokens = estimate_tokens(json.dumps(body, ensure_ascii=False))
+        usage = {"inputTokens": input_tokens, "outputTokens": estimate_tokens(output)}
+        prefix = self._cached_prefix(body)
+        if prefix:
+            # 模擬 prompt cache：第一次寫入，之後相同前綴改以 cache read 計算，不計入 inputTokens
+            cached_tokens = min(estimate_tokens(prefix), input_tokens)
+            key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+            with self._prompt_cache_lock:
+                hit = key in self._prompt_cache
+                self._prompt_cache.add(key)
+            usage["inputTokens"] = input_tokens - cached_tokens
+            usage["cacheReadInputTokenCount" if hit else "cacheWriteInputTokenCount"] = cached_tokens
+        return usage
+
+    def invoke_model(self, modelId: str, body: str, **_: Any) -> Dict[str, Any]:
+        with self.config.quota(self.region_name, "InvokeModel"):
+            self.config.wait_base_latency()
+            self.config.maybe_throttle("InvokeModel")
+            request = json.loads(body)
+            text = self._generate(request)
+            usage = self._usage(request, text)
+            self.config.wait_for_tokens(usage["outputTokens"])
+        payload = {
+            "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+            "stopReason": "end_turn",
+            "usage": dict(usage, totalTokens=usage["inputTokens"] + usage["outputTokens"]),
+        }
+        return {
+            "body": io.BytesIO(json.dumps(payload, ensure_ascii=False).encode("utf-8")),
+            "contentType": "application/json",
+            "ResponseMetadata": _response_metadata(usage["inputTokens"], usage["outputTokens"]),
+        }
+
+    def converse(self, modelId: str, messages: List[Dict[str, Any]], system: Optional[List[Dict[str, Any]]] = None,
+                 inferenceConfig: Optional[Dict[str, Any]] = None, **_: Any) -> Dict[str, Any]:
+        # 轉回 messages body 以共用 _generate / _usage；usage 改用 Converse 的欄位名稱
+        request = {"system": system or [], "messages": messages,
+                   "inferenceConfig": {"max_new_tokens": (inferenceConfig or {}).get("maxTokens", 500)}}
+        with self.config.quota(self.region_name, "Converse"):
+            self.config.wait_base_latency()
+            self.config.maybe_throttle("Converse")
+            text = self._generate(request)
+            usage = self._usage(request, text)
+            self.config.wait_for_tokens(usage["outputTokens"])
+        usage = {{"cacheReadInputTokenCount": "cacheReadInputTokens",
+                  "cacheWriteInputTokenCount": "cacheWriteInputTokens"}.get(key, key): value
+                 for key, value in usage.items()}
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": text}]}},
+            "stopReason": "end_turn",
+            "usage": dict(usage, totalTokens=usage["inputTokens"] + usage["outputTokens"]),
+            "metrics": {"latencyMs": 0},
+            "ResponseMetadata": _response_metadata(usage["inputTokens"], usage["outputTokens"]),
+        }
+
+    def invoke_model_with_response_stream(self, modelId: str, body: str, **_: Any) -> Dict[str, Any]:
+        with self.config.quota(self.region_name, "InvokeModelWithResponseStream"):
+            self.config.wait_base_latency()
+            self.config.maybe_throttle("InvokeModelWithResponseStream")
+        request = json.loads(body)
+        text = self._generate(request)
+        usage = self._usage(request, text)
+
+        def _events() -> Iterator[Dict[str, Any]]:
+            def _event(payload: Dict[str, Any]) -> Dict[str, Any]:
+                return {"chunk": {"bytes": json.dumps(payload, ensure_ascii=False).encode("utf-8")}}
+
+            yield _event({"messageStart": {"role": "assistant"}})
+            for piece in _chunks(text):
+                self.config.wait_for_tokens(estimate_tokens(piece))
+                yield _event({"contentBlockDelta": {"delta": {"text": piece}, "contentBlockIndex": 0}})
+            yield _event({"contentBlockStop": {"contentBlockIndex": 0}})
+            yield _event({"messageStop": {"stopReason": "end_turn"}})
+            yield _event({"metadata": {"usage": usage}})
+
+        return {"body": _events(), "contentType": "application/json", "ResponseMetadata": _response_metadata()}
+
+
+class SimulatedAgentRuntime:
+    """模擬 bedrock-agent-runtime 的 retrieve / retrieve_and_generate（含串流版本）。"""
+
+    def __init__(self, config: SimulatorConfig, region_name: str = "us-east-1"):
+        self.config = config
+        self.region_name = region_name
+
+    def _search(self, query: str, vector_config: Dict[str, Any]) -> List[Dict[str, Any]]:
+        number_of_results = vector_config.get("numberOfResults", 5)
+        metadata_filter = vector_config.get("filter")
+        query_chars = set(query)
+        scored = []
+        for index, chunk in enumerate(self.config.corpus):
+            if metadata_filter and not matches_filter(metadata_filter, chunk.get("metadata", {})):
+                continue
+            overlap = len(query_chars & set(chunk["text"])) / (len(query_chars) or 1)
+            scored.append((overlap, index, chunk))
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [
+            {
+                "content": {"text": chunk["text"], "type": "TEXT"},
+                "location": {"type": "S3", "s3Location": {"uri": chunk.get("uri", f"s3://simulated-kb/{index}.md")}},
+                "metadata": dict(chunk.get("metadata", {})),
+                "score": round(score, 6),
+            }
+            for score, index, chunk in scored[:number_of_results]
+        ]
+
+    def retrieve(self, knowledgeBaseId: str, retrievalQuery: Dict[str, Any],
+                 retrievalConfiguration: Optional[Dict[str, Any]] = None, **_: Any) -> Dict[str, Any]:
+        self.config.wait_base_latency()
+        self.config.maybe_throttle("Retrieve")
+        vector_config = (retrievalConfiguration or {}).get("vectorSearchConfiguration", {})
+        return {
+            "retrievalResults": self._search(retrievalQuery["text"], vector_config),
+            "ResponseMetadata": _response_metadata(),
+        }
+
+    def _retrieve_and_generate(self, input: Dict[str, Any], retrieveAndGenerateConfiguration: Dict[str, Any],
+                               sessionId: Optional[str]) -> Dict[str, Any]:
+        kb_config = retrieveAndGenerateConfiguration.get("knowledgeBaseConfiguration", {})
+        vector_config = kb_config.get("retrievalConfiguration", {}).get("vectorSearchConfiguration", {})
+        references = self._search(input["text"], vector_config)
+        text = _draft(input["text"], [reference["content"]["text"] for reference in references])
+        max_tokens = (kb_config.get("generationConfiguration", {}).get("inferenceConfig", {})
+                      .get("textInferenceConfig", {}).get("maxTokens"))
+        if max_tokens:
+            text = text[:max_tokens]
+        citation = {
+            "generatedResponsePart": {"textResponsePart": {"text": text, "span": {"start": 0, "end": len(text)}}},
+            "retrievedReferences": [
+                {"content": reference["content"], "location": reference["location"], "metadata": reference["metadata"]}
+                for reference in references
+            ],
+        }
+        return {"output": {"text": text}, "citations": [citation], "sessionId": sessionId or str(uuid.uuid4())}
+
+    def retrieve_and_generate(self, input: Dict[str, Any], retrieveAndGenerateConfiguration: Dict[str, Any],
+                              sessionId: Optional[str] = None, **_: Any) -> Dict[str, Any]:
+        self.config.wait_base_latency()
+        self.config.maybe_throttle("RetrieveAndGenerate")
+        response = self._retrieve_and_generate(input, retrieveAndGenerateConfiguration, sessionId)
+        self.config.wait_for_tokens(estimate_tokens(response["output"]["text"]))
+        response["ResponseMetadata"] = _response_metadata()
+        return response
+
+    def retrieve_and_generate_stream(self, input: Dict[str, Any], retrieveAndGenerateConfiguration: Dict[str, Any],
+                                     sessionId: Optional[str] = None, **_: Any) -> Dict[str, Any]:
+        self.config.wait_base_latency()
+        self.config.maybe_throttle("RetrieveAndGenerateStream")
+        response = self._retrieve_and_generate(input, retrieveAndGenerateConfiguration, sessionId)
+
+        def _events() -> Iterator[Dict[str, Any]]:
+            for piece in _chunks(response["output"]["text"]):
+                self.config.wait_for_tokens(estimate_tokens(piece))
+                yield {"output": {"text": piece}}
+            for citation in response["citations"]:
+                yield {"citation": dict(citation, citation=citation)}
+
+        return {"sessionId": response["sessionId"], "stream": _events(), "ResponseMetadata": _response_metadata()}
+
+
+_SIMULATED_SERVICES: Dict[str, Callable[[SimulatorConfig, str], Any]] = {
+    "bedrock-runtime": SimulatedBedrockRuntime,
+    "bedrock-agent-runtime": SimulatedAgentRuntime,
+}
+
+
+def simulator_factory(config: Optional[SimulatorConfig] = None) -> Callable[..., Any]:
+    """回傳可交給 tools.clients.set_client_factory 的模擬 client factory。"""
+    config = config or SimulatorConfig.from_env()
+
+    def _factory(service_name: str, region_name: str, _config: Any = None) -> Any:
+        if service_name not in _SIMULATED_SERVICES:
+            raise ValueError(f"The Bedrock simulator does not support the {service_name} service.")
+        return _SIMULATED_SERVICES[service_name](config, region_name)
+
+    return _factory
+
+
+# ---- record / replay ----
+
+_STREAM_KEYS = {"invoke_model_with_response_stream": "body", "retrieve_and_generate_stream": "stream"}
+
+
+def _encode(value: Any) -> Any:
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, dict):
+        return {key: _encode(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, dict):
+        if set(value) == {"__bytes__"}:
+            return base64.b64decode(value["__bytes__"])
+        return {key: _decode(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+class CassetteMissError(LookupError):
+    """replay 模式下找不到對應的錄製回應。"""
+
+
+class Cassette:
+    """
+    以 JSON 檔保存的錄製回應，key 為 (service, operation, 參數) 的雜湊。
+    同一個 key 錄到多筆回應時，replay 會依序循環使用。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, List[Any]] = {}
+        self._cursor: Dict[str, int] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as handle:
+                self._entries = json.load(handle)
+
+    @staticmethod
+    def key(service_name: str, operation: str, params: Dict[str, Any]) -> str:
+        canonical = json.dumps(_encode(params), sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(f"{service_name}:{operation}:{canonical}".encode("utf-8")).hexdigest()
+
+    def record(self, key: str, response: Any) -> None:
+        with self._lock:
+            self._entries.setdefault(key, []).append(_encode(response))
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as handle:
+                json.dump(self._entries, handle, ensure_ascii=False, indent=1)
+
+    def play(self, key: str) -> Any:
+        with self._lock:
+            responses = self._entries.get(key)
+            if not responses:
+                raise CassetteMissError(f"No recorded response for request {key} in {self.path}.")
+            index = self._cursor.get(key, 0)
+            self._cursor[key] = index + 1
+            return _decode(responses[index % len(responses)])
+
+
+def _materialize(operation: str, response: Dict[str, Any]) -> Dict[str, Any]:
+    """把串流或 StreamingBody 讀成可序列化的資料，並回傳可再次讀取的副本。"""
+    response = dict(response)
+    if operation == "invoke_model":
+        response["body"] = response["body"].read()
+    elif operation in _STREAM_KEYS:
+        key = _STREAM_KEYS[operation]
+        response[key] = list(response[key])
+    return response
+
+
+def _revive(operation: str, response: Dict[str, Any]) -> Dict[str, Any]:
+    response = dict(response)
+    if operation == "invoke_model":
+        response["body"] = io.BytesIO(response["body"])
+    elif operation in _STREAM_KEYS:
+        key = _STREAM_KEYS[operation]
+        response[key] = iter(response[key])
+    return response
+
+
+class RecordingClient:
+    """包裝真實的 boto3 client，將每次呼叫的回應寫入 cassette。"""
+
+    def __init__(self, client: Any, service_name: str, cassette: Cassette):
+        self._client = client
+        self._service_name = service_name
+        self._cassette = cassette
+
+    def __getattr__(self, operation: str) -> Any:
+        method = getattr(self._client, operation)
+        if not callable(method) or operation.startswith("_"):
+            return method
+
+        def _call(**params: Any) -> Any:
+            response = _materialize(operation, method(**params))
+            self._cassette.record(Cassette.key(self._service_name, operation, params), response)
+            return _revive(operation, response)
+
+        return _call
+
+
+class ReplayClient:
+    """從 cassette 重播回應，不需網路；可選擇以 SimulatorConfig 加入延遲。"""
+
+    def __init__(self, service_name: str, cassette: Cassette, config: Optional[SimulatorConfig] = None):
+        self._service_name = service_name
+        self._cassette = cassette
+        self._config = config
+
+    def __getattr__(self, operation: str) -> Any:
+        if operation.startswith("_"):
+            raise AttributeError(operation)
+
+        def _call(**params: Any) -> Any:
+            if self._config is not None:
+                self._config.wait_base_latency()
+            response = self._cassette.play(Cassette.key(self._service_name, operation, params))
+            return _revive(operation, response)
+
+        return _call
+
+
+def recording_factory(cassette_path: str) -> Callable[..., Any]:
+    import boto3
+
+    cassette = Cassette(cassette_path)
+
+    def _factory(service_name: str, region_name: str, config: Any = None) -> Any:
+        client = boto3.client(service_name, region_name=region_name, config=config)
+        return RecordingClient(client, service_name, cassette)
+
+    return _factory
+
+
+def replay_factory(cassette_path: str, config: Optional[SimulatorConfig] = None) -> Callable[..., Any]:
+    cassette = Cassette(cassette_path)
+
+    def _factory(service_name: str, region_name: str, _config: Any = None) -> Any:
+        return ReplayClient(service_name, cassette, config)
+
+    return _factory
+
+
+def factory_from_env(backend: str) -> Callable[..., Any]:
+    """
+    依 BEDROCK_BACKEND 建立 factory：simulator、record 或 replay
+    （record / replay 需以 BEDROCK_CASSETTE 指定 cassette 檔案）。
+    """
+    if backend == "simulator":
+        return simulator_factory()
+    cassette_path = os.environ.get("BEDROCK_CASSETTE", "cassettes/bedrock.json")
+    if backend == "record":
+        return recording_factory(cassette_path)
+    if backend == "replay":
+        return replay_factory(cassette_path)
+    raise ValueError(f"Unknown BEDROCK_BACKEND '{backend}'. Use aws, simulator, record or replay.")
+
+
+def use_backend(backend: str, simulator_config: Optional[SimulatorConfig] = None) -> None:
+    """在程式中切換 tools 模組使用的 Bedrock 後端。"""
+    from tools.clients import set_client_factory
+
+    if backend == "aws":
+        set_client_factory(None)
+    elif backend == "simulator":
+        set_client_factory(simulator_factory(simulator_config))
+    else:
+        set_client_factory(factory_from_env(backend))
@@ -0,0 +1,150 @@
+import asyncio
+import copy
+import hashlib
+import json
+import threading
+import weakref
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from tools import telemetry
+from tools.config import SingleFlightConfig
+from tools.deadline import Deadline, DeadlineExceeded
+
+
+_groups: "weakref.WeakValueDictionary[str, SingleFlight]" = weakref.WeakValueDictionary()
+
+
+def make_key(*parts: Any) -> str:
+    """把（已正規化的）參數轉成穩定的 key：排序過的 JSON 再取 SHA-256。"""
+    canonical = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.followers = 0
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    合併相同 key 的並行呼叫：第一個呼叫者（leader）實際執行，其餘呼叫者等待並取得同一份結果的複本。
+    結果不會保留，呼叫結束後相同 key 會重新執行；leader 失敗時所有等待者都收到同一個例外，
+    但 leader 因自己的 deadline / timeout 到期而失敗時，等待者改以自己的 func（與 deadline）重新執行。
+    do() 供執行緒使用，do_async() 供 asyncio 使用（兩者的 in-flight 呼叫分開記錄）。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self._tasks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Hashable, asyncio.Task]]" = \
+            weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "coalesced": 0, "errors": 0, "abandoned": 0}
+        _groups[name] = self
+
+    def do(self,
+           key: Hashable,
+           func: Callable[[], Any],
+           deadline: Optional[Deadline] = None,
+           stage: Optional[str] = None) -> Tuple[Any, bool]:
+        """
+        執行（或等待進行中的）func，回傳 (結果, 是否為合併的呼叫)。
+        等待者最多等到自己的 deadline，逾時則拋出 DeadlineExceeded，不影響 leader 與其他等待者。
+        """
+        if not SingleFlightConfig.ENABLED:
+            return func(), False
+
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                if call is None:
+                    call = self._calls[key] = _Call()
+                    self._stats["calls"] += 1
+                    break
+                call.followers += 1
+                self._stats["coalesced"] += 1
+
+            telemetry.metric("singleflight_coalesced", 1, group=self.name)
+            if not call.done.wait(None if deadline is None else deadline.remaining()):
+                with self._lock:
+                    self._stats["abandoned"] += 1
+                raise DeadlineExceeded(f"Deadline exceeded while waiting for stage '{stage or self.name}'.")
+            if isinstance(call.error, DeadlineExceeded):
+                # leader 的 deadline 較早到期；等待者的 deadline 可能還有餘裕，改為自己執行（或加入新的呼叫）
+                continue
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result), True
+
+        try:
+            result = func()
+        except BaseException as exc:
+            call.error = exc
+            with self._lock:
+                self._stats["errors"] += 1
+                self._calls.pop(key, None)
+            call.done.set()
+            raise
+
+        with self._lock:
+            # 先移除 key 再讀取等待者數，之後不會再有新的等待者加入
+            self._calls.pop(key, None)
+            followers = call.followers
+        if followers:
+            # 等待者拿到的是獨立的快照，leader 的呼叫端之後修改結果不會影響它們
+            call.result = copy.deepcopy(result)
+        call.done.set()
+        return result, False
+
+    async def do_async(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        asyncio 版的 do()：共用的呼叫在獨立的 task 中執行，每個呼叫端以 asyncio.shield 等待，
+        因此任一呼叫端（包含 leader）被取消都不會取消共用的呼叫；所有呼叫端都取消時 task 仍會執行完畢。
+        """
+        if not SingleFlightConfig.ENABLED:
+            return await func(), False
+
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                tasks = self._tasks.setdefault(loop, {})
+                task = tasks.get(key)
+                coalesced = task is not None and not task.done()
+                if coalesced:
+                    self._stats["coalesced"] += 1
+                else:
+                    task = tasks[key] = loop.create_task(func())
+                    self._stats["calls"] += 1
+                    task.add_done_callback(lambda finished: self._finish_task(tasks, key, finished))
+
+            if coalesced:
+                telemetry.metric("singleflight_coalesced", 1, group=self.name)
+            try:
+                result = await asyncio.shield(task)
+            except (DeadlineExceeded, asyncio.TimeoutError):
+                if not coalesced:
+                    raise
+                # 共用的呼叫因 leader 的 deadline / timeout 失敗；等待者改以自己的 func 重新執行
+                continue
+            # 每個呼叫端（包含 leader）都拿到獨立的複本，task 本身的結果不會被修改
+            return copy.deepcopy(result), coalesced
+
+    def _finish_task(self, tasks: Dict[Hashable, "asyncio.Task"], key: Hashable, task: "asyncio.Task") -> None:
+        with self._lock:
+            if tasks.get(key) is task:
+                del tasks[key]
+            if task.cancelled() or task.exception() is not None:
+                self._stats["errors"] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            in_flight = len(self._calls) + sum(len(tasks) for tasks in self._tasks.values())
+            return dict(self._stats, in_flight=in_flight)
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """回傳所有 single-flight 群組的統計（calls 為實際執行次數，coalesced 為被合併的呼叫數）。"""
+    return {name: group.stats() for name, group in list(_groups.items())}
@@ -0,0 +1,25 @@
+import math
+from typing import Dict, Iterable, List
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """以最近排名法（第 ceil(fraction * n) 個值）計算百分位數；輸入需已排序。"""
+    if not sorted_values:
+        return 0.0
+    # 先四捨五入去除浮點誤差（例如 0.7 * 10 = 7.000000000000001），避免 ceil 多進一位
+    rank = math.ceil(round(fraction * len(sorted_values), 9)) - 1
+    return sorted_values[max(0, min(len(sorted_values) - 1, rank))]
+
+
+def latency_summary(latencies_ms: Iterable[float]) -> Dict[str, float]:
+    values = sorted(latencies_ms)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean_ms": sum(values) / len(values),
+        "p50_ms": percentile(values, 0.50),
+        "p95_ms": percentile(values, 0.95),
+        "p99_ms": percentile(values, 0.99),
+        "max_ms": values[-1],
+    }
@@ -0,0 +1,266 @@
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from tools.config import TelemetryConfig
+
+
+logger = logging.getLogger("tools.telemetry")
+
+_THROTTLE_CODES = ("ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException")
+_TOKEN_HEADERS = {
+    "x-amzn-bedrock-input-token-count": "input_tokens",
+    "x-amzn-bedrock-output-token-count": "output_tokens",
+    "x-amzn-bedrock-cache-read-input-token-count": "cache_read_input_tokens",
+    "x-amzn-bedrock-cache-write-input-token-count": "cache_write_input_tokens",
+}
+
+
+class Sink:
+    """遙測資料的輸出端；enabled 為 False 時 span 與 API hook 幾乎不做任何事。"""
+
+    enabled = True
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+
+class NoopSink(Sink):
+    enabled = False
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        pass
+
+
+class LogSink(Sink):
+    """以結構化 JSON 寫入 logging。"""
+
+    def __init__(self, level: int = logging.INFO):
+        self.level = level
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        logger.log(self.level, json.dumps(record, ensure_ascii=False, default=str))
+
+
+class EMFSink(Sink):
+    """
+    輸出 CloudWatch Embedded Metric Format，Lambda 的 stdout 會自動轉成 metrics。
+    """
+
+    _METRICS = (
+        ("duration_ms", "Latency", "Milliseconds"),
+        ("input_tokens", "InputTokens", "Count"),
+        ("output_tokens", "OutputTokens", "Count"),
+        ("cache_read_input_tokens", "CacheReadInputTokens", "Count"),
+        ("cache_write_input_tokens", "CacheWriteInputTokens", "Count"),
+        ("retries", "Retries", "Count"),
+        ("throttles", "Throttles", "Count"),
+        ("value", "Value", "None"),
+    )
+
+    def __init__(self, namespace: str = TelemetryConfig.NAMESPACE, stream: Any = None):
+        self.namespace = namespace
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        dimension = "Operation" if record["type"] == "api_call" else "Stage"
+        document: Dict[str, Any] = {dimension: record["name"]}
+        metrics = []
+        for field, metric_name, unit in self._METRICS:
+            if isinstance(record.get(field), (int, float)):
+                document[metric_name] = record[field]
+                metrics.append({"Name": metric_name, "Unit": unit})
+        if record["type"] != "metric":
+            document["Errors"] = 0 if record.get("status") == "ok" else 1
+            metrics.append({"Name": "Errors", "Unit": "Count"})
+        # 其餘欄位以 property 形式保留，方便在 Logs Insights 查詢
+        for key, value in record.items():
+            document.setdefault(key, value)
+        document["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{"Namespace": self.namespace, "Dimensions": [[dimension]], "Metrics": metrics}],
+        }
+        line = json.dumps(document, ensure_ascii=False, default=str)
+        with self._lock:
+            print(line, file=self.stream or sys.stdout, flush=True)
+
+
+class OpenTelemetrySink(Sink):
+    """轉送到 OpenTelemetry（需另外安裝 opentelemetry-api 並設定 SDK / exporter）。"""
+
+    def __init__(self) -> None:
+        try:
+            from opentelemetry import metrics, trace
+        except ImportError as exc:
+            raise RuntimeError("TELEMETRY_SINK=otel requires the opentelemetry-api package.") from exc
+        self._tracer = trace.get_tracer("tools")
+        self._latency = metrics.get_meter("tools").create_histogram("kb.latency", unit="ms")
+
+    def emit(self, record: Dict[str, Any]) -> None:
+        attributes = {key: value for key, value in record.items()
+                      if isinstance(value, (str, bool, int, float)) and key not in ("start_ns", "duration_ms")}
+        if record["type"] == "metric":
+            self._latency.record(record.get("value", 0), attributes)
+            return
+        start_ns = record.get("start_ns") or time.time_ns()
+        end_ns = start_ns + int(record.get("duration_ms", 0) * 1e6)
+        otel_span = self._tracer.start_span(record["name"], start_time=start_ns, attributes=attributes)
+        otel_span.end(end_time=end_ns)
+        self._latency.record(record.get("duration_ms", 0), attributes)
+
+
+def _sink_from_name(name: str) -> Sink:
+    if name in ("", "none", "noop"):
+        return NoopSink()
+    if name == "log":
+        return LogSink()
+    if name == "emf":
+        return EMFSink()
+    if name == "otel":
+        return OpenTelemetrySink()
+    raise ValueError(f"Unknown TELEMETRY_SINK '{name}'. Use none, log, emf or otel.")
+
+
+_sink: Sink = _sink_from_name(TelemetryConfig.SINK)
+
+
+def get_sink() -> Sink:
+    return _sink
+
+
+def set_sink(sink: Optional[Sink]) -> None:
+    """切換遙測輸出端；傳入 None 代表停用。"""
+    global _sink
+    _sink = sink or NoopSink()
+
+
+def error_code(exc: BaseException) -> str:
+    response = getattr(exc, "response", None)
+    if isinstance(response, dict):
+        return response.get("Error", {}).get("Code", type(exc).__name__)
+    return type(exc).__name__
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+    """
+    量測一個階段的耗時。yield 出的 dict 可在區塊內補充屬性（例如 token 數）。
+    """
+    sink = _sink
+    if not sink.enabled:
+        yield attributes
+        return
+
+    start_ns = time.time_ns()
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield attributes
+    except GeneratorExit:
+        status = "cancelled"
+        raise
+    except BaseException as exc:
+        status = "error"
+        attributes["error_code"] = error_code(exc)
+        if attributes["error_code"] in _THROTTLE_CODES:
+            attributes["throttles"] = 1
+        raise
+    finally:
+        record = {"type": "span", "name": name, "status": status, "start_ns": start_ns,
+                  "duration_ms": (time.perf_counter() - started) * 1000}
+        record.update(attributes)
+        sink.emit(record)
+
+
+def metric(name: str, value: float, **attributes: Any) -> None:
+    """送出單一數值（例如 cold start 的 import 時間）。"""
+    sink = _sink
+    if sink.enabled:
+        record = {"type": "metric", "name": name, "value": value}
+        record.update(attributes)
+        sink.emit(record)
+
+
+def record_usage(attributes: Dict[str, Any], usage: Optional[Dict[str, Any]]) -> None:
+    """把模型回應 body 中的 usage 欄位（Nova / Converse 格式）寫入 span 屬性。"""
+    if not usage:
+        return
+    for source, target in (("inputTokens", "input_tokens"),
+                           ("outputTokens", "output_tokens"),
+                           ("cacheReadInputTokenCount", "cache_read_input_tokens"),
+                           ("cacheWriteInputTokenCount", "cache_write_input_tokens")):
+        if usage.get(source) is not None:
+            attributes[target] = usage[source]
+
+
+# ---- botocore hooks：記錄每一次 Bedrock API 呼叫（含重試與 throttling） ----
+
+def _before_call(context: Dict[str, Any], **_: Any) -> None:
+    if _sink.enabled:
+        context["telemetry_started"] = time.perf_counter()
+        context["telemetry_start_ns"] = time.time_ns()
+        context["telemetry_retries"] = 0
+        context["telemetry_throttles"] = 0
+
+
+def _needs_retry(request_dict: Optional[Dict[str, Any]] = None, response: Any = None,
+                 caught_exception: Any = None, **_: Any) -> None:
+    if not _sink.enabled or not request_dict:
+        return
+    context = request_dict.get("context", {})
+    if "telemetry_started" not in context:
+        return
+    code = None
+    if response is not None:
+        code = response[1].get("Error", {}).get("Code")
+    if code in _THROTTLE_CODES:
+        context["telemetry_throttles"] += 1
+    if code or caught_exception is not None:
+        context["telemetry_retries"] += 1
+
+
+def _after_call(http_response: Any, parsed: Dict[str, Any], model: Any, context: Dict[str, Any], **_: Any) -> None:
+    sink = _sink
+    if not sink.enabled or "telemetry_started" not in context:
+        return
+    metadata = parsed.get("ResponseMetadata", {})
+    headers = metadata.get("HTTPHeaders", {})
+    code = parsed.get("Error", {}).get("Code")
+    record = {
+        "type": "api_call",
+        "name": model.name,
+        "service": model.service_model.service_name,
+        "status": "error" if code else "ok",
+        "http_status": metadata.get("HTTPStatusCode"),
+        "start_ns": context["telemetry_start_ns"],
+        "duration_ms": (time.perf_counter() - context["telemetry_started"]) * 1000,
+        # retries 會在重試中的 needs-retry 事件累加，最後一次嘗試的 after-call 才讀到完整次數
+        "retries": metadata.get("RetryAttempts", context["telemetry_retries"]),
+        # needs-retry 對每次嘗試（含最後一次）都會觸發，這裡只補上沒有經過重試判斷的情況
+        "throttles": max(context["telemetry_throttles"], 1 if code in _THROTTLE_CODES else 0),
+        "request_id": metadata.get("RequestId"),
+    }
+    if code:
+        record["error_code"] = code
+    for header, field in _TOKEN_HEADERS.items():
+        if header in headers:
+            record[field] = int(headers[header])
+    if "usage" in parsed:
+        record_usage(record, parsed["usage"])
+    sink.emit(record)
+
+
+def instrument_client(client: Any) -> Any:
+    """在 boto3 client 上註冊遙測 hook；模擬器等沒有 botocore 事件的 client 會原樣回傳。"""
+    events = getattr(getattr(client, "meta", None), "events", None)
+    if events is None:
+        return client
+    events.register("before-call.*.*", _before_call)
+    events.register("needs-retry.*.*", _needs_retry)
+    events.register("after-call.*.*", _after_call)
+    return client
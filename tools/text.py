@@ -0,0 +1,61 @@
+import re
+from typing import List, Sequence
+
+from tools.cache import normalize_query
+from tools.config import LocalIndexConfig
+
+
+# 連續的英數字視為一個詞；連續的非 ASCII 字元（中文等，不含全形標點）為一段，之後再切成字元 n-gram
+_TOKEN_RE = re.compile(r"([0-9a-z]+(?:[._-][0-9a-z]+)*)|([^\x00-\x7f，。、；：！？「」『』（）【】《》〈〉…—\u3000]+)")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    不需 tokenizer 的 token 數估計：中文等非 ASCII 字元約一字一 token，ASCII 約四個字元一 token。
+    以 encode 計算 ASCII 字元數，整段都在 C 中完成，適合打包 context 時大量呼叫。
+    """
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (len(text) - ascii_chars) + ascii_chars // 4
+
+
+def tokenize(text: str, ngram_sizes: Sequence[int] = (1, 2)) -> List[str]:
+    """
+    將文字切成 token：英數字以詞為單位，中文等逐字並產生字元 n-gram（預設 unigram + bigram）。
+    n-gram 不跨越英數詞與標點。
+    """
+    tokens: List[str] = []
+    for word, run in _TOKEN_RE.findall(normalize_query(text)):
+        if word:
+            tokens.append(word)
+            continue
+        for size in ngram_sizes:
+            if size == 1:
+                tokens.extend(run)
+            else:
+                tokens.extend(run[index:index + size] for index in range(len(run) - size + 1))
+    return tokens
+
+
+def chunk_text(text: str,
+               max_chars: int = LocalIndexConfig.CHUNK_CHARS,
+               overlap: int = LocalIndexConfig.CHUNK_OVERLAP) -> List[str]:
+    """依空行分段後合併到 max_chars 以內；過長的段落以 overlap 字元重疊切開。"""
+    chunks: List[str] = []
+    current = ""
+    for paragraph in (part.strip() for part in re.split(r"\n\s*\n", text)):
+        if not paragraph:
+            continue
+        if len(paragraph) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            step = max(1, max_chars - overlap)
+            chunks.extend(paragraph[start:start + max_chars] for start in range(0, len(paragraph) - overlap, step))
+            continue
+        if current and len(current) + len(paragraph) + 2 > max_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks